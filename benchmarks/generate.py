@@ -0,0 +1,201 @@
+"""
+Benchmarks the code generators on synthetic modules and register maps.
+
+Each case is timed over a number of repeats, keeping the fastest, then run once more under tracemalloc for the peak
+memory. Results are written as JSON so a later run can be compared against them with --compare. The cases are the
+paths which generate differently: importing and parsing modules, regenerating over earlier output, and the per
+register FunctionContainers of parse_csv against the RegisterMap function and table outputs. BASELINE holds results
+committed along with the generators.
+
+    python -m benchmarks.generate --output baseline.json
+    python -m benchmarks.generate --sizes 10 1000 --compare benchmarks/baseline.json
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import ustubby
+from ustubby import static
+
+BASELINE = Path(__file__).with_name("baseline.json")
+
+DEFAULT_SIZES = (10, 1000, 100000)
+
+# One function per parameter kind, repeated with a numbered name until the module has the requested size
+FUNCTION_KINDS = {
+    "no_args": "() -> None",
+    "positional": "(a: int, b: float, c: bool) -> int",
+    "many_positional": "(a: int, b: int, c: int, d: float, e: str) -> float",
+    "defaults": "(a: int, b: float = 1.5, c: str = 'x') -> int",
+    "keyword": "(a: int, *, b: int = 2, c: bool = False) -> None",
+    "none_defaults": "(a: int, *, data: bytes = None, scale: float = None) -> None",
+    "buffer": "(data: bytes, out: bytearray) -> int",
+    "container": "(values: List[int]) -> float",
+    "object": "(a: object) -> str",
+    "small_int": "(a: SmallInt, b: SmallInt) -> SmallInt",
+}
+
+
+class Result(NamedTuple):
+    case: str
+    size: int
+    seconds: float
+    peak_bytes: int
+
+
+def module_source(size: int) -> str:
+    lines = ["from typing import List", "from ustubby import SmallInt"]
+    kinds = list(FUNCTION_KINDS.items())
+    for index in range(size):
+        kind, signature = kinds[index % len(kinds)]
+        lines += ["", f"def {kind}_{index}{signature}:", f'    """Synthetic {kind} function"""']
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_module(size: int, name: str = "bench") -> types.ModuleType:
+    """
+    :return: Module of size functions cycling through FUNCTION_KINDS
+    """
+    mod = types.ModuleType(name)
+    exec(compile(module_source(size), f"<{name}>", "exec"), mod.__dict__)
+    return mod
+
+
+def functions(mod: types.ModuleType) -> List[Callable]:
+    return [value for value in vars(mod).values() if isinstance(value, types.FunctionType)]
+
+
+def write_register_csv(path: Path, size: int) -> Path:
+    """
+    Writes a LiteX csr.csv with size registers alternating between writable single words and read only counters
+    """
+    lines = ["csr_base,bench,0x82000000,,"]
+    for index in range(size):
+        length, access = (1, "rw") if index % 2 else (4, "ro")
+        lines.append(f"csr_register,reg_{index},0x{0x82000000 + index * 4:08x},{length},{access}")
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+def cases(size: int, directory: Path) -> Iterator[tuple]:
+    """
+    :return: (name, function to measure) for every generation path at this size
+    """
+    source = module_source(size)
+    mod = synthetic_module(size)
+    previous = ustubby.stub_module(mod)
+    csv_path = write_register_csv(directory / f"csr_{size}.csv", size)
+    yield "stub_module", lambda: ustubby.stub_module(mod)
+    yield "static_stub_module", lambda: ustubby.stub_module(static.load_source(source, "bench"))
+    yield "update_module", lambda: ustubby.update_module(mod, previous)
+    yield "parse_csv", lambda: ustubby.stub_module(ustubby.parse_csv(csv_path))
+    yield "stub_registers", lambda: ustubby.stub_registers(ustubby.RegisterMap.from_file(csv_path, "bench"))
+    yield "stub_register_table", lambda: ustubby.stub_register_table(ustubby.RegisterMap.from_file(csv_path, "bench"))
+
+
+def measure(run: Callable, repeat: int) -> tuple:
+    """
+    :return: Fastest wall time over repeat runs and the tracemalloc peak of one more run
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat: int = 3, only: Optional[List[str]] = None) -> Iterator[Result]:
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for case, run in cases(size, Path(directory)):
+                if only and case not in only:
+                    continue
+                seconds, peak = measure(run, repeat)
+                yield Result(case, size, seconds, peak)
+
+
+def baseline(results: List[Result]) -> Dict:
+    return {
+        "ustubby": ustubby.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [result._asdict() for result in results],
+    }
+
+
+def load_baseline(path: Path) -> Dict[tuple, Result]:
+    with open(path) as f:
+        data = json.load(f)
+    return {(r["case"], r["size"]): Result(**r) for r in data["results"]}
+
+
+def compare(results: List[Result], previous: Dict[tuple, Result], threshold: float) -> List[str]:
+    """
+    :return: Description of every result whose time or peak memory grew by more than threshold times
+    """
+    regressions = []
+    for result in results:
+        old = previous.get((result.case, result.size))
+        if old is None:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            ratio = getattr(result, metric) / getattr(old, metric) if getattr(old, metric) else 1.0
+            if ratio > threshold:
+                regressions.append(f"{result.case} size {result.size}: {metric} {ratio:.2f}x the baseline")
+    return regressions
+
+
+def format_result(result: Result, old: Optional[Result] = None) -> str:
+    line = f"{result.case:<24}{result.size:>8}{result.seconds:>12.4f}s{result.peak_bytes / 1024:>12.1f}KiB"
+    if old is not None and old.seconds and old.peak_bytes:
+        line += f"{result.seconds / old.seconds:>8.2f}x{result.peak_bytes / old.peak_bytes:>8.2f}x"
+    return line
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the ustubby code generators.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Number of functions in the synthetic modules and registers in the csv files.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to time for each case, keeping the fastest.")
+    parser.add_argument("--case", action="append", default=None,
+                        help="Only run this case, can be given more than once.")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=Path, default=None,
+                        help="Baseline JSON from an earlier run to compare the results against.")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Ratio to the baseline above which a result counts as a regression.")
+    args = parser.parse_args(argv)
+
+    previous = load_baseline(args.compare) if args.compare else {}
+    results = []
+    print(f"{'case':<24}{'size':>8}{'time':>13}{'peak':>15}" + (f"{'time':>9}{'peak':>9}" if previous else ""))
+    for result in run_benchmarks(args.sizes, args.repeat, args.case):
+        results.append(result)
+        print(format_result(result, previous.get((result.case, result.size))))
+    if args.output is not None:
+        args.output.write_text(json.dumps(baseline(results), indent=2) + "\n")
+    regressions = compare(results, previous, args.threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,446 @@
 from __future__ import annotations
+import array
 import inspect
+import itertools
+import math
+import re
 import types
 import csv
-from typing import Dict
+import collections.abc
+import typing
+from typing import Dict, NamedTuple, Optional
+
+from ustubby import static
 
 __version__ = "0.1.1"
 
 
 def string_template(base_str):
-    def string_handle(*args, **kwargs):
-        return base_str.format(*args, **kwargs)
+    # The bound format method, so rendering a template is a single call
+    return base_str.format
+
+
+# Types passed through the buffer protocol without copying, with the access to request and the C type of the data
+buffer_types = {
+    bytes: ("MP_BUFFER_READ", "const uint8_t"),
+    bytearray: ("MP_BUFFER_RW", "uint8_t"),
+    memoryview: ("MP_BUFFER_READ", "const uint8_t"),
+    array.array: ("MP_BUFFER_RW", "void"),
+}
+
+
+def kw_given(source):
+    """
+    :return: C condition that a keyword parameter defaulting to None was passed as something other than None
+    """
+    return f"{source} != mp_const_none"
+
+
+def buffer_template(source, flags, c_type, indent="\t", optional=False):
+    """
+    Template exposing the buffer of an object as {0} with its length in bytes as {0}_len
+    :param source: C expression for the object, formatted with the same arguments as the template
+    :param flags: MP_BUFFER_READ, MP_BUFFER_WRITE or MP_BUFFER_RW
+    :param c_type: Type the body sees the data as
+    :param optional: The parameter defaults to None, leaving {0} NULL and {0}_len 0 when it is None
+    """
+    if optional:
+        lines = ["mp_buffer_info_t {0}_bufinfo = {{ .buf = NULL, .len = 0 }};",
+                 f"if ({kw_given(source)}) {{{{",
+                 f"\tmp_get_buffer_raise({source}, &{{0}}_bufinfo, {flags});",
+                 "}}"]
+    else:
+        lines = ["mp_buffer_info_t {0}_bufinfo;",
+                 f"mp_get_buffer_raise({source}, &{{0}}_bufinfo, {flags});"]
+    return string_template("\n".join(indent + line for line in lines + [
+        f"{c_type} *{{0}} = {{0}}_bufinfo.buf;",
+        "size_t {0}_len = {0}_bufinfo.len;",
+    ]))
+
+
+# Element types that typed containers such as List[int] unpack into, with the C type and the function converting an
+# mp_obj_t into it. Add to this with register_element_type.
+element_types = {
+    int: ("mp_int_t", "mp_obj_get_int"),
+    float: ("mp_float_t", "mp_obj_get_float"),
+    bool: ("bool", "mp_obj_is_true"),
+}
+
+# Generic origins which can be unpacked with mp_obj_get_array
+container_origins = (list, tuple, collections.abc.Sequence)
+
+
+def container_element(annotation):
+    """
+    :param annotation: Parameter annotation such as List[int], Tuple[float, ...] or Tuple[int, int]
+    :return: (element type, fixed length or None) if the annotation is a typed container of a known element type
+    """
+    if typing.get_origin(annotation) not in container_origins:
+        return None
+    args = typing.get_args(annotation)
+    if len(args) == 2 and args[1] is Ellipsis:
+        args, length = args[:1], None
+    elif typing.get_origin(annotation) is tuple:
+        length = len(args)
+    else:
+        length = None
+    if not args or any(arg != args[0] for arg in args) or args[0] not in element_types:
+        return None
+    return args[0], length
+
+
+# Elements a typed container argument can have, the array being on the C stack
+CONTAINER_MAX_LENGTH = 32
+
+
+def container_template(source, c_type, converter, length=None, indent="\t", optional=False):
+    """
+    Template unpacking a list or tuple into a C array {0} with the number of elements in {0}_len.
+    The array holds CONTAINER_MAX_LENGTH elements unless the length is fixed, raising ValueError for longer objects.
+    :param source: C expression for the object, formatted with the same arguments as the template
+    :param c_type: Type of the array elements
+    :param converter: C function converting each mp_obj_t element into c_type
+    :param length: Number of elements required, or None to take any number up to CONTAINER_MAX_LENGTH
+    :param optional: The parameter defaults to None, leaving {0}_len 0 when it is None
+    :raises ValueError: if the fixed length is over CONTAINER_MAX_LENGTH
+    """
+    if length is not None and length > CONTAINER_MAX_LENGTH:
+        raise ValueError(f"Containers can have at most {CONTAINER_MAX_LENGTH} elements, not {length}")
+    if optional:
+        unpack = f"mp_obj_get_array({source}, &{{0}}_len, &{{0}}_items);" if length is None else \
+            f"mp_obj_get_array_fixed_n({source}, {length}, &{{0}}_items);"
+        lines = ["size_t {0}_len = 0;",
+                 "mp_obj_t *{0}_items = NULL;",
+                 f"if ({kw_given(source)}) {{{{",
+                 f"\t{unpack}"]
+        if length is not None:
+            lines.append(f"\t{{0}}_len = {length};")
+        lines.append("}}")
+    elif length is None:
+        lines = ["size_t {0}_len = 0;",
+                 "mp_obj_t *{0}_items = NULL;",
+                 f"mp_obj_get_array({source}, &{{0}}_len, &{{0}}_items);"]
+    else:
+        lines = [f"const size_t {{0}}_len = {length};",
+                 "mp_obj_t *{0}_items = NULL;",
+                 f"mp_obj_get_array_fixed_n({source}, {length}, &{{0}}_items);"]
+    if length is None:
+        lines += [f"if ({{0}}_len > {CONTAINER_MAX_LENGTH}) {{{{",
+                  f'\tmp_raise_ValueError(MP_ERROR_TEXT("{{0}} has more than {CONTAINER_MAX_LENGTH} elements"));',
+                  "}}"]
+    lines += [f"{c_type} {{0}}[{length or CONTAINER_MAX_LENGTH}];",
+              "for (size_t {0}_i = 0; {0}_i < {0}_len; {0}_i++) {{",
+              f"\t{{0}}[{{0}}_i] = {converter}({{0}}_items[{{0}}_i]);",
+              "}}"]
+    return string_template("\n".join(indent + line for line in lines))
+
+
+class Out:
+    """
+    Annotation for a buffer the function stores its result in, e.g. def read(out: Out[array.array]) -> float
+    The generated function returns the object passed in rather than allocating a new one.
+    """
+    buffer_type = array.array
+    _subscripted = {}
+
+    def __class_getitem__(cls, item):
+        if item not in buffer_types or item is bytes:
+            raise TypeError(f"Out needs a writable buffer type, not {item}")
+        if item not in cls._subscripted:
+            cls._subscripted[item] = type(f"Out[{item.__name__}]", (cls,), {"buffer_type": item})
+        return cls._subscripted[item]
+
+
+class SmallInt(int):
+    """
+    Annotation for an int expected to fit in a small int, e.g. def popcount(value: SmallInt) -> SmallInt
+    Arguments are read with MP_OBJ_SMALL_INT_VALUE and results made with MP_OBJ_NEW_SMALL_INT, behind one check that
+    falls back to mp_obj_get_int and mp_obj_new_int so larger values still work.
+    """
 
-    return string_handle
+
+# Reads an int argument without the type dispatch of mp_obj_get_int when it is a small int
+small_int_get = "mp_obj_is_small_int({0}) ? MP_OBJ_SMALL_INT_VALUE({0}) : mp_obj_get_int({0})"
+
+
+def small_int(f):
+    """
+    Decorator treating every int parameter and an int return value of the function as SmallInt
+    """
+    f.small_int = True
+    return f
+
+
+def many(f):
+    """
+    Decorator also generating a batched f_many(out, *args) looping over buffers in C, see ustubby.vectorise
+    The batched function uses helpers generated once per module, so stub it with stub_module.
+    """
+    f.many = True
+    return f
+
+
+def signature(f):
+    """
+    :return: inspect.signature of f, with int replaced by SmallInt for functions decorated with small_int
+    """
+    sig = inspect.signature(f)
+    if not getattr(f, "small_int", False):
+        return sig
+    return sig.replace(
+        parameters=[param.replace(annotation=SmallInt) if param.annotation is int else param
+                    for param in sig.parameters.values()],
+        return_annotation=SmallInt if sig.return_annotation is int else sig.return_annotation)
+
+
+def is_out(annotation):
+    return isinstance(annotation, type) and issubclass(annotation, Out)
+
+
+def native_struct(annotation):
+    """
+    :return: C struct of instances of a native class stubbed along with the function, or None if the annotation isn't
+        such a class, see ir.Native
+    """
+    if isinstance(annotation, ir.Native):
+        return f"{annotation.c_name}_obj_t"
+    return None
+
+
+def unsupported_annotation(annotation) -> TypeError:
+    """
+    :return: Error for a parameter annotation with no conversion to C
+    """
+    if annotation is inspect.Parameter.empty:
+        return TypeError("Parameters need an annotation to be converted to C")
+    name = getattr(annotation, "__qualname__", annotation)
+    return TypeError(f"No C conversion for parameters annotated {name}, classes are only converted when they are "
+                     f"stubbed in the same module")
+
+
+def handler(table, annotation, source, indent="\t", optional=False):
+    """
+    Looks up the template converting a parameter, building one for typed containers, Out buffers and native classes
+    :param table: Template table for the calling convention such as type_handler
+    :param source: C expression for the object if a container, Out or native class template is needed
+    :param optional: Build a buffer or container template which only converts the object when it was passed
+    """
+    if annotation == "self":
+        return string_template(f"{indent}SELF_t *{{0}} = MP_OBJ_TO_PTR({source});")
+    if optional and annotation in buffer_types:
+        return buffer_template(source, *buffer_types[annotation], indent, optional=True)
+    if annotation in table:
+        return table[annotation]
+    if is_out(annotation):
+        c_type = buffer_types[annotation.buffer_type][1].replace("const ", "")
+        return buffer_template(source, "MP_BUFFER_WRITE", c_type, indent, optional)
+    element = container_element(annotation)
+    if element is not None:
+        return container_template(source, *element_types[element[0]], length=element[1], indent=indent,
+                                  optional=optional)
+    struct = native_struct(annotation)
+    if struct is None:
+        raise unsupported_annotation(annotation)
+    return string_template(f"{indent}{struct} *{{0}} = MP_OBJ_TO_PTR({source});")
+
+
+def short_type(annotation):
+    """
+    :return: Suffix of the mp_arg_val_t member holding the annotation after mp_arg_parse_all
+    """
+    if annotation not in shortened_types and (container_element(annotation) or is_out(annotation) or
+                                              native_struct(annotation)):
+        return "obj"
+    if annotation not in shortened_types:
+        raise unsupported_annotation(annotation)
+    return shortened_types[annotation]
+
+
+# Types of positional parameters which can take a default without mp_arg_parse_all,
+# with the C type and the expression converting the given argument
+default_types = {
+    int: ("mp_int_t", "mp_obj_get_int({0})"),
+    SmallInt: ("mp_int_t", f"({small_int_get})"),
+    float: ("mp_float_t", "mp_obj_get_float({0})"),
+    bool: ("bool", "mp_obj_is_true({0})"),
+    str: ("const char*", "mp_obj_str_get_str({0})"),
+    object: ("mp_obj_t", "{0}"),
+}
+
+# Converts a positional argument into the mp_arg_val_t member mp_arg_parse_all would fill in
+kw_fast_converters = {
+    "int": "mp_obj_get_int({0})",
+    "bool": "mp_obj_is_true({0})",
+    "obj": "{0}",
+}
+
+
+def c_default(annotation, default):
+    """
+    :return: C expression for the default of a parameter, or None if it has no C equivalent for the annotation
+    """
+    if default is None:
+        return "mp_const_none" if annotation is object else None
+    if annotation is bool and isinstance(default, bool):
+        return "true" if default else "false"
+    if annotation in (int, SmallInt, float) and isinstance(default, int) and not isinstance(default, bool):
+        return str(default)
+    if annotation is float and isinstance(default, float) and math.isfinite(default):
+        return repr(default)
+    if annotation is str and isinstance(default, str) and default.isascii() and default.isprintable():
+        return '"' + default.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return None
+
+
+def default_template(annotation, default, indent="\t"):
+    """
+    Template for a trailing positional parameter of a VAR_BETWEEN function, using default when it is not given
+    """
+    c_type, converter = default_types[annotation]
+    value = c_default(annotation, default)
+
+    def template(name, index):
+        return f"{indent}{c_type} {name} = n_args > {index} ? {converter.format(f'args[{index}]')} : {value};"
+
+    return template
+
+
+def calling_convention(params):
+    """
+    Chooses how the generated function receives its arguments
+    :param params: Parameter signature from inspect.signature
+    :return: "positional" for up to three required arguments, "between" for positional arguments with optional
+        trailing defaults or more than three arguments, "keyword" for anything needing mp_arg_parse_all
+    """
+    if not all(param.kind == param.POSITIONAL_OR_KEYWORD for param in params.values()):
+        return "keyword"
+    defaults = [param for param in params.values() if param.default is not param.empty]
+    if not defaults:
+        return "positional" if len(params) < 4 else "between"
+    if all(param.annotation in default_types and c_default(param.annotation, param.default) is not None
+           for param in defaults):
+        return "between"
+    return "keyword"
+
+
+def required_count(params):
+    return sum(param.default is param.empty for param in params.values())
+
+
+def allowed_arg(name, param):
+    """
+    :return: mp_arg_t entry for a parameter of a keyword function
+    """
+    flags = []
+    if param.default is param.empty:
+        flags.append("MP_ARG_REQUIRED")
+    if param.kind == param.KEYWORD_ONLY:
+        flags.append("MP_ARG_KW_ONLY")
+    type_txt = short_type(param.annotation)
+    flags.append(f"MP_ARG_{type_txt.upper()}")
+    if param.default is inspect._empty:
+        default = ""
+    elif param.default is None and type_txt == "obj":
+        # Matching the None of a VAR_BETWEEN function, conversions check for it in kw_unpack
+        default = "{ .u_rom_obj = MP_ROM_NONE }"
+    elif param.default is None or type_txt == "obj":
+        # Object defaults are filled in after parsing, see arg_unpack
+        default = f"{{ .u_{type_txt} = MP_OBJ_NULL }}"
+    else:
+        value = c_default(param.annotation, param.default) if param.annotation in default_types else None
+        default = f"{{ .u_{type_txt} = {value if value is not None else param.default} }}"
+    return f"{{ MP_QSTR_{name}, {' | '.join(flags)}, {default} }},"
+
+
+def kw_parse(name, params):
+    """
+    Parses the arguments of a keyword function into args.
+    Calls without keywords are unpacked directly, as mp_arg_parse_all searches the keyword map for every parameter.
+    :param name: C name of the function, the allowed arguments are {name}_allowed_args
+    :param params: Parameter signature from inspect.signature, None to always use mp_arg_parse_all
+    :return: list of lines indented with tabs
+    """
+    table = f"{name}_allowed_args"
+    parse_all = [f"mp_arg_parse_all(n_args - 1, pos_args + 1, kw_args,",
+                 f"\tMP_ARRAY_SIZE({table}), {table}, args);"]
+    lines = [f"\tmp_arg_val_t args[MP_ARRAY_SIZE({table})];"]
+    fast = kw_fast_path(table, params or {})
+    if not params or fast is None:
+        return lines + ["\t" + line for line in parse_all]
+    return lines + fast + ["\t} else {"] + ["\t\t" + line for line in parse_all] + ["\t}"]
+
+
+def kw_fast_path(table, params):
+    """
+    :return: Lines unpacking a call with only positional arguments into args, or None if it can't be done without
+        mp_arg_parse_all
+    """
+    positional = [name for name, param in params.items()
+                  if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)]
+    required = required_count(params)
+    if any(param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD) or
+           param.default is param.empty and name not in positional or
+           short_type(param.annotation) not in kw_fast_converters for name, param in params.items()):
+        return None
+    # The first positional argument is skipped as in mp_arg_parse_all below
+    if required == len(positional):
+        count = f"n_args == {required + 1}"
+    elif required:
+        count = f"n_args >= {required + 1} && n_args <= {len(positional) + 1}"
+    else:
+        count = f"n_args <= {len(positional) + 1}"
+    lines = [f"\tif (kw_args->used == 0 && {count}) {{"]
+    for name, param in params.items():
+        type_txt = short_type(param.annotation)
+        default = f"args[ARG_{name}] = {table}[ARG_{name}].defval;"
+        if name not in positional:
+            lines.append(f"\t\t{default}")
+            continue
+        index = positional.index(name) + 1
+        converter = small_int_get if param.annotation is SmallInt else kw_fast_converters[type_txt]
+        convert = f"args[ARG_{name}].u_{type_txt} = {converter.format(f'pos_args[{index}]')};"
+        if param.default is param.empty:
+            lines.append(f"\t\t{convert}")
+        else:
+            lines.extend([f"\t\tif (n_args > {index}) {{", f"\t\t\t{convert}",
+                          "\t\t} else {", f"\t\t\t{default}", "\t\t}"])
+    return lines
+
+
+def register_element_type(py_type, c_type, converter):
+    """
+    Allows py_type to be used as a parameter and as the element type of typed containers
+    e.g. register_element_type(Q15, "int16_t", "q15_from_obj") for List[Q15]
+    :param py_type: Annotation to recognise
+    :param c_type: C type of the converted value
+    :param converter: C function or macro converting an mp_obj_t into c_type
+    """
+    element_types[py_type] = (c_type, converter)
+    type_handler[py_type] = string_template(f"\t{c_type} {{0}} = {converter}({{0}}_obj);")
+    type_handler_arr[py_type] = string_template(f"\t{c_type} {{0}} = {converter}(args[{{1}}]);")
+    kw_type_handler[py_type] = string_template(f"\t{c_type} {{0}} = {converter}(args[ARG_{{0}}].u_obj);")
+    shortened_types[py_type] = "obj"
 
 
 type_handler = {
     int: string_template("\tmp_int_t {0} = mp_obj_get_int({0}_obj);"),
+    SmallInt: string_template(f"\tmp_int_t {{0}} = {small_int_get.format('{0}_obj')};"),
     float: string_template("\tmp_float_t {0} = mp_obj_get_float({0}_obj);"),
     bool: string_template("\tbool {0} = mp_obj_is_true({0}_obj);"),
     str: string_template("\tconst char* {0} = mp_obj_str_get_str({0}_obj);"),
     tuple: string_template(
-        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
     list: string_template(
-        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
     set: string_template(
-        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
-    object: string_template("\tmp_obj_t {0} args[ARG_{0}].u_obj;"),
-    "self": string_template("\tSELF_t *self = MP_OBJ_TO_PTR(self_in);"),
+        "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
+    object: string_template("\tmp_obj_t {0} = {0}_obj;"),
+    "self": string_template("\tSELF_t *{0} = MP_OBJ_TO_PTR({0}_obj);"),
+    **{t: buffer_template("{0}_obj", *v) for t, v in buffer_types.items()},
 }
 type_handler_arr = {
     int: string_template("\tmp_int_t {0} = mp_obj_get_int(args[{1}]);"),
+    SmallInt: string_template(f"\tmp_int_t {{0}} = {small_int_get.format('args[{1}]')};"),
     float: string_template("\tmp_float_t {0} = mp_obj_get_float(args[{1}]);"),
     bool: string_template("\tbool {0} = mp_obj_is_true(args[{1}]);"),
     str: string_template("\tconst char* {0} = mp_obj_str_get_str(args[{1}]);"),
@@ -39,26 +450,43 @@ type_handler_arr = {
         "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array(args[{1}], &{0}_len, &{0});"),
     set: string_template(
         "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array(args[{1}], &{0}_len, &{0});"),
-    object: string_template("\tmp_obj_t {0} args[ARG_{0}].u_obj;")
+    object: string_template("\tmp_obj_t {0} = args[{1}];"),
+    **{t: buffer_template("args[{1}]", *v) for t, v in buffer_types.items()},
+}
+# Keyword arguments defaulting to None which are converted unless they are None, with the value they are left as
+kw_none_handler = {
+    float: string_template("\tbool {0}_given = {1};\n"
+                           "\tmp_float_t {0} = {0}_given ? mp_obj_get_float(args[ARG_{0}].u_obj) : 0;"),
+    str: string_template("\tconst char* {0} = {1} ? mp_obj_str_get_str(args[ARG_{0}].u_obj) : NULL;"),
+}
+# Keyword arguments which need converting after mp_arg_parse_all
+kw_type_handler = {
+    float: string_template("\tmp_float_t {0} = mp_obj_get_float(args[ARG_{0}].u_obj);"),
+    str: string_template("\tconst char* {0} = mp_obj_str_get_str(args[ARG_{0}].u_obj);"),
+    **{t: buffer_template("args[ARG_{0}].u_obj", *v) for t, v in buffer_types.items()},
 }
 
 return_type_handler = {
     int: "\tmp_int_t ret_val;",
+    SmallInt: "\tmp_int_t ret_val;",
     float: "\tmp_float_t ret_val;",
     bool: "\tbool ret_val;",
     str: "",
     tuple: "",
     # tuple: string_template(
-    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
     # list: string_template(
-    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
     # set: string_template(
-    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+    #     "\tmp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
     None: ""
 }
 
+small_int_return = "return MP_SMALL_INT_FITS(ret_val) ? MP_OBJ_NEW_SMALL_INT(ret_val) : mp_obj_new_int(ret_val);"
+
 return_handler = {
     int: "\treturn mp_obj_new_int(ret_val);",
+    SmallInt: "\t" + small_int_return,
     float: "\treturn mp_obj_new_float(ret_val);",
     bool: "\treturn mp_obj_new_bool(ret_val);",
     str: "\treturn mp_obj_new_str(<ret_val_ptr>, <ret_val_len>);",
@@ -73,20 +501,225 @@ return_handler = {
     None: "\treturn mp_const_none;"
 }
 
+# Returns which avoid allocating, see return_mode. Floats are immediate objects on ports with MICROPY_OBJ_REPR_C or
+# MICROPY_OBJ_REPR_D, where mp_obj_new_float doesn't allocate, and are allocated as usual elsewhere.
+static_return_handler = {
+    **return_handler,
+    str: "\treturn MP_OBJ_NEW_QSTR(ret_val);",
+}
+
+# Strings returned in the static mode are qstrs known when the firmware is built, such as MP_QSTR_ok
+static_return_type_handler = {
+    **return_type_handler,
+    str: "\tqstr ret_val;",
+}
+
+return_modes = ("object", "out", "static")
+
+
+def return_mode(mode):
+    """
+    Decorator choosing how the generated function returns its result
+    object: allocates a new object for the result as usual
+    out: stores the result in the parameter annotated with Out and returns that object, selected automatically when
+        a parameter is annotated with Out
+    static: strings are returned as a qstr ret_val, such as MP_QSTR_ok, so only qstrs built into the firmware can be
+        returned. Floats are returned as usual, which only avoids allocating on ports where they are immediate values.
+    """
+    if mode not in return_modes:
+        raise ValueError(f"Unknown return mode {mode}, expected one of {', '.join(return_modes)}")
+
+    def decorator(f):
+        f.return_mode = mode
+        return f
+
+    return decorator
+
+
+def out_parameter(params):
+    """
+    :return: Name of the first parameter annotated with Out, or None
+    """
+    return next((name for name, param in params.items() if is_out(param.annotation)), None)
+
+
+def resolve_return_mode(f, params):
+    """
+    :return: Return mode of the function, from return_mode or from an Out parameter
+    """
+    mode = getattr(f, "return_mode", None) or ("out" if out_parameter(params) else "object")
+    if mode == "out" and out_parameter(params) is None:
+        raise ValueError(f"{f.__name__} returns through an out parameter but none is annotated with Out")
+    return mode
+
+
+def param_source(params, name):
+    """
+    :return: C expression for the object passed as parameter name
+    """
+    convention = calling_convention(params)
+    if convention == "positional":
+        return f"{name}_obj"
+    if convention == "between":
+        return f"args[{list(params).index(name)}]"
+    return f"args[ARG_{name}].u_obj"
+
+
+def out_return(ret_type, name, source):
+    """
+    Stores ret_val in the out buffer name by its typecode, then returns the object passed in
+    :param ret_type: int, float, bool, None or a fixed length tuple of these such as Tuple[float, float, float]
+    :param source: C expression for the out object
+    """
+    element = container_element(ret_type)
+    if element is not None and element[1]:
+        element_type, count, value = element[0], element[1], "ret_val[i]"
+    elif ret_type in (int, SmallInt, float, bool, None):
+        element_type, count, value = ret_type, 1, "ret_val"
+    else:
+        raise ValueError(f"Can't return {ret_type} through an out parameter")
+    lines = []
+    if element_type is not None:
+        index = "i" if count > 1 else "0"
+        size = f"mp_binary_get_size('@', {name}_bufinfo.typecode, NULL)"
+        lines += [f"if ({name}_len < {f'{count} * ' if count > 1 else ''}{size}) {{",
+                  '\tmp_raise_ValueError(MP_ERROR_TEXT("out buffer too small"));',
+                  "}"]
+        if element_type is float:
+            store = [f"switch ({name}_bufinfo.typecode) {{",
+                     "\tcase 'f':",
+                     f"\t\t((float *){name})[{index}] = {value};",
+                     "\t\tbreak;",
+                     "\tcase 'd':",
+                     f"\t\t((double *){name})[{index}] = {value};",
+                     "\t\tbreak;",
+                     "\tdefault:",
+                     '\t\tmp_raise_TypeError(MP_ERROR_TEXT("out must be an array of floats"));',
+                     "}"]
+        else:
+            store = [f"mp_binary_set_val_array_from_int({name}_bufinfo.typecode, {name}, {index}, {value});"]
+        if count > 1:
+            store = [f"for (size_t i = 0; i < {count}; i++) {{"] + ["\t" + line for line in store] + ["}"]
+        lines += store
+    lines.append(f"return {source};")
+    return "\n".join("\t" + line for line in lines)
+
+
 shortened_types = {
     int: "int",
+    SmallInt: "int",
     object: "obj",
     None: "null",
     bool: "bool",
+    float: "obj",
+    str: "obj",
     "self": "OBJ",
+    **{t: "obj" for t in buffer_types},
 }
 
 
+def dedent(lines):
+    """
+    Removes the leading tab from generated lines and expands the rest for use in the container to_c methods
+    """
+    return [(line[1:] if line.startswith("\t") else line).replace("\t", "    ") for line in lines]
+
+
 def expand_newlines(lst_in):
-    new_list = []
-    for line in lst_in:
-        new_list.extend(line.replace('\t', '    ').split('\n'))
-    return new_list
+    return "\n".join(lst_in).replace('\t', '    ').split('\n')
+
+
+# Opening line of a generated function, the name being wrapped in the IMPL macro of its module when instrumented
+c_function_open = re.compile(r"^STATIC mp_obj_t (?:\w+_IMPL\((\w+)\)|(\w+))\(.*\) \{$")
+
+# First line of each return the generator puts after the body, see ret_val_return
+c_return_open = re.compile(r"^\s*(?:return\b|#if |if \(\w+_len < |// signature:)")
+
+
+def brace_depth(line, depth, comment):
+    """
+    Follows the nesting of braces through a line of C, ignoring those in comments, strings and character constants
+    :param depth: Braces open before the line
+    :param comment: A /* comment is open before the line
+    :return: depth and comment after the line
+    """
+    index = 0
+    while index < len(line):
+        if comment:
+            end = line.find("*/", index)
+            if end < 0:
+                return depth, True
+            index, comment = end + 2, False
+            continue
+        char = line[index]
+        if line.startswith("//", index):
+            break
+        if line.startswith("/*", index):
+            index, comment = index + 2, True
+            continue
+        if char in "\"'":
+            index += 1
+            while index < len(line) and line[index] != char:
+                index += 2 if line[index] == "\\" else 1
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        index += 1
+    return depth, comment
+
+
+class CFunction(NamedTuple):
+    """
+    Function found in C generated by ustubby, see iter_c_functions
+    :param comments: Comment block before it, without the //
+    :param body: Lines between the arguments and the return, None if they can't be told apart
+    :param ret: Lines from the return to the closing brace, None along with the body
+    """
+    c_name: str
+    comments: str
+    body: Optional[str]
+    ret: Optional[str]
+
+
+def iter_c_functions(source):
+    """
+    Finds the functions of C generated by ustubby in one pass, matching braces to find where each one ends.
+    The generator puts the code between the first blank line of the function's own block after the arguments and the
+    blank lines before the return, so that is taken as the body. Blank lines inside nested blocks are part of the
+    code, and keyword functions have two more blank lines around the argument parsing.
+    :param source: String of c source
+    :return: CFunction of each function, the body being None if the blank lines are missing or the last ones aren't
+        followed by a return, as in the wrappers of instrumented functions
+    """
+    lines = source.splitlines()
+    depth, comment = 0, False
+    function = None
+    for index, line in enumerate(lines):
+        if function is None and depth == 0 and not comment:
+            match = c_function_open.match(line)
+            if match:
+                start = index
+                while start > 0 and lines[start - 1].startswith("//"):
+                    start -= 1
+                skip = 2 if line.endswith(f"({ir.KEYWORD_PARAMS}) {{") else 0
+                function = (match.group(1) or match.group(2), "\n".join(line[2:] for line in lines[start:index]),
+                            skip, [])
+        elif function is not None and depth == 1 and not comment and not line.strip():
+            function[3].append(index)
+        depth, comment = brace_depth(line, depth, comment)
+        if function is not None and depth == 0:
+            c_name, comments, skip, blanks = function
+            body = ret = None
+            if len(blanks) > skip + 1 and c_return_open.match(lines[blanks[-1] + 1]):
+                # The tuple return starts with a blank line of its own
+                end = len(blanks) - 1
+                while end > skip + 1 and blanks[end - 1] == blanks[end] - 1:
+                    end -= 1
+                body = "\n".join(lines[blanks[skip] + 1:blanks[end]])
+                ret = "\n".join(lines[blanks[end] + 1:index])
+            yield CFunction(c_name, comments, body, ret)
+            function = None
 
 
 class BaseContainer:
@@ -126,31 +759,32 @@ class ModuleContainer:
 class FunctionContainer(BaseContainer):
     return_type_handler = {
         int: "mp_int_t ret_val;",
+        SmallInt: "mp_int_t ret_val;",
         float: "mp_float_t ret_val;",
         bool: "bool ret_val;",
         str: None,
         tuple: "",
         # tuple: string_template(
-        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
         # list: string_template(
-        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
         # set: string_template(
-        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
+        #     "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array({0}_obj, &{0}_len, &{0});"),
         None: None
     }
     return_handler = {
         int: "return mp_obj_new_int(ret_val);",
+        SmallInt: small_int_return,
         float: "return mp_obj_new_float(ret_val);",
         bool: "return mp_obj_new_bool(ret_val);",
         str: "return mp_obj_new_str(<ret_val_ptr>, <ret_val_len>);",
-        tuple: '''
-        // signature: mp_obj_t mp_obj_new_tuple(size_t n, const mp_obj_t *items);
-        mp_obj_t ret_val[] = {
-            mp_obj_new_int(123),
-            mp_obj_new_float(456.789),
-            mp_obj_new_str("hello", 5),
-        };
-        return mp_obj_new_tuple(3, ret_val);''',
+        tuple: '''// signature: mp_obj_t mp_obj_new_tuple(size_t n, const mp_obj_t *items);
+mp_obj_t ret_val[] = {
+    mp_obj_new_int(123),
+    mp_obj_new_float(456.789),
+    mp_obj_new_str("hello", 5),
+};
+return mp_obj_new_tuple(3, ret_val);''',
         None: "return mp_const_none;"
     }
 
@@ -162,7 +796,9 @@ class FunctionContainer(BaseContainer):
         self.code = None
         self.return_type = None
         self.return_value = None
+        self.return_mode = "object"
         self.signature = None
+        self.many = False
 
     def load_python(self, input) -> FunctionContainer:
         """
@@ -172,11 +808,50 @@ class FunctionContainer(BaseContainer):
         self.comments = input.__doc__
         self.name = input.__name__
         self.module = input.__module__
-        self.signature = inspect.signature(input)
+        self.signature = signature(input)
         self.parameters.load_python(self.signature.parameters)
-        self.return_type = inspect.signature(input).return_annotation
+        self.parameters.name = f"{self.module}_{self.name}"
+        self.return_type = self.signature.return_annotation
+        self.return_mode = resolve_return_mode(input, self.signature.parameters)
+        self.many = getattr(input, "many", False)
         return self
 
+    def load_c(self, input: str) -> FunctionContainer:
+        """
+        Reads a function back from C generated by ustubby, keeping its body as code.
+        The module, if already set, is stripped from the C name to give the name.
+        :param input: String of c source holding the function and its comment block
+        :return: self
+        :raises ValueError: if input holds no generated function with a body
+        """
+        for c_name, comments, body, _ in iter_c_functions(input):
+            if body is not None:
+                return self.load_c_function(c_name, comments, body)
+        raise ValueError("No generated function with a body found")
+
+    def load_c_function(self, c_name: str, comments: str, body: str) -> FunctionContainer:
+        """
+        :param body: Lines of the body as generated, dedented once for code, with whitespace only lines left empty
+            as to_ir leaves empty lines unindented
+        :return: self
+        """
+        prefix = f"{self.module}_" if self.module else ""
+        self.name = c_name[len(prefix):] if c_name.startswith(prefix) else c_name
+        self.comments = comments
+        self.code = "\n".join("" if not line.strip() else line[4:] if line.startswith("    ") else line
+                               for line in body.splitlines())
+        return self
+
+    def load_ast(self, input, module: str, namespace=None) -> FunctionContainer:
+        """
+        Alternative to load_python that reads the function definition without executing anything
+        :param input: ast.FunctionDef to parse
+        :param module: Name of the module the function belongs to
+        :param namespace: Names available to annotations, see static.import_namespace
+        :return:
+        """
+        return self.load_python(static.function_from_ast(input, module, namespace))
+
     def to_c_comments(self):
         """
         Uses single line comments as we can't know if there are string escapes such as /* in the code
@@ -190,6 +865,8 @@ class FunctionContainer(BaseContainer):
         return f"STATIC mp_obj_t {self.module}_{self.name}"
 
     def to_c_return_val_init(self):
+        if self.return_mode == "out":
+            return "\n".join(dedent(ret_val_init(self.return_type, self.return_mode).splitlines())) or None
         return self.return_type_handler[self.return_type]
 
     def to_c_code_body(self):
@@ -201,6 +878,12 @@ class FunctionContainer(BaseContainer):
     def to_c_return_value(self):
         if self.return_value is not None:
             return self.return_value
+        elif self.return_mode != "object":
+            params = self.parameters.parameters
+            out = out_parameter(params)
+            lines = ret_val_return(self.return_type, self.return_mode, out and (out, param_source(params, out)))
+            return "\n".join(line if line.startswith("#") else line[1:] for line in lines.splitlines()).replace(
+                "\t", "    ")
         else:
             return self.return_handler.get(self.return_type)
 
@@ -211,7 +894,7 @@ class FunctionContainer(BaseContainer):
         elif self.parameters.type == "between":
             return f"MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(" \
                 f"{self.module}_{self.name}_obj, " \
-                f"{self.parameters.count}, {self.parameters.count}, {self.module}_{self.name});"
+                f"{self.parameters.required}, {self.parameters.count}, {self.module}_{self.name});"
         elif self.parameters.type == "keyword":
             return f"MP_DEFINE_CONST_FUN_OBJ_KW({self.module}_{self.name}_obj, 1, {self.module}_{self.name});"
 
@@ -219,66 +902,57 @@ class FunctionContainer(BaseContainer):
         if self.parameters.type == "keyword":
             return f"STATIC const mp_arg_t {self.module}_{self.name}_allowed_args[]"
 
-    def to_c(self):
-        # TODO work on formatter
-        resp = self.to_c_comments()
-        resp += "\n"
-        resp += f"{self.to_c_func_def()}({self.parameters.to_c_input()}) {{\n"
-        resp += "    " + "\n    ".join(self.parameters.to_c_init().splitlines()) + "\n"
-        if self.to_c_return_val_init():
-            resp += "    " + self.to_c_return_val_init() + "\n"
-        resp += f"\n    {self.to_c_code_body()}\n\n"
-        resp += f"    {self.to_c_return_value()}\n"
-        resp += "}\n"
-        resp += self.to_c_define()
-        return resp
+    def to_ir(self) -> ir.Function:
+        """
+        :return: The function as an IR node, dropping blank comment lines and indenting code and return_value
+        """
+        ret_value = None
+        if self.return_value is not None:
+            ret_value = "\n".join(line if line.startswith("#") else "    " + line
+                                  for line in self.return_value.splitlines())
+        doc = self.comments and "\n".join(line for line in self.comments.splitlines() if line.strip())
+        out = out_parameter(self.parameters.parameters) if self.return_mode == "out" else None
+        code = self.code and "\n".join(line if not line or line.startswith("#") else "    " + line
+                                       for line in self.code.splitlines())
+        return ir.Function(self.name, f"{self.module}_{self.name}", doc, self.parameters.type,
+                           map(ir.Parameter.from_inspect, self.parameters.parameters.values()),
+                           ir.Return(self.return_type, self.return_mode, out, ret_value),
+                           code or None, many=self.module if self.many else None)
+
+    def to_c(self, instrument=False):
+        """
+        :param instrument: Time the function, needs the stats macros from instrument.preamble of its module
+        """
+        fn = self.to_ir()
+        if instrument:
+            fn = fn.replace(instrument=self.module)
+        return "\n".join(ir.render_function(fn)[1:])
 
 
 class ParametersContainer(BaseContainer):
-    type_handler = {
-        int: string_template("mp_int_t {0} = mp_obj_get_int({0}_obj);"),
-        float: string_template("mp_float_t {0} = mp_obj_get_float({0}_obj);"),
-        bool: string_template("bool {0} = mp_obj_is_true({0}_obj);"),
-        str: string_template("const char* {0} = mp_obj_str_get_str({0}_obj);"),
-        tuple: string_template(
-            "mp_obj_t *{0} = NULL;\nsize_t {0}_len = 0;\nmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
-        list: string_template(
-            "mp_obj_t *{0} = NULL;\nsize_t {0}_len = 0;\nmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
-        set: string_template(
-            "mp_obj_t *{0} = NULL;\nsize_t {0}_len = 0;\nmp_obj_get_array({0}_arg, &{0}_len, &{0});"),
-        object: string_template("\tmp_obj_t {0} args[ARG_{0}].u_obj;")
-    }
-    type_handler_arr = {
-        int: string_template("mp_int_t {0} = mp_obj_get_int(args[{1}]);"),
-        float: string_template("mp_float_t {0} = mp_obj_get_float(args[{1}]);"),
-        bool: string_template("bool {0} = mp_obj_is_true(args[{1}]);"),
-        str: string_template("const char* {0} = mp_obj_str_get_str(args[{1}]);"),
-        tuple: string_template(
-            "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array(args[{1}], &{0}_len, &{0});"),
-        list: string_template(
-            "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array(args[{1}], &{0}_len, &{0});"),
-        set: string_template(
-            "mp_obj_t *{0} = NULL;\n\tsize_t {0}_len = 0;\n\tmp_obj_get_array(args[{1}], &{0}_len, &{0});"),
-        object: string_template("mp_obj_t {0} args[ARG_{0}].u_obj;")
-    }
-
     def __init__(self):
         self.type = ""
         self.count = 0
+        self.required = 0
         self.parameters = None
+        # C name of the function, used to name the keyword argument table
+        self.name = None
 
     def load_python(self, input: Dict[str, inspect.Parameter]) -> ParametersContainer:
         self.parameters = input
         self.count = len(self.parameters)
-        simple = all([param.kind == param.POSITIONAL_OR_KEYWORD for param in self.parameters.values()])
-        if simple and self.count < 4:
-            self.type = "positional"
-        elif simple:
-            self.type = "between"
-        else:
-            self.type = "keyword"
+        self.required = required_count(self.parameters)
+        self.type = calling_convention(self.parameters)
         return self
 
+    def load_ast(self, input, namespace=None) -> ParametersContainer:
+        """
+        :param input: ast.arguments of a function definition
+        :param namespace: Names available to annotations, see static.import_namespace
+        :return:
+        """
+        return self.load_python(static.parameters_from_ast(input, namespace or static.base_namespace()))
+
     def to_c_enums(self):
         if self.type != "keyword":
             return None
@@ -286,30 +960,17 @@ class ParametersContainer(BaseContainer):
 
     def to_c_kw_allowed_args(self):
         if self.type == "keyword":
-            args = []
-            for name, param in self.parameters.items():
-                if param.kind in [param.POSITIONAL_OR_KEYWORD, param.POSITIONAL_ONLY]:
-                    arg_type = "MP_ARG_REQUIRED"
-                else:
-                    arg_type = "MP_ARG_KW_ONLY"
-                type_txt = shortened_types[param.annotation]
-                if param.default is inspect._empty:
-                    default = ""
-                elif param.default is None:
-                    default = f"{{ .u_{type_txt} = MP_OBJ_NULL }}"
-                else:
-                    default = f"{{ .u_{type_txt} = {param.default} }}"
-                args.append(f"{{ MP_QSTR_{name}, {arg_type} | MP_ARG_{type_txt.upper()}, {default} }},")
-            return args
-            # return f"\tSTATIC const mp_arg_t {f.__module__}_{f.__name__}_allowed_args[] = {{\n\t\t{args}\n\t}};"
+            return [allowed_arg(name, param) for name, param in self.parameters.items()]
 
     def to_c_arg_array(self):
         if self.type != "keyword":
             return None
+        return "\n".join(dedent(kw_parse(self.name, self.parameters)))
 
     def to_c_kw_arg_unpack(self):
         if self.type != "keyword":
             return None
+        return "\n".join(dedent(arg_unpack(self.parameters).splitlines()))
 
     def to_c_input(self):
         if self.type == "positional":
@@ -318,167 +979,248 @@ class ParametersContainer(BaseContainer):
             return "size_t n_args, const mp_obj_t *args"
         elif self.type == "keyword":
             # Complex case
-            return "size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args) {"
+            return "size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args"
 
     def to_c_init(self):
-        if self.type == "keyword":
-            return "\n".join([self.to_c_enums(),
-                              self.to_c_kw_allowed_args(),
-                              "",
-                              self.to_c_arg_array(),
-                              "",
-                              self.to_c_kw_arg_unpack()])
-        elif len(self.parameters) > 3:
-            return "\n".join([self.type_handler_arr[value.annotation](param, index) for index, (param, value) in enumerate(self.parameters.items())])
-        else:
-            return "\n".join([self.type_handler[value.annotation](param) for param, value in self.parameters.items()])
+        fn = ir.Function(self.name, self.name, convention=self.type,
+                         parameters=map(ir.Parameter.from_inspect, self.parameters.values()))
+        return "\n".join(dedent("\n".join(ir.render_params(fn)).splitlines()))
 
 
 class ReturnContainer(BaseContainer):
     pass
 
 
-def stub_function(f, self=False):
+def stub_function(f, self=False, instrument=False):
     """
     :param self: first parameter is self
+    :param instrument: Time the function, needs the stats macros from instrument.preamble of its module
     """
-    # Function implementation
-    stub_ret = ["", function_comments(f), function_init(f"{f.__module__}_{f.__name__}")]
-    sig = inspect.signature(f)
-    stub_ret[-1] += function_params(sig.parameters)
-    if self:
-        parameters = dict(sig.parameters)
-        parameters['self'] = inspect.Parameter(name='self', kind=inspect._ParameterKind.POSITIONAL_ONLY, annotation='self')
-    else:
-        parameters = dict(sig.parameters)
-    stub_ret.extend(parse_params(f, parameters))
-    ret_init = ret_val_init(sig.return_annotation)
-    if ret_init:
-        stub_ret.append(ret_init)
-    stub_ret.append("")
-    stub_ret.append(code(f))
-    stub_ret.append("")
-    stub_ret.append(ret_val_return(sig.return_annotation))
-    stub_ret.append("}")
-    # C Function Definition
-    stub_ret.append(function_reference(f, f"{f.__module__}_{f.__name__}", sig.parameters))
-    return "\n".join(expand_newlines(stub_ret))
+    return "\n".join(ir.render_function(ir.build_function(f, self, instrument)))
+
+
+def iter_stub_function(f, self=False, instrument=False):
+    """
+    Generates the c source of a function one line at a time
+    :param self: first parameter is self, either the class the function is a method of or True for a placeholder type
+    :param instrument: Time the function, needs the stats macros from instrument.preamble of its module
+    """
+    yield from ir.render_function(ir.build_function(f, self, instrument))
 
 
 def module_doc(mod):
+    return module_doc_text(mod.__doc__)
+
+
+def module_doc_text(doc):
     s = '''// This file was developed using uStubby.
 // https://github.com/pazzarpj/micropython-ustubby
 '''
-    if mod.__doc__ is not None:
-        s += '\n/*'+ mod.__doc__ + '*/\n'
+    if doc is not None:
+        s += '\n/*'+ doc + '*/\n'
     return s
 
-def stub_module(mod):
-    stub_ret = [module_doc(mod), headers()]
-    classes = [o[1] for o in inspect.getmembers(mod) if inspect.isclass(o[1])]
-    members = [o[1] for cls in classes for o in inspect.getmembers(cls) if inspect.isfunction(o[1])]
-    functions = [o[1] for o in inspect.getmembers(mod) if inspect.isfunction(o[1])]
-    for func in members:
-        stub_ret.append(stub_function(func, self=True))
-    # Define the functions
-    for func in functions:
-        stub_ret.append(stub_function(func))
-    # Set up the module properties
-    stub_ret.append("")
-    stub_ret.append(f"STATIC const mp_rom_map_elem_t {mod.__name__}_module_globals_table[] = {{")
-    stub_ret.append(f"\t{{ MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_{mod.__name__}) }},")
-    stub_ret.extend(
-        [f"\t{{ MP_ROM_QSTR(MP_QSTR_{f.__name__}), MP_ROM_PTR(&{mod.__name__}_{f.__name__}_obj) }}," for f in
-         functions])
-    stub_ret.append("};")
-    stub_ret.append("")
-    stub_ret.append(f"STATIC MP_DEFINE_CONST_DICT({mod.__name__}_module_globals, {mod.__name__}_module_globals_table);")
+def stub_module(mod, instrument=False):
+    return "\n".join(iter_stub_module(mod, instrument))
+
+
+def iter_stub_module(mod, instrument=False):
+    """
+    Generates the c source of a module in chunks, joining them with newlines gives stub_module(mod)
+    :param instrument: Time every function into call stats read with _stats(), see ustubby.instrument
+    """
+    yield from ir.render_module(ir.build_module(mod, instrument))
+
+
+def load_c(source, module):
+    """
+    Reads the functions of C generated for a module back into FunctionContainers, see FunctionContainer.load_c
+    :param source: String of c source
+    :param module: Name of the module
+    :return: The containers keyed by function name
+    """
+    containers = {}
+    for c_name, comments, body, _ in iter_c_functions(source):
+        if body is not None and c_name.startswith(f"{module}_"):
+            container = FunctionContainer()
+            container.module = module
+            containers[c_name[len(module) + 1:]] = container.load_c_function(c_name, comments, body)
+    return containers
+
+
+def update_module(mod, source, instrument=False):
+    return "\n".join(iter_update_module(mod, source, instrument))
+
+
+def iter_update_module(mod, source, instrument=False):
+    """
+    Regenerates a module over C previously generated for it, keeping the bodies written into its functions, methods
+    and constructors along with any return that was edited. The rest of each function is regenerated, so functions
+    whose python signature is unchanged come out byte identical and only the changed ones are rewritten. A return
+    left as generated is regenerated, following changes to the return annotation or mode. Functions with code or a
+    return value set in python take those instead.
+    :param source: String of the previously generated c source
+    :raises ValueError: if a function of the module is in source but its body can't be told apart
+    """
+    found = {}
+    for function in iter_c_functions(source):
+        # The wrapper of an instrumented function comes after it under the same name, without a body
+        if function.c_name not in found or found[function.c_name].body is None:
+            found[function.c_name] = function
+    generated_returns = {"\n".join(expand_newlines([ret])) for handlers in (return_handler, static_return_handler)
+                         for ret in handlers.values()}
+
+    def kept(c_name, code):
+        if code is not None or c_name not in found:
+            return code
+        if found[c_name].body is None:
+            raise ValueError(f"Can't find the body of {c_name}, it should be between blank lines after the "
+                             f"arguments and before the return")
+        return found[c_name].body
+
+    def kept_function(fn):
+        fn = fn.replace(code=kept(fn.c_name, fn.code))
+        ret = found[fn.c_name].ret if fn.c_name in found else None
+        if fn.ret.value is not None or ret is None or ret in generated_returns:
+            return fn
+        return fn.replace(ret=fn.ret.replace(value=ret))
+
+    module = ir.build_module(mod, instrument)
+    functions = [kept_function(fn) for fn in module.functions]
+    native_classes = []
+    for cls in module.classes:
+        make_new = cls.make_new.replace(code=kept(f"{cls.c_name}_make_new", cls.make_new.code))
+        native_classes.append(cls.replace(make_new=make_new, methods=[kept_function(fn) for fn in cls.methods]))
+    yield from ir.render_module(module.replace(functions=functions, classes=native_classes))
+
+
+def iter_module_definition(name, members, guarded=()):
+    """
+    Generates the globals table, module object and module registration
+    :param name: Module name
+    :param members: Iterable of (attribute name, ROM value) pairs to put in the globals table
+    :param guarded: (macro, members) pairs of members only compiled in when the macro is true
+    """
+    yield ""
+    yield f"STATIC const mp_rom_map_elem_t {name}_module_globals_table[] = {{"
+    yield f"\t{{ MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_{name}) }},"
+    for attr, value in members:
+        yield f"\t{{ MP_ROM_QSTR(MP_QSTR_{attr}), {value} }},"
+    for macro, entries in guarded:
+        yield f"#if {macro}"
+        for attr, value in entries:
+            yield f"\t{{ MP_ROM_QSTR(MP_QSTR_{attr}), {value} }},"
+        yield "#endif"
+    yield "};"
+    yield ""
+    yield f"STATIC MP_DEFINE_CONST_DICT({name}_module_globals, {name}_module_globals_table);"
     # Define the module object
-    stub_ret.append(f"const mp_obj_module_t {mod.__name__}_user_cmodule = {{")
-    stub_ret.append(f"\t.base = {{&mp_type_module}},")
-    stub_ret.append(f"\t.globals = (mp_obj_dict_t*)&{mod.__name__}_module_globals,")
-    stub_ret.append("};")
+    yield f"const mp_obj_module_t {name}_user_cmodule = {{"
+    yield f"\t.base = {{&mp_type_module}},"
+    yield f"\t.globals = (mp_obj_dict_t*)&{name}_module_globals,"
+    yield "};"
     # Register the module
-    stub_ret.append("")
-    stub_ret.append(
-        f"MP_REGISTER_MODULE(MP_QSTR_{mod.__name__}, {mod.__name__}_user_cmodule, MODULE_{mod.__name__.upper()}_ENABLED);")
-    return "\n".join(stub_ret)
+    yield ""
+    yield f"MP_REGISTER_MODULE(MP_QSTR_{name}, {name}_user_cmodule, MODULE_{name.upper()}_ENABLED);"
 
 
-def function_init(func_name):
-    return f"STATIC mp_obj_t {func_name}("
+def write_lines(lines, stream):
+    """
+    Writes chunks to a text stream as they are generated, separated by newlines
+    :param lines: Iterable of strings such as iter_stub_module(mod)
+    :param stream: Writable text stream such as a file or sys.stdout
+    """
+    separator = ""
+    for line in lines:
+        stream.write(separator)
+        stream.write(line)
+        separator = "\n"
 
 
-def ret_val_init(ret_type):
-    return return_type_handler[ret_type]
+def write_module(mod, stream):
+    """
+    Streams the c source of a module, keeping memory use flat regardless of module size
+    :param stream: Writable text stream such as a file or sys.stdout
+    """
+    write_lines(iter_stub_module(mod), stream)
 
 
-def ret_val_return(ret_type):
-    return return_handler[ret_type]
+def c_name(f, cls=None):
+    """
+    :param cls: Class the function is a method of
+    :return: Name of the C function implementing f
+    """
+    if cls is not None:
+        return f"{f.__module__}_{cls.__name__}_{f.__name__}"
+    return f"{f.__module__}_{f.__name__}"
+
+
+def ret_val_init(ret_type, mode="object"):
+    if mode == "out":
+        element = container_element(ret_type)
+        if element is not None and element[1]:
+            return f"\t{element_types[element[0]][0]} ret_val[{element[1]}];"
+    if mode == "static":
+        return static_return_type_handler[ret_type]
+    return return_type_handler[ret_type]
 
 
-def function_params(params):
-    if len(params) == 0:
-        return ") {"
-    simple = all([param.kind == param.POSITIONAL_OR_KEYWORD for param in params.values()])
-    if simple and len(params) < 4:
-        params = ", ".join([f"mp_obj_t {x}_obj" for x in params])
-        return params + ") {"
-    elif simple:
-        return "size_t n_args, const mp_obj_t *args) {"
-    else:
-        # Complex case
-        return "size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args) {"
+def ret_val_return(ret_type, mode="object", out=None):
+    """
+    :param mode: One of return_modes
+    :param out: Name and C expression of the out parameter for the out return mode
+    """
+    if mode == "out":
+        return out_return(ret_type, *out)
+    if mode == "static":
+        return static_return_handler[ret_type]
+    return return_handler[ret_type]
 
 
 def kw_enum(params):
     return f"\tenum {{ {', '.join(['ARG_' + k for k in params])} }};"
 
 
-def kw_allowed_args(f, params):
-    args = []
-    for name, param in params.items():
-        if param.kind in [param.POSITIONAL_OR_KEYWORD, param.POSITIONAL_ONLY]:
-            arg_type = "MP_ARG_REQUIRED"
-        else:
-            arg_type = "MP_ARG_KW_ONLY"
-        type_txt = shortened_types[param.annotation]
-        if param.default is inspect._empty:
-            default = ""
-        elif param.default is None:
-            default = f"{{ .u_{type_txt} = MP_OBJ_NULL }}"
-        else:
-            default = f"{{ .u_{type_txt} = {param.default} }}"
-        args.append(f"{{ MP_QSTR_{name}, {arg_type} | MP_ARG_{type_txt.upper()}, {default} }},")
-    args = "\n\t\t".join(args)
-    return f"\tSTATIC const mp_arg_t {f.__module__}_{f.__name__}_allowed_args[] = {{\n\t\t{args}\n\t}};"
+def kw_default_unpack(name, param):
+    """
+    :return: Conversion of an object argument falling back to its C default when it was left out, or None
+    """
+    if param.default is param.empty or param.default is None or param.annotation not in default_types:
+        return None
+    default = c_default(param.annotation, param.default)
+    if default is None:
+        return None
+    c_type, converter = default_types[param.annotation]
+    value = f"args[ARG_{name}].u_obj"
+    return f"\t{c_type} {name} = {value} == MP_OBJ_NULL ? {default} : {converter.format(value)};"
 
 
-def arg_array(f):
-    args = f"{f.__module__}_{f.__name__}_allowed_args"
-    return f"\tmp_arg_val_t args[MP_ARRAY_SIZE({args})];\n" \
-        f"\tmp_arg_parse_all(n_args - 1, pos_args + 1, kw_args,\n" \
-        f"\t\tMP_ARRAY_SIZE({args}), {args}, args);"
+def kw_unpack(name, param):
+    """
+    :return: Declaration of a keyword function's parameter from the parsed args
+    :raises TypeError: if the parameter defaults to None but its conversion has nothing to leave it as
+    """
+    annotation, type_txt = param.annotation, short_type(param.annotation)
+    if type_txt == "obj" and kw_default_unpack(name, param):
+        return kw_default_unpack(name, param)
+    if annotation in kw_type_handler or container_element(annotation) or is_out(annotation) or \
+            native_struct(annotation):
+        optional = param.default is None
+        source = f"args[ARG_{name}].u_obj"
+        if optional and annotation in kw_none_handler:
+            return kw_none_handler[annotation](name, kw_given(source))
+        if optional and annotation not in kw_type_handler and native_struct(annotation):
+            return f"\t{native_struct(annotation)} *{name} = {kw_given(source)} ? MP_OBJ_TO_PTR({source}) : NULL;"
+        if optional and not (annotation in buffer_types or container_element(annotation) or is_out(annotation)):
+            raise TypeError(f"{name} can't default to None as a {getattr(annotation, '__name__', annotation)}")
+        return handler(kw_type_handler, annotation, "args[ARG_{0}].u_obj", optional=optional)(name)
+    if type_txt == "bool":
+        return f"\tbool {name} = args[ARG_{name}].u_bool;"
+    return f"\tmp_{type_txt}_t {name} = args[ARG_{name}].u_{type_txt};"
 
 
 def arg_unpack(params):
-    return "\n".join(
-        f"\tmp_{shortened_types[param.annotation]}_t {name} = args[ARG_{name}].u_{shortened_types[param.annotation]};"
-        for name, param in params.items())
-
-
-def parse_params(f, params):
-    """
-    :param params: Parameter signature from inspect.signature
-    :return: list of strings defining the parsed parameters in c
-    """
-    simple = all([param.kind == param.POSITIONAL_OR_KEYWORD for param in params.values()])
-    if simple and len(params) > 3:
-        return [type_handler_arr[value.annotation](param, ind) for ind, (param, value) in enumerate(params.items())]
-    if simple:
-        return [type_handler[value.annotation](param) for param, value in params.items()]
-    else:
-        return [kw_enum(params), kw_allowed_args(f, params), "", arg_array(f), "", arg_unpack(params)]
+    return "\n".join(kw_unpack(name, param) for name, param in params.items())
 
 
 def headers():
@@ -494,27 +1236,7 @@ def function_comments(f):
     :param f:
     :return:
     """
-    try:
-        return '\n'.join(["//" + line.strip() for line in f.__doc__.splitlines()])
-    except AttributeError:
-        return "// No Comment"
-
-
-def code(f):
-    try:
-        return f.code
-    except AttributeError:
-        return "\t//Your code here"
-
-
-def function_reference(f, name, params):
-    simple = all([param.kind == param.POSITIONAL_OR_KEYWORD for param in params.values()])
-    if simple and len(params) < 4:
-        return f"MP_DEFINE_CONST_FUN_OBJ_{len(params)}({name}_obj, {name});"
-    elif simple:
-        return f"MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN({name}_obj, {len(params)}, {len(params)}, {name});"
-    else:
-        return f"MP_DEFINE_CONST_FUN_OBJ_KW({f.__module__}_{f.__name__}_obj, 1, {f.__module__}_{f.__name__});"
+    return ir.comment_block(f.__doc__)
 
 
 def filter_comments(csvfile):
@@ -524,29 +1246,58 @@ def filter_comments(csvfile):
         yield row
 
 
+# Converts the int {1} into the uint64_t {0}, for values which may not fit in an mp_int_t
+wide_unpack = string_template("""\tuint64_t {0};
+\tif (mp_obj_is_small_int({1})) {{
+\t\t{0} = (uint64_t)MP_OBJ_SMALL_INT_VALUE({1});
+\t}} else if (!mp_obj_is_int({1})) {{
+\t\tmp_raise_TypeError(MP_ERROR_TEXT("register value must be an int"));
+\t}} else {{
+\t\tmp_obj_int_to_bytes_impl({1}, MP_ENDIANNESS_BIG, sizeof({0}), (byte *)&{0});
+\t}}""")
+
+
 def register_func(func_name, address, length, access_control, mod="csr"):
+    """
+    Read and write functions of a register, multi word registers being read and written as uint64_t
+    """
     def write_func(value: int) -> None:
         pass
 
     def read_func() -> int:
         pass
 
+    # This module uses postponed annotations so the real types have to be set for inspect.signature
+    write_func.__annotations__ = {"value": int, "return": None}
+    read_func.__annotations__ = {"return": int}
+
     write_func.__name__ = f"{func_name}_write"
     write_func.__qualname__ = f"{func_name}_write"
     write_func.__module__ = mod
     write_func.__doc__ = f"""writes a value to {func_name} @ register {address}"""
-    write_func.code = f"\tret_val = {func_name}_read();"
+    write_func.code = f"\t{func_name}_write(value);"
 
     read_func.__name__ = f"{func_name}_read"
     read_func.__qualname__ = f"{func_name}_read"
     read_func.__doc__ = f""":return: value from {func_name} @ register {address}"""
     read_func.__module__ = mod
-    read_func.code = f"\t{func_name}_write(value);"
+    read_func.code = f"\tret_val = {func_name}_read();"
+
+    if int(length or 1) > 1:
+        # The value may not fit in an mp_int_t, so the body declares ret_val and makes the int itself
+        write_func.__annotations__ = {"value": object, "return": None}
+        write_func.code = wide_unpack("wide_value", "value") + f"\n\t{func_name}_write(wide_value);"
+        write_func.includes = ('#include "py/objint.h"',)
+        read_func.__annotations__ = {"return": None}
+        read_func.code = f"\tuint64_t ret_val = {func_name}_read();"
+        read_func.return_value = "\treturn mp_obj_new_int_from_ull(ret_val);"
 
     if access_control == "ro":
         return [read_func]
     elif access_control == "rw":
         return [read_func, write_func]
+    elif access_control == "wo":
+        return [write_func]
 
 
 csr_types = {
@@ -554,13 +1305,54 @@ csr_types = {
 }
 
 
-def parse_csv(path, module_name="csr"):
+def parse_rows(rows, module_name="csr"):
+    """
+    Builds a module of python functions to pass to stub_module from rows of a LiteX csr.csv.
+    Registers at consecutive addresses also get burst functions copying all of them at once, see RegisterMap.runs.
+    csr_field rows of register, field name, bit offset and width add read and write functions for the field.
+    """
     mod = types.ModuleType(module_name)
-    with open(path) as f:
-        reader = csv.reader(filter_comments(f))
-        for csr_type, func_name, address, length, access_control in reader:
-            if csr_type in csr_types:
-                funcs = csr_types[csr_type](func_name, address, length, access_control, mod)
-                for func in funcs:
-                    setattr(mod, func.__name__, func)
+    regmap = RegisterMap(module_name)
+    for csr_type, func_name, address, length, access_control in rows:
+        if csr_type in csr_types:
+            funcs = csr_types[csr_type](func_name, address, length, access_control, module_name)
+            for func in funcs:
+                setattr(mod, func.__name__, func)
+        if csr_type == "csr_register":
+            regmap.append(func_name, int(address, 0), int(length or 1), access_control)
+        elif csr_type == "csr_field":
+            regmap.append_field(func_name, address, int(length, 0), int(access_control, 0))
+        elif csr_type == "constant" and func_name == registers.DATA_WIDTH_CONSTANT:
+            regmap.data_width = int(address, 0)
+    for func in itertools.chain(regmap.field_funcs(), regmap.burst_funcs()):
+        setattr(mod, func.__name__, func)
     return mod
+
+
+def parse_csv(path, module_name="csr"):
+    """
+    Builds a module of python functions to pass to stub_module, see parse_rows.
+    For large register maps RegisterMap.from_csv and stub_registers are much faster and use far less memory.
+    """
+    with open(path) as f:
+        return parse_rows(csv.reader(filter_comments(f)), module_name)
+
+
+def parse_svd(path, module_name="csr"):
+    """
+    Builds a module of python functions from a CMSIS-SVD file, see importers.iter_svd and parse_rows
+    """
+    return parse_rows(importers.iter_svd(path), module_name)
+
+
+def parse_json(path, module_name="csr"):
+    """
+    Builds a module of python functions from a JSON register description, see importers.iter_json and parse_rows
+    """
+    return parse_rows(importers.iter_json(path), module_name)
+
+
+from ustubby import importers, ir, registers
+from ustubby.classes import iter_stub_class, stub_class
+from ustubby.registers import (RegisterMap, iter_stub_register_table, iter_stub_registers, stub_register_table,
+                               stub_registers)
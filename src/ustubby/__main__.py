@@ -1,58 +1,136 @@
 import argparse
-import importlib
 import sys
 from pathlib import Path
 
 import ustubby
+from ustubby import batch, footprint, harness, watch
+from ustubby.cache import Cache
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Converts a python file into micropython c extension stubs.")
-    parser.add_argument("input", type=Path,
-                        help="Python file to convert.")
+    parser.add_argument("input", type=str, nargs="+",
+                        help="Python files or LiteX csr.csv, SVD or JSON register maps to convert. Directories, glob patterns and manifest files listing "
+                             "inputs one per line are also accepted.")
     parser.add_argument("-o", "--output", type=Path, default=None,
-                        help="Output C file. Defaults to \"${input}.c\".")
+                        help="Output C file or - for stdout. Defaults to \"${input}.c\". Only valid with a single input.")
+    parser.add_argument("--output-dir", type=Path, default=None,
+                        help="Directory to write the C files into. Defaults to alongside each input.")
+    parser.add_argument("--static", action="store_true",
+                        help="Parse the input files instead of importing them, so no module code is executed.")
+    parser.add_argument("--register-mode", choices=list(batch.REGISTER_MODES), default="functions",
+                        help="Generate read/write functions for every register, or one register table with "
+                             "generic read(index)/write(index, value) accessors.")
     parser.add_argument("--overwrite", action="store_true",
                         help="Overwrite output file if it already exists.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes. Defaults to the number of cores.")
+    parser.add_argument("--cache-dir", type=Path, default=None,
+                        help="Cache generated output in this directory and skip modules whose source is unchanged.")
+    parser.add_argument("--build-files", action="store_true",
+                        help="Write micropython.mk and micropython.cmake next to the generated C files.")
+    parser.add_argument("--qstrdefs", action="store_true",
+                        help="Also write the QSTRs of each C file into a .qstrdefs.h file next to it. With "
+                             "--build-files, micropython.mk then lists them in QSTR_DEFS so the C files aren't scanned. "
+                             "Make only, CMake builds still scan them.")
+    parser.add_argument("--instrument", action="store_true",
+                        help="Time every function of python inputs into call stats read with the module's _stats(). "
+                             "Only compiled in when the build defines MODULE_<NAME>_INSTRUMENT=1.")
+    parser.add_argument("--update", action="store_true",
+                        help="Regenerate existing outputs of python inputs keeping the code written into their "
+                             "functions. Functions whose signature is unchanged come out byte identical.")
+    parser.add_argument("--harness", type=Path, default=None,
+                        help="Write a host benchmark harness for the module into this directory instead, "
+                             "built with gcc -O2 harness.c -o harness. Only valid with a single python input.")
+    parser.add_argument("--footprint", choices=["table", "json"], default=None,
+                        help="Print an estimate of the flash, RAM and QSTRs of each module instead of generating it.")
+    parser.add_argument("--word-size", type=int, default=4,
+                        help="Bytes in a pointer on the target, used by --footprint.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running after generating and regenerate inputs whenever they change. "
+                             "Implies --overwrite.")
+    parser.add_argument("--debounce", type=float, default=0.1,
+                        help="Seconds to wait for a burst of saves to finish before regenerating in watch mode.")
     args = parser.parse_args()
 
     ########################################
     # Preprocess and error-check arguments #
     ########################################
-    if not args.input.exists():
-        print(f"{args.input} does not exist.")
+    try:
+        inputs = batch.collect_inputs(args.input)
+    except FileNotFoundError as e:
+        print(e)
         return 1
 
-    if args.input.suffix != ".py":
-        print(f"{args.input} is not a \".py\" file.")
+    if not inputs:
+        print(f"No python files found in {' '.join(args.input)}.")
         return 1
 
-    args.input = args.input.expanduser().resolve()
+    try:
+        jobs = batch.plan(inputs, args.output_dir, args.static, args.register_mode, args.qstrdefs, args.instrument,
+                          args.update)
+    except ValueError as e:
+        print(e)
+        return 1
 
-    if args.output is None:
-        args.output = args.input.with_suffix(".c")
+    if args.harness is not None:
+        if len(jobs) != 1 or jobs[0].input.suffix != ".py":
+            print("--harness can only be used with a single python input.")
+            return 1
+        harness.write_harness(batch.load_module(jobs[0]), args.harness)
+        print(f"Build the harness with: cd {args.harness} && gcc -O2 harness.c -o harness && ./harness")
+        return 0
 
-    if args.output.suffix != ".c":
-        print(f"{args.output} is not a \".c\" file.")
-        return 1
+    if args.footprint is not None:
+        reports = [footprint.job_footprint(job, footprint.Target(args.word_size)) for job in jobs]
+        if args.footprint == "json":
+            print(footprint.format_json(reports))
+        else:
+            print("\n\n".join(footprint.format_table(report) for report in reports))
+        return 0
 
-    if args.output.exists() and not args.overwrite:
-        print(f"{args.output} already exists.")
+    if args.output is not None:
+        if args.watch:
+            print("--output can not be used with --watch, use --output-dir instead.")
+            return 1
+        if len(jobs) != 1:
+            print("--output can only be used with a single input.")
+            return 1
+        if str(args.output) == "-":
+            ustubby.write_lines(batch.iter_stub(jobs[0]), sys.stdout)
+            return 0
+        if args.output.suffix != ".c":
+            print(f"{args.output} is not a \".c\" file.")
+            return 1
+        jobs = [jobs[0]._replace(output=args.output)]
+
+    existing = [job.output for job in jobs if job.output.exists()]
+    if existing and not (args.overwrite or args.watch or args.update):
+        for output in existing:
+            print(f"{output} already exists.")
         return 1
 
     ###################
     # Execute ustubby #
     ###################
-    sys.path.insert(0, str(args.input.parent))
-
-    module = importlib.import_module(args.input.stem)
+    cache = Cache(args.cache_dir) if args.cache_dir is not None else None
+    # Stamp the inputs before generating so saves made during the first run are picked up
+    watcher = watch.Watcher(args.input, args.output_dir, args.static, args.register_mode, cache, args.debounce,
+                            args.qstrdefs, args.instrument, args.update) if args.watch else None
+    results = batch.run(jobs, args.jobs, cache)
+    for result in results:
+        if result.error is not None:
+            print(result.error)
 
-    c_output = ustubby.stub_module(module)
+    if args.build_files:
+        batch.write_build_files((result.job.output for result in results if result.error is None), args.qstrdefs)
 
-    args.output.parent.mkdir(exist_ok=True, parents=True)
-    args.output.write_text(c_output)
+    if watcher is not None:
+        print(f"Watching {len(watcher.stamps)} inputs, press Ctrl+C to stop.")
+        watcher.run()
+        return 0
 
-    return 0
+    return 1 if any(result.error is not None for result in results) else 0
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+Generate many modules in a single invocation.
+
+Inputs can be python files, directories, glob patterns or manifest files listing any of those.
+Each module is stubbed in its own worker process so a firmware build only pays for one interpreter start up.
+"""
+import functools
+import glob
+import importlib
+import importlib.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import ustubby
+from ustubby import importers, static
+from ustubby.cache import Cache, copy_if_changed, update_file
+from ustubby.harness import qstrs
+
+# Package plumbing rather than modules to stub when expanding directories and globs
+PACKAGE_FILES = ("__init__.py", "__main__.py")
+# Python modules and csr.csv, SVD or JSON register maps, any other file is read as a manifest
+INPUT_SUFFIXES = (".py", *importers.READERS)
+# Ways of turning a register map into C, one function per register access or one table with generic accessors
+REGISTER_MODES = {
+    "functions": ustubby.iter_stub_registers,
+    "table": ustubby.iter_stub_register_table,
+}
+
+class Job(NamedTuple):
+    input: Path
+    output: Path
+    static: bool = False
+    register_mode: str = "functions"
+    qstrdefs: bool = False
+    instrument: bool = False
+    update: bool = False
+
+
+class Result(NamedTuple):
+    job: Job
+    error: Optional[str] = None
+    cached: bool = False
+    written: bool = False
+
+
+def is_glob(spec: str) -> bool:
+    return any(char in spec for char in "*?[")
+
+
+def read_manifest(path: Path) -> List[str]:
+    """
+    Reads a manifest file of inputs, one per line.
+    Blank lines and lines starting with # are ignored. Relative entries are relative to the manifest.
+    :param path: Path of the manifest
+    :return: List of input specifications
+    """
+    specs = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if not os.path.isabs(line):
+            line = str(path.parent / line)
+        specs.append(line)
+    return specs
+
+
+def collect_inputs(specs: Iterable[str]) -> List[Path]:
+    """
+    Expands files, directories, globs and manifests into a list of unique input files.
+    Directories are searched for python files only.
+    :param specs: Input specifications as given on the command line
+    :return: Resolved python files in the order they were first found
+    """
+    found: Dict[Path, None] = {}
+    for spec in specs:
+        spec = str(spec)
+        if is_glob(spec):
+            paths = [Path(p) for p in sorted(glob.glob(os.path.expanduser(spec), recursive=True))
+                     if os.path.basename(p) not in PACKAGE_FILES]
+        else:
+            paths = [Path(spec).expanduser()]
+        for path in paths:
+            if path.is_dir():
+                for child in sorted(path.rglob("*.py")):
+                    if child.name not in PACKAGE_FILES:
+                        found[child.resolve()] = None
+            elif not path.is_file():
+                raise FileNotFoundError(f"{path} does not exist.")
+            elif path.suffix in INPUT_SUFFIXES:
+                found[path.resolve()] = None
+            else:
+                found.update((p, None) for p in collect_inputs(read_manifest(path)))
+    return list(found)
+
+
+def plan(inputs: Iterable[Path], output_dir: Optional[Path] = None, static: bool = False,
+         register_mode: str = "functions", qstrdefs: bool = False, instrument: bool = False,
+         update: bool = False) -> List[Job]:
+    """
+    :param inputs: Python files to convert
+    :param output_dir: Directory for the C files. Defaults to alongside each input.
+    :param static: Parse the inputs instead of importing them
+    :param register_mode: One of REGISTER_MODES, how register maps are turned into C
+    :param qstrdefs: Also write the QSTRs of each C file into a qstrdefs file next to it, see write_qstrdefs
+    :param instrument: Time every function of python inputs into call stats, see ustubby.instrument
+    :param update: Keep the function bodies of existing outputs of python inputs, see ustubby.iter_update_module
+    :return: One job per input
+    :raises ValueError: if two inputs would be written to the same output, such as a/mod.py and b/mod.py with an
+        output_dir
+    """
+    jobs = []
+    outputs: Dict[Path, Path] = {}
+    for path in inputs:
+        output = path.with_suffix(".c")
+        if output_dir is not None:
+            output = output_dir / output.name
+        if output in outputs:
+            raise ValueError(f"{outputs[output]} and {path} would both be written to {output}.")
+        outputs[output] = path
+        jobs.append(Job(path, output, static, register_mode, qstrdefs, instrument, update))
+    return jobs
+
+
+def import_module(path: Path, reload: bool = False):
+    """
+    Imports a python file by putting its directory on the path.
+    A module of the same name imported from another file is replaced rather than reused, so a/mod.py and b/mod.py
+    each get their own functions. If the file raises, the module it would have replaced is put back.
+    :param path: Python file to import
+    :param reload: Execute the file again even if it is the module already imported, as the watch mode does
+    :return: The imported module
+    """
+    parent = str(path.parent)
+    if parent not in sys.path:
+        sys.path.insert(0, parent)
+    previous = sys.modules.get(path.stem)
+    if not reload and previous is not None and getattr(previous, "__file__", None) and \
+            Path(previous.__file__).resolve() == path.resolve():
+        return previous
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[path.stem] = mod
+    try:
+        if reload:
+            # The bytecode cache goes by the mtime in seconds and the size, so it can miss an edit made within a second
+            exec(compile(path.read_bytes(), str(path), "exec"), mod.__dict__)
+        else:
+            spec.loader.exec_module(mod)
+    except BaseException:
+        if previous is not None:
+            sys.modules[path.stem] = previous
+        else:
+            del sys.modules[path.stem]
+        raise
+    return mod
+
+
+def is_register_map(path: Path) -> bool:
+    return path.suffix.lower() in importers.READERS
+
+
+def load_module(job: Job):
+    if job.static:
+        return static.load_module(job.input)
+    return import_module(job.input)
+
+
+def iter_stub(job: Job):
+    """
+    :return: Chunks of C source for the job's input, see ustubby.iter_stub_module
+    """
+    if is_register_map(job.input):
+        return REGISTER_MODES[job.register_mode](ustubby.RegisterMap.from_file(job.input, job.input.stem))
+    return iter_stub_loaded(job, load_module(job))
+
+
+def iter_stub_loaded(job: Job, mod):
+    """
+    :return: Chunks of C source for the job's loaded python module, keeping the bodies of the output when updating
+    """
+    if job.update and job.output.exists():
+        return ustubby.iter_update_module(mod, job.output.read_text(), job.instrument)
+    return ustubby.iter_stub_module(mod, job.instrument)
+
+
+def generate(job: Job, cache: Optional[Cache] = None, stub: Callable[[Job], Iterable[str]] = iter_stub) -> Result:
+    """
+    Stubs one module, skipping generation when the cache holds output for identical inputs.
+    The output file is only rewritten when its contents change so make does not recompile it.
+    :param job: Input and output paths
+    :param cache: Optional persistent cache
+    :param stub: Produces the chunks of C source for the job, such as a server reusing loaded modules
+    :return: Result of the job
+    """
+    key = None
+    cached = None
+    if job.update:
+        # The output depends on the previous output as well as the input
+        cache = None
+    if cache is not None:
+        key = cache.key(job.input.read_bytes(), module=job.input.stem, static=job.static,
+                        register_mode=job.register_mode, instrument=job.instrument)
+        cached = cache.get(key)
+    if cached is not None:
+        written = copy_if_changed(cached, job.output)
+    else:
+        written = update_file(job.output, stub(job))
+        if cache is not None:
+            cache.put(key, job.output)
+    if job.qstrdefs:
+        write_qstrdefs(job.output)
+    return Result(job, cached=cached is not None, written=written)
+
+
+def _generate(job: Job, cache: Optional[Cache] = None, stub: Callable[[Job], Iterable[str]] = iter_stub) -> Result:
+    try:
+        return generate(job, cache, stub)
+    except Exception as e:
+        return Result(job, f"{job.input}: {type(e).__name__}: {e}")
+
+
+def run(jobs: List[Job], workers: Optional[int] = None, cache: Optional[Cache] = None) -> List[Result]:
+    """
+    Generates every job, fanning out over a process pool when there is more than one.
+    :param jobs: Jobs to run
+    :param workers: Number of worker processes. Defaults to the number of cores.
+    :param cache: Optional persistent cache shared by the workers
+    :return: Results in the same order as the jobs
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [_generate(job, cache) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(functools.partial(_generate, cache=cache), jobs))
+
+
+def qstrdefs_path(output: Path) -> Path:
+    return output.with_suffix(".qstrdefs.h")
+
+
+def iter_qstrdefs(names: Iterable[str], source: str) -> Iterable[str]:
+    yield f"// QSTRs used by {source}, written by uStubby"
+    yield from (f"Q({name})" for name in names)
+
+
+def write_qstrdefs(output: Path) -> bool:
+    """
+    Writes the QSTRs a generated C file uses, deduplicated and sorted, into a qstrdefs file next to it.
+    Adding the file to QSTR_DEFS lets the build skip extracting QSTRs from the C file.
+    :return: True if the file was written
+    """
+    names = sorted(qstrs(output.read_text()))
+    return update_file(qstrdefs_path(output), iter_qstrdefs(names, output.name))
+
+
+def makefile_fragment(name: str, sources: List[str], qstrdefs: bool = False) -> str:
+    """
+    :param qstrdefs: The sources have qstrdefs files, so they are added to SRC_USERMOD_LIB_C which MicroPython does not
+        scan for QSTRs, and their qstrdefs files to QSTR_DEFS
+    """
+    var = f"{name.upper()}_MOD_DIR"
+    lines = [f"{var} := $(USERMOD_DIR)", ""]
+    if qstrdefs:
+        lines.append("# Add all C files to SRC_USERMOD_LIB_C, their QSTRs are listed in QSTR_DEFS instead of scanned.")
+        lines.extend(f"SRC_USERMOD_LIB_C += $({var})/{source}" for source in sources)
+        lines.extend(f"QSTR_DEFS += $({var})/{qstrdefs_path(Path(source))}" for source in sources)
+    else:
+        lines.append("# Add all C files to SRC_USERMOD.")
+        lines.extend(f"SRC_USERMOD += $({var})/{source}" for source in sources)
+    lines.extend(["", f"CFLAGS_USERMOD += -I$({var})"])
+    lines.extend(f"CFLAGS_USERMOD += -DMODULE_{Path(source).stem.upper()}_ENABLED=1" for source in sources)
+    return "\n".join(lines) + "\n"
+
+
+def cmake_fragment(name: str, sources: List[str], qstrdefs: bool = False) -> str:
+    """
+    :param qstrdefs: The sources have qstrdefs files. MicroPython's CMake builds scan every usermod source for QSTRs
+        and have no list of QSTR definition files for user modules, so these are only noted in a comment and the
+        sources are scanned as usual. Skipping the scan is Make only, see makefile_fragment.
+    """
+    target = f"usermod_{name}"
+    lines = []
+    if qstrdefs:
+        lines.append("# The QSTRs of these sources are still scanned, CMake builds have no way to take them from")
+        lines.extend(f"# {qstrdefs_path(Path(source))}" for source in sources)
+        lines.append("")
+    lines += [f"add_library({target} INTERFACE)", "", f"target_sources({target} INTERFACE"]
+    lines.extend(f"    ${{CMAKE_CURRENT_LIST_DIR}}/{source}" for source in sources)
+    lines.extend([")", "", f"target_include_directories({target} INTERFACE", "    ${CMAKE_CURRENT_LIST_DIR}", ")", ""])
+    lines.append(f"target_compile_definitions({target} INTERFACE")
+    lines.extend(f"    MODULE_{Path(source).stem.upper()}_ENABLED=1" for source in sources)
+    lines.extend([")", "", f"target_link_libraries(usermod INTERFACE {target})"])
+    return "\n".join(lines) + "\n"
+
+
+def write_build_files(outputs: Iterable[Path], qstrdefs: bool = False) -> List[Path]:
+    """
+    Writes micropython.mk and micropython.cmake into each directory holding generated C files.
+    :param outputs: Generated C files
+    :param qstrdefs: The C files have qstrdefs files, see makefile_fragment and cmake_fragment
+    :return: The build files written
+    """
+    directories: Dict[Path, List[str]] = {}
+    for output in outputs:
+        directories.setdefault(output.parent, []).append(output.name)
+    written = []
+    for directory, sources in directories.items():
+        name = "".join(c if c.isalnum() else "_" for c in directory.name) or "ustubby"
+        sources = sorted(sources)
+        for filename, fragment in (("micropython.mk", makefile_fragment), ("micropython.cmake", cmake_fragment)):
+            path = directory / filename
+            path.write_text(fragment(name, sources, qstrdefs))
+            written.append(path)
+    return written
@@ -0,0 +1,114 @@
+"""
+Persistent on-disk cache of generated C, keyed by everything that affects the output.
+"""
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+import ustubby
+
+
+class Cache:
+    """
+    Stores generated C files under a directory, one file per key.
+    The key is a hash of the input source, the ustubby version and the generation options.
+    Only the input file itself is hashed, so changes to modules it imports are not detected.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def key(self, source: bytes, **options) -> str:
+        """
+        :param source: Contents of the input file
+        :param options: Anything else the generated output depends on
+        :return: Hex digest identifying the generated output
+        """
+        digest = hashlib.sha256()
+        digest.update(ustubby.__version__.encode())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.c"
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        :param key: Key from Cache.key
+        :return: Path of the cached C source or None on a miss
+        """
+        path = self.path(key)
+        return path if path.exists() else None
+
+    def put(self, key: str, source: Path) -> None:
+        """
+        :param key: Key from Cache.key
+        :param source: Generated C file to store
+        """
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        # Copy then rename so concurrent workers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+
+
+def _temp_file(path: Path) -> str:
+    """
+    Creates a temporary file next to path with the permissions path would get if written directly
+    """
+    path.parent.mkdir(exist_ok=True, parents=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    return tmp
+
+
+def _replace_if_changed(tmp: str, path: Path) -> bool:
+    try:
+        if path.exists() and filecmp.cmp(tmp, path, shallow=False):
+            return False
+        os.replace(tmp, path)
+        return True
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def update_file(path: Path, lines: Iterable[str]) -> bool:
+    """
+    Streams lines into a temporary file next to path and only replaces path if the contents differ,
+    preserving its modification time when nothing changed.
+    :param path: File to write
+    :param lines: Chunks joined with newlines, such as ustubby.iter_stub_module(mod)
+    :return: True if the file was written
+    """
+    tmp = _temp_file(path)
+    try:
+        with open(tmp, "w") as f:
+            ustubby.write_lines(lines, f)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return _replace_if_changed(tmp, path)
+
+
+def copy_if_changed(source: Path, path: Path) -> bool:
+    """
+    Copies source to path unless path already has the same contents
+    :return: True if the file was written
+    """
+    if path.exists() and filecmp.cmp(source, path, shallow=False):
+        return False
+    tmp = _temp_file(path)
+    shutil.copyfile(source, tmp)
+    return _replace_if_changed(tmp, path)
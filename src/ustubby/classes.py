@@ -0,0 +1,204 @@
+"""
+Native classes generated as an mp_obj_type_t rather than a dict backed instance.
+
+Annotated class attributes become fields of a fixed size C struct, read and written through the type's attr handler.
+The constructor comes from __init__, or from the fields when there is no __init__, and the methods are put in the
+type's locals dict.
+"""
+import inspect
+from typing import Dict, List
+
+import ustubby
+from ustubby import ir
+
+# C types of fields with the functions converting from and to mp_obj_t, anything else is stored as an mp_obj_t
+field_types = {
+    int: ("mp_int_t", "mp_obj_get_int", "mp_obj_new_int"),
+    ustubby.SmallInt: ("mp_int_t", "mp_obj_get_int", "mp_obj_new_int"),
+    float: ("mp_float_t", "mp_obj_get_float", "mp_obj_new_float"),
+    bool: ("bool", "mp_obj_is_true", "mp_obj_new_bool"),
+}
+
+OBJECT_FIELD = ("mp_obj_t", "", "")
+
+
+def type_name(cls: ir.Class) -> str:
+    return f"{cls.c_name}_type"
+
+
+def fields(cls) -> Dict[str, object]:
+    """
+    :return: Annotations of the attributes defined by the class itself, in definition order
+    """
+    return dict(vars(cls).get("__annotations__", {}))
+
+
+def field_type(annotation):
+    return field_types.get(annotation, OBJECT_FIELD)
+
+
+def methods(cls) -> List:
+    """
+    :return: Functions defined by the class itself, leaving out __init__ and the other special methods
+    """
+    return [f for name, f in inspect.getmembers(cls, inspect.isfunction)
+            if name in vars(cls) and not (name.startswith("__") and name.endswith("__"))]
+
+
+def field_default(cls, name, annotation):
+    """
+    :return: C expression for the class attribute default of a field, or None if it has none
+    """
+    if name not in vars(cls):
+        return None
+    storage = annotation if annotation in field_types else object
+    return ustubby.c_default(storage, vars(cls)[name])
+
+
+def init_parameters(cls) -> Dict[str, inspect.Parameter]:
+    """
+    Parameters of the constructor, from __init__ without self or otherwise one per field like a dataclass
+    """
+    init = vars(cls).get("__init__")
+    if init is not None:
+        params = dict(list(inspect.signature(init).parameters.items())[1:])
+        if any(param.kind != param.POSITIONAL_OR_KEYWORD for param in params.values()):
+            raise ValueError(f"{cls.__name__}.__init__ can only take positional parameters")
+        return params
+    params = {}
+    for name, annotation in fields(cls).items():
+        storage = annotation if annotation in field_types else object
+        default = field_default(cls, name, annotation)
+        params[name] = inspect.Parameter(name, inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=storage,
+                                         default=vars(cls)[name] if default is not None else inspect.Parameter.empty)
+    # Only trailing defaults can be left out
+    required = [index for index, param in enumerate(params.values()) if param.default is param.empty]
+    for name in list(params)[:required[-1] if required else 0]:
+        params[name] = params[name].replace(default=inspect.Parameter.empty)
+    return params
+
+
+def iter_struct(cls: ir.Class):
+    struct = f"{cls.c_name}_obj_t"
+    yield ""
+    if cls.doc:
+        yield ir.comment_block(cls.doc)
+    yield f"typedef struct _{struct} {{"
+    yield "    mp_obj_base_t base;"
+    for field in cls.fields:
+        yield f"    {field_type(field.annotation)[0]} {field.name};"
+    yield f"}} {struct};"
+    yield ""
+    yield f"extern const mp_obj_type_t {type_name(cls)};"
+
+
+def iter_make_new(cls: ir.Class):
+    """
+    Generates make_new, converting the arguments as for a VAR_BETWEEN function then storing those named after a field
+    """
+    struct = f"{cls.c_name}_obj_t"
+    params = cls.make_new.signature()
+    lines = [""]
+    if cls.make_new.doc:
+        lines.append(ir.comment_block(cls.make_new.doc))
+    lines.append(f"STATIC mp_obj_t {cls.c_name}_make_new(const mp_obj_type_t *type, size_t n_args, size_t n_kw, "
+                 f"const mp_obj_t *args) {{")
+    lines.append(f"\tmp_arg_check_num(n_args, n_kw, {ustubby.required_count(params)}, {len(params)}, false);")
+    for index, (name, param) in enumerate(params.items()):
+        if param.default is param.empty:
+            lines.append(ustubby.handler(ustubby.type_handler_arr, param.annotation, "args[{1}]")(name, index))
+        elif param.annotation in ustubby.default_types and ustubby.c_default(param.annotation, param.default):
+            lines.append(ustubby.default_template(param.annotation, param.default)(name, index))
+        else:
+            raise ValueError(f"Default of {cls.name}.__init__ parameter {name} has no C equivalent")
+    lines.append(f"\t{struct} *self = m_new_obj({struct});")
+    lines.append("\tself->base.type = type;")
+    for field in cls.fields:
+        name, c_type = field.name, field_type(field.annotation)[0]
+        if name in params and c_type == field_type(params[name].annotation)[0] and (
+                params[name].annotation in field_types or params[name].annotation is object):
+            lines.append(f"\tself->{name} = {name};")
+        elif name in params and c_type == "mp_obj_t" and params[name].default is params[name].empty:
+            lines.append(f"\tself->{name} = args[{list(params).index(name)}];")
+        elif field.default is not None:
+            lines.append(f"\tself->{name} = {field.default};")
+        elif c_type == "mp_obj_t":
+            lines.append(f"\tself->{name} = mp_const_none;")
+    lines += ["", cls.make_new.code if cls.make_new.code is not None else ir.PLACEHOLDER, ""]
+    lines += ["\treturn MP_OBJ_FROM_PTR(self);", "}"]
+    yield from ustubby.expand_newlines(lines)
+
+
+def iter_attr(cls: ir.Class):
+    """
+    Generates the attr handler loading and storing fields. Other attributes fall through to the locals dict.
+    """
+    yield ""
+    yield f"STATIC void {cls.c_name}_attr(mp_obj_t self_in, qstr attr, mp_obj_t *dest) {{"
+    yield f"    {cls.c_name}_obj_t *self = MP_OBJ_TO_PTR(self_in);"
+    yield "    if (dest[0] == MP_OBJ_NULL) {"
+    yield "        // Load attribute"
+    yield "        switch (attr) {"
+    for field in cls.fields:
+        to_obj = field_type(field.annotation)[2]
+        yield f"            case MP_QSTR_{field.name}:"
+        yield f"                dest[0] = {to_obj}(self->{field.name});" if to_obj else \
+            f"                dest[0] = self->{field.name};"
+        yield "                return;"
+    yield "        }"
+    yield "        // Not a field, continue the lookup in the locals dict"
+    yield "        dest[1] = MP_OBJ_SENTINEL;"
+    yield "    } else if (dest[1] != MP_OBJ_NULL) {"
+    yield "        // Store attribute"
+    yield "        switch (attr) {"
+    for field in cls.fields:
+        from_obj = field_type(field.annotation)[1]
+        yield f"            case MP_QSTR_{field.name}:"
+        yield f"                self->{field.name} = {from_obj}(dest[1]);" if from_obj else \
+            f"                self->{field.name} = dest[1];"
+        yield "                dest[0] = MP_OBJ_NULL;"
+        yield "                return;"
+    yield "        }"
+    yield "    }"
+    yield "}"
+
+
+def render_class(cls: ir.Class):
+    """
+    Generates the c source of a native class in chunks: the instance struct, make_new, the attr handler, the methods,
+    the locals dict and the type itself.
+    """
+    prefix = cls.c_name
+    yield from iter_struct(cls)
+    yield from iter_make_new(cls)
+    if cls.fields:
+        yield from iter_attr(cls)
+    for method in cls.methods:
+        yield from ir.render_function(method)
+    yield ""
+    yield f"STATIC const mp_rom_map_elem_t {prefix}_locals_dict_table[] = {{"
+    for method in cls.methods:
+        yield f"\t{{ MP_ROM_QSTR(MP_QSTR_{method.name}), MP_ROM_PTR(&{method.c_name}_obj) }},"
+    yield "};"
+    yield f"STATIC MP_DEFINE_CONST_DICT({prefix}_locals_dict, {prefix}_locals_dict_table);"
+    yield ""
+    yield f"const mp_obj_type_t {type_name(cls)} = {{"
+    yield "\t{ &mp_type_type },"
+    yield f"\t.name = MP_QSTR_{cls.name},"
+    yield f"\t.make_new = {prefix}_make_new,"
+    if cls.fields:
+        yield f"\t.attr = {prefix}_attr,"
+    yield f"\t.locals_dict = (mp_obj_dict_t*)&{prefix}_locals_dict,"
+    yield "};"
+
+
+def iter_stub_class(cls, instrument=False):
+    """
+    Generates the c source of a native class in chunks, see render_class
+    :param instrument: Time the methods into the call stats of the module
+    """
+    yield from render_class(ir.build_class(cls, instrument))
+
+
+def stub_class(cls) -> str:
+    return "\n".join(iter_stub_class(cls))
@@ -0,0 +1,132 @@
+"""
+Client for the generation server, falling back to generating in process when no server is running.
+Once a server has accepted a request it alone handles it, so a slow or failed server is reported as an error rather
+than generating the same output again from this process.
+
+Only the standard library is imported until the fallback is needed, so running this file directly starts quickly:
+
+    python path/to/ustubby/client.py example.py -o build/example.c
+
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+from typing import Optional
+
+TIMEOUT = 60.0
+
+
+class ServerError(RuntimeError):
+    """
+    The server accepted the connection but didn't answer
+    """
+
+
+def default_socket() -> str:
+    """
+    :return: $USTUBBY_SOCKET, or a socket in the temporary directory named after the user
+    """
+    if "USTUBBY_SOCKET" in os.environ:
+        return os.environ["USTUBBY_SOCKET"]
+    user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "")
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), f"ustubby-{user}.sock")
+
+
+def job(request: dict):
+    """
+    :return: The batch.Job described by a request
+    """
+    from pathlib import Path
+    from ustubby import batch
+    return batch.Job(Path(request["input"]), Path(request["output"]), bool(request.get("static")),
+                     request.get("register_mode", "functions"), bool(request.get("qstrdefs")),
+                     bool(request.get("instrument")), bool(request.get("update")))
+
+
+def request(path: str, message: dict, timeout: float = TIMEOUT) -> dict:
+    """
+    Sends one request to the server
+    :param message: input and output paths, and optionally static, register_mode, qstrdefs, instrument, update and
+        cache_dir
+    :return: The response with error, cached and written
+    :raises OSError: if no server is listening on path
+    :raises AttributeError: if the platform has no Unix domain sockets
+    :raises ServerError: if the server was connected to but didn't answer within timeout
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        try:
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            # ValueError: the server closed without answering
+            raise ServerError(f"No answer from the server on {path}: {e or type(e).__name__}") from e
+
+
+def generate(message: dict, path: Optional[str] = None) -> dict:
+    """
+    Generates through the server at path, or in this process if it can't be connected to
+    :return: The response, with server set to whether the request went to the server
+    """
+    path = path or default_socket()
+    message = dict(message, input=os.path.abspath(message["input"]), output=os.path.abspath(message["output"]))
+    try:
+        return dict(request(path, message), server=True)
+    except ServerError as e:
+        return {"error": str(e), "cached": False, "written": False, "server": True}
+    except (OSError, AttributeError):
+        # AttributeError: no AF_UNIX on this platform
+        pass
+    from ustubby import batch
+    from ustubby.cache import Cache
+    cache = Cache(message["cache_dir"]) if message.get("cache_dir") else None
+    result = batch._generate(job(message), cache)
+    return {"error": result.error, "cached": result.cached, "written": result.written, "server": False}
+
+
+def stop(path: Optional[str] = None) -> bool:
+    """
+    :return: True if a server was running and has been asked to stop
+    """
+    try:
+        request(path or default_socket(), {"stop": True})
+    except (OSError, AttributeError, ServerError):
+        return False
+    return True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Generates a C stub through the ustubby server if one is running.")
+    parser.add_argument("input", nargs="?", help="Python file or LiteX csr.csv, SVD or JSON register map to convert.")
+    parser.add_argument("-o", "--output", default=None, help="Output C file. Defaults to \"${input}.c\".")
+    parser.add_argument("--static", action="store_true", help="Parse the input instead of importing it.")
+    parser.add_argument("--register-mode", choices=["functions", "table"], default="functions",
+                        help="How register maps are turned into C, see ustubby --register-mode.")
+    parser.add_argument("--qstrdefs", action="store_true", help="Also write a .qstrdefs.h file of the QSTRs used.")
+    parser.add_argument("--instrument", action="store_true", help="Time every function into call stats.")
+    parser.add_argument("--update", action="store_true", help="Keep the function bodies of an existing output.")
+    parser.add_argument("--cache-dir", default=None, help="Cache generated output in this directory.")
+    parser.add_argument("--socket", default=None, help="Socket of the server. Defaults to $USTUBBY_SOCKET.")
+    parser.add_argument("--stop", action="store_true", help="Stop the server instead.")
+    args = parser.parse_args(argv)
+    if args.stop:
+        return 0 if stop(args.socket) else 1
+    if args.input is None:
+        parser.error("the input is required")
+    output = args.output or os.path.splitext(args.input)[0] + ".c"
+    response = generate({"input": args.input, "output": output, "static": args.static,
+                         "register_mode": args.register_mode, "qstrdefs": args.qstrdefs,
+                         "instrument": args.instrument, "update": args.update, "cache_dir": args.cache_dir},
+                        args.socket)
+    if response["error"] is not None:
+        print(response["error"])
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Estimates of the flash, RAM and QSTRs a generated module costs once it is built into the firmware.
+
+The estimates count the objects the generated C defines: function objects, globals and locals table entries,
+mp_arg_t tables, type objects and the QSTRs of every name, sized for the target's word size. Machine code is
+estimated from the number of generated C statements, so the code written in place of //Your code here is not
+counted. A QSTR used by several functions is charged to the first of them only, and names already interned by
+MicroPython itself such as __name__ are free.
+"""
+import itertools
+import json
+import types
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from ustubby import batch, classes, ir, registers, vectorise
+
+# Interned by MicroPython itself, so using them costs no extra flash
+CORE_QSTRS = {"__name__", "__init__", "self"}
+# Words in an mp_obj_type_t with the members of the old style initializer generated by ustubby.classes
+TYPE_WORDS = 15
+
+
+class Target(NamedTuple):
+    """
+    :param word_size: Bytes in a pointer or mp_int_t, 4 for most microcontrollers
+    :param qstr_hash_bytes: MICROPY_QSTR_BYTES_IN_HASH of the port
+    :param qstr_len_bytes: MICROPY_QSTR_BYTES_IN_LEN of the port
+    :param statement_bytes: Machine code per generated C statement, defaults to two words
+    """
+    word_size: int = 4
+    qstr_hash_bytes: int = 1
+    qstr_len_bytes: int = 1
+    statement_bytes: Optional[int] = None
+
+    def code(self, statements: int) -> int:
+        return statements * (self.statement_bytes if self.statement_bytes is not None else 2 * self.word_size)
+
+    def qstr(self, name: str) -> int:
+        """
+        :return: Bytes of the string, its terminator, hash, length and the pointer to it in the pool
+        """
+        return len(name.encode()) + 1 + self.qstr_hash_bytes + self.qstr_len_bytes + self.word_size
+
+
+class Footprint(NamedTuple):
+    """
+    :param kind: Calling convention of a function, "class" or "module"
+    :param rom: Estimated flash bytes, the sum of the flash entries of detail
+    :param ram: Static RAM bytes
+    :param detail: Bytes per item, such as fun_obj or qstrs
+    """
+    name: str
+    kind: str
+    rom: int
+    ram: int
+    qstrs: int
+    detail: Dict[str, int]
+
+
+class Report(NamedTuple):
+    module: str
+    target: Target
+    total: Footprint
+    entries: List[Footprint]
+
+
+def statements(lines: Iterable[str]) -> int:
+    """
+    :return: Number of C statements in the generated lines, leaving out tables and declarations without code
+    """
+    count = 0
+    for chunk in lines:
+        for line in chunk.splitlines():
+            line = line.strip()
+            if not line.endswith(";") or line.startswith(("{", "STATIC const", "MP_DEFINE", "extern", "typedef")):
+                continue
+            if line.startswith(("mp_", "bool ", "const char*")) and "=" not in line:
+                continue
+            count += 1
+    return count
+
+
+def footprint(name: str, kind: str, target: Target, seen: Set[str], qstr_names: Iterable[str],
+              ram: Dict[str, int] = None, **rom: int) -> Footprint:
+    """
+    Adds up the flash entries with the QSTRs not already in seen, adding them to seen
+    """
+    new = [q for q in dict.fromkeys(qstr_names) if q not in seen and q not in CORE_QSTRS]
+    seen.update(new)
+    detail = dict(rom, qstrs=sum(target.qstr(q) for q in new))
+    ram = ram or {}
+    detail.update(ram)
+    return Footprint(name, kind, sum(v for k, v in detail.items() if k not in ram), sum(ram.values()), len(new),
+                     detail)
+
+
+def function_footprint(fn: ir.Function, target: Target, seen: Set[str], label: Optional[str] = None) -> Footprint:
+    """
+    :param seen: QSTRs charged to earlier entries, updated with the ones this function adds
+    :param label: Name to report the function under, defaults to its python name
+    """
+    word = target.word_size
+    qstrs = [fn.name]
+    rom = {}
+    if fn.convention == "positional":
+        # mp_obj_fun_builtin_fixed_t: base and function pointer
+        rom["fun_obj"] = 2 * word
+    else:
+        # mp_obj_fun_builtin_var_t: base, signature and function pointer
+        rom["fun_obj"] = 2 * word + max(4, word)
+    if fn.convention == "keyword":
+        params = fn.parameters[1:] if fn.method else fn.parameters
+        qstrs += [param.name for param in params]
+        # mp_arg_t: qstr and flags as two uint16_t then an mp_arg_val_t
+        rom["arg_table"] = len(params) * (4 + word if word <= 4 else 2 * word)
+    rom["table_entry"] = 2 * word
+    rom["code"] = target.code(statements(ir.render_function(fn)))
+    if fn.many:
+        # The batched companion is a VAR_BETWEEN function with its own globals entry, its code is counted above
+        qstrs.append(vectorise.many_name(fn))
+        rom["many"] = 4 * word + max(4, word)
+    return footprint(label or fn.name, fn.convention, target, seen, qstrs, **rom)
+
+
+def class_footprint(cls: ir.Class, target: Target, seen: Set[str]) -> List[Footprint]:
+    """
+    :return: The footprint of the type followed by one per method
+    """
+    word = target.word_size
+    code = list(classes.iter_make_new(cls))
+    if cls.fields:
+        code += classes.iter_attr(cls)
+    entries = [footprint(cls.name, "class", target, seen, [cls.name, *(field.name for field in cls.fields)],
+                         type_obj=TYPE_WORDS * word, locals_dict=3 * word, table_entry=2 * word,
+                         code=target.code(statements(code)))]
+    for method in cls.methods:
+        entries.append(function_footprint(method, target, seen, f"{cls.name}.{method.name}"))
+    return entries
+
+
+def module_footprint(mod, target: Target = Target()) -> Report:
+    """
+    :param mod: Module as passed to stub_module
+    :return: Footprint of every function and class, and of the whole module including its own objects
+    """
+    module = ir.build_module(mod)
+    word = target.word_size
+    seen: Set[str] = set()
+    entries = []
+    for cls in module.classes:
+        entries += class_footprint(cls, target, seen)
+    for fn in module.functions:
+        entries.append(function_footprint(fn, target, seen))
+    # mp_obj_module_t, the globals dict and its __name__ entry
+    own = footprint(module.name, "module", target, seen, [module.name],
+                    module_obj=2 * word, globals_dict=3 * word, table_entry=2 * word)
+    return Report(module.name, target, total(own, entries, seen), entries)
+
+
+def register_table_footprint(regmap: registers.RegisterMap, target: Target = Target()) -> Report:
+    """
+    Footprint of the register table form of a register map, see registers.iter_stub_register_table
+    """
+    word = target.word_size
+    seen: Set[str] = set()
+    accessors = registers.TABLE_HEADER.format(module=regmap.name, data_width=regmap.data_width) + \
+        registers.TABLE_ACCESSORS.format(module=regmap.name, example="REGISTER")
+    # The lookup helper is shared by read and write, so it is charged to read
+    entries = [footprint("read", "positional", target, seen, ["read"], fun_obj=2 * word, table_entry=2 * word,
+                         code=target.code(statements(accessors.split("STATIC mp_obj_t")[:2]))),
+               footprint("write", "positional", target, seen, ["write"], fun_obj=2 * word, table_entry=2 * word,
+                         code=target.code(statements(accessors.split("STATIC mp_obj_t")[2:])))]
+    for register in regmap:
+        # A row of the register table and an MP_ROM_INT index constant in the globals table
+        entries.append(footprint(register.name.upper(), "register", target, seen, [register.name.upper()],
+                                 table_row=8, table_entry=2 * word))
+    # The field accessors and burst functions are generated as in the functions mode
+    funcs = types.ModuleType(regmap.name)
+    for func in itertools.chain(regmap.field_funcs(), regmap.burst_funcs()):
+        setattr(funcs, func.__name__, func)
+    for fn in ir.build_module(funcs).functions:
+        entries.append(function_footprint(fn, target, seen))
+    own = footprint(regmap.name, "module", target, seen, [regmap.name],
+                    module_obj=2 * word, globals_dict=3 * word, table_entry=2 * word)
+    return Report(regmap.name, target, total(own, entries, seen), entries)
+
+
+def job_footprint(job: batch.Job, target: Target = Target()) -> Report:
+    """
+    :return: Footprint of the module a batch job would generate
+    """
+    if batch.is_register_map(job.input):
+        regmap = registers.RegisterMap.from_file(job.input, job.input.stem)
+        if job.register_mode == "table":
+            return register_table_footprint(regmap, target)
+        return module_footprint(regmap.to_module(), target)
+    return module_footprint(batch.load_module(job), target)
+
+
+def total(own: Footprint, entries: List[Footprint], seen: Set[str]) -> Footprint:
+    detail: Dict[str, int] = {}
+    for entry in [own, *entries]:
+        for key, value in entry.detail.items():
+            detail[key] = detail.get(key, 0) + value
+    return Footprint(own.name, "module", own.rom + sum(e.rom for e in entries), sum(e.ram for e in entries),
+                     len(seen), detail)
+
+
+def format_table(report: Report) -> str:
+    """
+    :return: One line per function and class, largest flash first, then the module total
+    """
+    lines = [f"{'name':<40}{'kind':>12}{'rom':>10}{'ram':>8}{'qstrs':>8}"]
+    for entry in sorted(report.entries, key=lambda e: (-e.rom, e.name)):
+        lines.append(f"{entry.name:<40}{entry.kind:>12}{entry.rom:>10}{entry.ram:>8}{entry.qstrs:>8}")
+    total = report.total
+    lines.append(f"{total.name + ' total':<40}{total.kind:>12}{total.rom:>10}{total.ram:>8}{total.qstrs:>8}")
+    return "\n".join(lines)
+
+
+def as_dict(report: Report) -> dict:
+    """
+    :return: JSON serialisable summary of the report
+    """
+    return {
+        "module": report.module,
+        "target": report.target._asdict(),
+        "total": report.total._asdict(),
+        "entries": [entry._asdict() for entry in sorted(report.entries, key=lambda e: (-e.rom, e.name))],
+    }
+
+
+def format_json(reports: Iterable[Report]) -> str:
+    return json.dumps([as_dict(report) for report in reports], indent=2)
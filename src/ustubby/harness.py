@@ -0,0 +1,885 @@
+"""
+Host harness timing the generated argument unpacking and return boxing without a MicroPython build.
+
+write_harness(mod, directory) writes
+    py/*.h      a shim of the MicroPython object API, just enough for generated modules to compile and run with gcc
+    qstrdefs.h  the qstrs the module uses
+    <mod>.c     the module, with the "Your code here" placeholders zeroing ret_val instead
+    harness.c   a driver calling every function in a tight loop and printing the nanoseconds per call
+
+    gcc -O2 harness.c -o harness && ./harness [iterations]
+
+The shim keeps the MICROPY_OBJ_REPR_A object layout and calls functions through their function objects like
+mp_call_function_n_kw, so the calling conventions compare the way they would on a port. Absolute numbers are for the
+host, only the differences between generation strategies carry over to firmware.
+"""
+import array
+import inspect
+import re
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import ustubby
+from ustubby import ir
+from ustubby.cache import update_file
+
+DEFAULT_ITERATIONS = 1000000
+
+SHIM_HEADER = r"""// Host shim of the MicroPython object API written by ustubby.harness, not MicroPython itself.
+// Objects use the MICROPY_OBJ_REPR_A layout and are allocated from an arena which is recycled between calls.
+#ifndef USTUBBY_SHIM_OBJ_H
+#define USTUBBY_SHIM_OBJ_H
+
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define STATIC static
+#define NORETURN __attribute__((noreturn))
+#define MP_ERROR_TEXT(s) s
+#define MP_ARRAY_SIZE(a) (sizeof(a) / sizeof((a)[0]))
+#define MP_REGISTER_MODULE(module_name, obj_module, enabled_define)
+
+#define MICROPY_OBJ_REPR_A (0)
+#define MICROPY_OBJ_REPR_B (1)
+#define MICROPY_OBJ_REPR_C (2)
+#define MICROPY_OBJ_REPR_D (3)
+#define MICROPY_OBJ_REPR (MICROPY_OBJ_REPR_A)
+
+typedef intptr_t mp_int_t;
+typedef uintptr_t mp_uint_t;
+typedef double mp_float_t;
+typedef size_t qstr;
+typedef void *mp_obj_t;
+typedef const void *mp_const_obj_t;
+typedef const void *mp_rom_obj_t;
+
+typedef struct _mp_obj_type_t mp_obj_type_t;
+typedef struct _mp_obj_base_t {
+    const mp_obj_type_t *type;
+} mp_obj_base_t;
+
+#define MP_OBJ_NULL ((mp_obj_t)0)
+#define MP_OBJ_SENTINEL ((mp_obj_t)4)
+#define MP_OBJ_TO_PTR(o) ((void *)(o))
+#define MP_OBJ_FROM_PTR(p) ((mp_obj_t)(p))
+
+#define mp_obj_is_small_int(o) ((((mp_int_t)(o)) & 1) != 0)
+#define MP_OBJ_SMALL_INT_VALUE(o) (((mp_int_t)(o)) >> 1)
+#define MP_OBJ_NEW_SMALL_INT(small_int) ((mp_obj_t)((((mp_uint_t)(small_int)) << 1) | 1))
+#define MP_SMALL_INT_FITS(n) \
+    (((((mp_uint_t)(n)) ^ (((mp_uint_t)(n)) << 1)) & ((mp_uint_t)1 << (sizeof(mp_uint_t) * 8 - 1))) == 0)
+#define mp_obj_is_qstr(o) ((((mp_int_t)(o)) & 7) == 2)
+#define MP_OBJ_QSTR_VALUE(o) (((mp_uint_t)(o)) >> 3)
+#define MP_OBJ_NEW_QSTR(qst) ((mp_obj_t)((((mp_uint_t)(qst)) << 3) | 2))
+#define MP_OBJ_NEW_IMMEDIATE_OBJ(val) ((mp_obj_t)(((val) << 3) | 6))
+#define mp_obj_is_obj(o) ((((mp_int_t)(o)) & 3) == 0)
+
+#define mp_const_none MP_OBJ_NEW_IMMEDIATE_OBJ(0)
+#define mp_const_false MP_OBJ_NEW_IMMEDIATE_OBJ(1)
+#define mp_const_true MP_OBJ_NEW_IMMEDIATE_OBJ(3)
+#define mp_obj_new_bool(x) ((x) ? mp_const_true : mp_const_false)
+
+#define MP_ROM_QSTR(q) MP_OBJ_NEW_QSTR(q)
+#define MP_ROM_PTR(p) ((mp_rom_obj_t)(p))
+#define MP_ROM_INT(i) MP_OBJ_NEW_SMALL_INT(i)
+#define MP_ROM_NONE mp_const_none
+
+typedef struct _mp_map_elem_t {
+    mp_obj_t key;
+    mp_obj_t value;
+} mp_map_elem_t;
+
+typedef struct _mp_rom_map_elem_t {
+    mp_rom_obj_t key;
+    mp_rom_obj_t value;
+} mp_rom_map_elem_t;
+
+typedef struct _mp_map_t {
+    size_t used;
+    size_t alloc;
+    mp_map_elem_t *table;
+} mp_map_t;
+
+typedef struct _mp_obj_dict_t {
+    mp_obj_base_t base;
+    mp_map_t map;
+} mp_obj_dict_t;
+
+typedef mp_obj_t (*mp_make_new_fun_t)(const mp_obj_type_t *type, size_t n_args, size_t n_kw, const mp_obj_t *args);
+typedef void (*mp_attr_fun_t)(mp_obj_t self_in, qstr attr, mp_obj_t *dest);
+
+struct _mp_obj_type_t {
+    mp_obj_base_t base;
+    qstr name;
+    mp_make_new_fun_t make_new;
+    mp_attr_fun_t attr;
+    struct _mp_obj_dict_t *locals_dict;
+};
+
+typedef struct _mp_obj_module_t {
+    mp_obj_base_t base;
+    mp_obj_dict_t *globals;
+} mp_obj_module_t;
+
+#define SHIM_TYPE(type_name) \
+    __attribute__((unused)) static const mp_obj_type_t type_name = { { &mp_type_type }, .name = 0 }
+
+__attribute__((unused)) static const mp_obj_type_t mp_type_type = { { &mp_type_type }, .name = 0 };
+SHIM_TYPE(mp_type_module);
+SHIM_TYPE(mp_type_dict);
+SHIM_TYPE(mp_type_int);
+SHIM_TYPE(mp_type_float);
+SHIM_TYPE(mp_type_str);
+SHIM_TYPE(mp_type_bytes);
+SHIM_TYPE(mp_type_bytearray);
+SHIM_TYPE(mp_type_memoryview);
+SHIM_TYPE(mp_type_array);
+SHIM_TYPE(mp_type_tuple);
+SHIM_TYPE(mp_type_list);
+SHIM_TYPE(mp_type_fun_builtin_0);
+SHIM_TYPE(mp_type_fun_builtin_1);
+SHIM_TYPE(mp_type_fun_builtin_2);
+SHIM_TYPE(mp_type_fun_builtin_3);
+SHIM_TYPE(mp_type_fun_builtin_var);
+
+#define MP_DEFINE_CONST_DICT(dict_name, table_name) \
+    const mp_obj_dict_t dict_name = { \
+        { &mp_type_dict }, \
+        { MP_ARRAY_SIZE(table_name), MP_ARRAY_SIZE(table_name), (mp_map_elem_t *)(mp_rom_map_elem_t *)table_name } \
+    }
+
+// Errors end the run, the harness only calls functions with valid arguments
+
+NORETURN static inline void shim_raise(const char *type, const char *msg) {
+    fprintf(stderr, "%s: %s\n", type, msg);
+    exit(1);
+}
+
+NORETURN static inline void mp_raise_ValueError(const char *msg) {
+    shim_raise("ValueError", msg);
+}
+
+NORETURN static inline void mp_raise_TypeError(const char *msg) {
+    shim_raise("TypeError", msg);
+}
+
+// Arena allocator. Once full it starts again from the mark set after the arguments were made, as the results of
+// earlier calls are no longer referenced.
+
+#ifndef SHIM_HEAP_SIZE
+#define SHIM_HEAP_SIZE (16 * 1024 * 1024)
+#endif
+
+static uint8_t shim_heap[SHIM_HEAP_SIZE] __attribute__((aligned(16)));
+static size_t shim_heap_used;
+static size_t shim_heap_mark;
+
+static inline void shim_arena_mark(void) {
+    shim_heap_mark = shim_heap_used;
+}
+
+static inline void *m_malloc(size_t num_bytes) {
+    num_bytes = (num_bytes + 15) & ~(size_t)15;
+    if (shim_heap_used + num_bytes > SHIM_HEAP_SIZE) {
+        shim_heap_used = shim_heap_mark;
+        if (shim_heap_used + num_bytes > SHIM_HEAP_SIZE) {
+            shim_raise("MemoryError", "shim heap exhausted");
+        }
+    }
+    void *ptr = shim_heap + shim_heap_used;
+    shim_heap_used += num_bytes;
+    return ptr;
+}
+
+#define m_new(type, num) ((type *)(m_malloc(sizeof(type) * (num))))
+#define m_new_obj(type) (m_new(type, 1))
+#define m_new_obj_var(obj_type, var_type, var_num) ((obj_type *)m_malloc(sizeof(obj_type) + sizeof(var_type) * (var_num)))
+
+// qstrs, the static ones come from qstrdefs.h which defines shim_qstr_strings before this header
+
+static const char *shim_qstr_dynamic[256];
+static size_t shim_qstr_dynamic_len;
+
+static inline const char *qstr_str(qstr q) {
+    if (q < MP_ARRAY_SIZE(shim_qstr_strings)) {
+        return shim_qstr_strings[q];
+    }
+    return shim_qstr_dynamic[q - MP_ARRAY_SIZE(shim_qstr_strings)];
+}
+
+static inline qstr qstr_from_strn(const char *str, size_t len) {
+    for (size_t q = 0; q < MP_ARRAY_SIZE(shim_qstr_strings) + shim_qstr_dynamic_len; q++) {
+        if (strlen(qstr_str(q)) == len && memcmp(qstr_str(q), str, len) == 0) {
+            return q;
+        }
+    }
+    if (shim_qstr_dynamic_len >= MP_ARRAY_SIZE(shim_qstr_dynamic)) {
+        shim_raise("MemoryError", "too many qstrs");
+    }
+    char *copy = malloc(len + 1);
+    memcpy(copy, str, len);
+    copy[len] = '\0';
+    shim_qstr_dynamic[shim_qstr_dynamic_len] = copy;
+    return MP_ARRAY_SIZE(shim_qstr_strings) + shim_qstr_dynamic_len++;
+}
+
+// Object layouts
+
+typedef struct _shim_int_t {
+    mp_obj_base_t base;
+    long long value;
+} shim_int_t;
+
+typedef struct _mp_obj_float_t {
+    mp_obj_base_t base;
+    mp_float_t value;
+} mp_obj_float_t;
+
+typedef struct _mp_obj_str_t {
+    mp_obj_base_t base;
+    size_t hash;
+    size_t len;
+    const uint8_t *data;
+} mp_obj_str_t;
+
+// bytearray, memoryview and array share this layout as in MicroPython
+typedef struct _shim_array_t {
+    mp_obj_base_t base;
+    char typecode;
+    size_t len;
+    void *items;
+} shim_array_t;
+
+typedef struct _mp_obj_tuple_t {
+    mp_obj_base_t base;
+    size_t len;
+    mp_obj_t items[];
+} mp_obj_tuple_t;
+
+typedef struct _mp_obj_list_t {
+    mp_obj_base_t base;
+    size_t alloc;
+    size_t len;
+    mp_obj_t *items;
+} mp_obj_list_t;
+
+static inline const mp_obj_type_t *shim_type(mp_const_obj_t o) {
+    return mp_obj_is_obj(o) && o != MP_OBJ_NULL ? ((const mp_obj_base_t *)o)->type : NULL;
+}
+
+// Conversions
+
+static inline mp_int_t mp_obj_get_int(mp_const_obj_t arg) {
+    if (mp_obj_is_small_int(arg)) {
+        return MP_OBJ_SMALL_INT_VALUE(arg);
+    } else if (arg == mp_const_false) {
+        return 0;
+    } else if (arg == mp_const_true) {
+        return 1;
+    } else if (shim_type(arg) == &mp_type_int) {
+        return (mp_int_t)((const shim_int_t *)arg)->value;
+    }
+    mp_raise_TypeError("can't convert to int");
+}
+
+static inline mp_float_t mp_obj_get_float(mp_obj_t arg) {
+    if (shim_type(arg) == &mp_type_float) {
+        return ((mp_obj_float_t *)arg)->value;
+    }
+    return (mp_float_t)mp_obj_get_int(arg);
+}
+
+static inline bool mp_obj_is_true(mp_obj_t arg) {
+    if (arg == mp_const_false || arg == mp_const_none) {
+        return false;
+    } else if (arg == mp_const_true) {
+        return true;
+    } else if (mp_obj_is_small_int(arg)) {
+        return MP_OBJ_SMALL_INT_VALUE(arg) != 0;
+    } else if (shim_type(arg) == &mp_type_float) {
+        return ((mp_obj_float_t *)arg)->value != 0;
+    } else if (shim_type(arg) == &mp_type_str || shim_type(arg) == &mp_type_bytes) {
+        return ((mp_obj_str_t *)arg)->len != 0;
+    } else if (shim_type(arg) == &mp_type_tuple) {
+        return ((mp_obj_tuple_t *)arg)->len != 0;
+    }
+    return true;
+}
+
+static inline const char *mp_obj_str_get_str(mp_obj_t self_in) {
+    if (mp_obj_is_qstr(self_in)) {
+        return qstr_str(MP_OBJ_QSTR_VALUE(self_in));
+    } else if (shim_type(self_in) == &mp_type_str) {
+        return (const char *)((mp_obj_str_t *)self_in)->data;
+    }
+    mp_raise_TypeError("can't convert to str");
+}
+
+static inline mp_obj_t mp_obj_new_int(mp_int_t value) {
+    if (MP_SMALL_INT_FITS(value)) {
+        return MP_OBJ_NEW_SMALL_INT(value);
+    }
+    shim_int_t *o = m_new_obj(shim_int_t);
+    o->base.type = &mp_type_int;
+    o->value = value;
+    return MP_OBJ_FROM_PTR(o);
+}
+
+static inline mp_obj_t mp_obj_new_float(mp_float_t value) {
+    mp_obj_float_t *o = m_new_obj(mp_obj_float_t);
+    o->base.type = &mp_type_float;
+    o->value = value;
+    return MP_OBJ_FROM_PTR(o);
+}
+
+static inline mp_obj_t shim_new_str(const mp_obj_type_t *type, const char *data, size_t len) {
+    mp_obj_str_t *o = m_new_obj(mp_obj_str_t);
+    uint8_t *copy = m_new(uint8_t, len + 1);
+    memcpy(copy, data, len);
+    copy[len] = '\0';
+    o->base.type = type;
+    o->hash = 0;
+    o->len = len;
+    o->data = copy;
+    return MP_OBJ_FROM_PTR(o);
+}
+
+static inline mp_obj_t mp_obj_new_str(const char *data, size_t len) {
+    return shim_new_str(&mp_type_str, data, len);
+}
+
+static inline mp_obj_t mp_obj_new_bytes(const uint8_t *data, size_t len) {
+    return shim_new_str(&mp_type_bytes, (const char *)data, len);
+}
+
+static inline mp_obj_t mp_obj_new_tuple(size_t n, const mp_obj_t *items) {
+    mp_obj_tuple_t *o = m_new_obj_var(mp_obj_tuple_t, mp_obj_t, n);
+    o->base.type = &mp_type_tuple;
+    o->len = n;
+    for (size_t i = 0; i < n; i++) {
+        o->items[i] = items == NULL ? MP_OBJ_NULL : items[i];
+    }
+    return MP_OBJ_FROM_PTR(o);
+}
+
+static inline void mp_obj_get_array(mp_obj_t o, size_t *len, mp_obj_t **items) {
+    if (shim_type(o) == &mp_type_tuple) {
+        *len = ((mp_obj_tuple_t *)o)->len;
+        *items = ((mp_obj_tuple_t *)o)->items;
+    } else if (shim_type(o) == &mp_type_list) {
+        *len = ((mp_obj_list_t *)o)->len;
+        *items = ((mp_obj_list_t *)o)->items;
+    } else {
+        mp_raise_TypeError("object isn't a tuple or list");
+    }
+}
+
+static inline void mp_obj_get_array_fixed_n(mp_obj_t o, size_t len, mp_obj_t **items) {
+    size_t seq_len;
+    mp_obj_get_array(o, &seq_len, items);
+    if (seq_len != len) {
+        mp_raise_ValueError("tuple/list has wrong length");
+    }
+}
+
+// Buffer protocol
+
+#define MP_BUFFER_READ (1)
+#define MP_BUFFER_WRITE (2)
+#define MP_BUFFER_RW (MP_BUFFER_READ | MP_BUFFER_WRITE)
+
+typedef struct _mp_buffer_info_t {
+    void *buf;
+    size_t len;
+    int typecode;
+} mp_buffer_info_t;
+
+static inline size_t mp_binary_get_size(char struct_type, char val_type, size_t *palign) {
+    (void)struct_type;
+    (void)palign;
+    switch (val_type) {
+        case 'b': case 'B': return 1;
+        case 'h': case 'H': return 2;
+        case 'i': case 'I': case 'f': return 4;
+        case 'l': case 'L': return sizeof(long);
+        case 'q': case 'Q': case 'd': return 8;
+        default: return sizeof(void *);
+    }
+}
+
+static inline void mp_binary_set_val_array_from_int(char typecode, void *p, size_t index, mp_int_t val) {
+    switch (typecode) {
+        case 'b': ((int8_t *)p)[index] = (int8_t)val; break;
+        case 'B': ((uint8_t *)p)[index] = (uint8_t)val; break;
+        case 'h': ((int16_t *)p)[index] = (int16_t)val; break;
+        case 'H': ((uint16_t *)p)[index] = (uint16_t)val; break;
+        case 'i': ((int32_t *)p)[index] = (int32_t)val; break;
+        case 'I': ((uint32_t *)p)[index] = (uint32_t)val; break;
+        case 'l': ((long *)p)[index] = (long)val; break;
+        case 'L': ((unsigned long *)p)[index] = (unsigned long)val; break;
+        case 'q': ((int64_t *)p)[index] = (int64_t)val; break;
+        case 'Q': ((uint64_t *)p)[index] = (uint64_t)val; break;
+        default: mp_raise_TypeError("not an integer typecode");
+    }
+}
+
+static inline mp_obj_t mp_binary_get_val_array(char typecode, void *p, size_t index) {
+    switch (typecode) {
+        case 'b': return MP_OBJ_NEW_SMALL_INT(((int8_t *)p)[index]);
+        case 'B': return MP_OBJ_NEW_SMALL_INT(((uint8_t *)p)[index]);
+        case 'h': return MP_OBJ_NEW_SMALL_INT(((int16_t *)p)[index]);
+        case 'H': return MP_OBJ_NEW_SMALL_INT(((uint16_t *)p)[index]);
+        case 'i': return mp_obj_new_int(((int32_t *)p)[index]);
+        case 'I': return mp_obj_new_int((mp_int_t)((uint32_t *)p)[index]);
+        case 'l': return mp_obj_new_int(((long *)p)[index]);
+        case 'L': return mp_obj_new_int((mp_int_t)((unsigned long *)p)[index]);
+        case 'q': return mp_obj_new_int((mp_int_t)((int64_t *)p)[index]);
+        case 'Q': return mp_obj_new_int((mp_int_t)((uint64_t *)p)[index]);
+        case 'f': return mp_obj_new_float(((float *)p)[index]);
+        case 'd': return mp_obj_new_float(((double *)p)[index]);
+        default: mp_raise_TypeError("unsupported typecode");
+    }
+}
+
+static inline mp_obj_t shim_new_array(const mp_obj_type_t *type, char typecode, size_t len) {
+    shim_array_t *o = m_new_obj(shim_array_t);
+    o->base.type = type;
+    o->typecode = typecode;
+    o->len = len;
+    o->items = m_new(uint8_t, len * mp_binary_get_size('@', typecode, NULL));
+    memset(o->items, 0, len * mp_binary_get_size('@', typecode, NULL));
+    return MP_OBJ_FROM_PTR(o);
+}
+
+static inline bool mp_get_buffer(mp_obj_t obj, mp_buffer_info_t *bufinfo, int flags) {
+    const mp_obj_type_t *type = shim_type(obj);
+    if (type == &mp_type_bytes || type == &mp_type_str) {
+        if (flags & MP_BUFFER_WRITE) {
+            return false;
+        }
+        bufinfo->buf = (void *)((mp_obj_str_t *)obj)->data;
+        bufinfo->len = ((mp_obj_str_t *)obj)->len;
+        bufinfo->typecode = 'B';
+    } else if (type == &mp_type_bytearray || type == &mp_type_memoryview || type == &mp_type_array) {
+        shim_array_t *array = (shim_array_t *)obj;
+        bufinfo->buf = array->items;
+        bufinfo->len = array->len * mp_binary_get_size('@', array->typecode, NULL);
+        bufinfo->typecode = array->typecode;
+    } else {
+        return false;
+    }
+    return true;
+}
+
+static inline void mp_get_buffer_raise(mp_obj_t obj, mp_buffer_info_t *bufinfo, int flags) {
+    if (!mp_get_buffer(obj, bufinfo, flags)) {
+        mp_raise_TypeError("object with buffer protocol required");
+    }
+}
+
+// Argument parsing
+
+#define MP_ARG_BOOL (0x001)
+#define MP_ARG_INT (0x002)
+#define MP_ARG_OBJ (0x003)
+#define MP_ARG_KIND_MASK (0x0ff)
+#define MP_ARG_REQUIRED (0x100)
+#define MP_ARG_KW_ONLY (0x200)
+
+typedef union _mp_arg_val_t {
+    bool u_bool;
+    mp_int_t u_int;
+    mp_obj_t u_obj;
+    mp_rom_obj_t u_rom_obj;
+} mp_arg_val_t;
+
+typedef struct _mp_arg_t {
+    uint16_t qst;
+    uint16_t flags;
+    mp_arg_val_t defval;
+} mp_arg_t;
+
+static inline void mp_arg_check_num(size_t n_args, size_t n_kw, size_t n_args_min, size_t n_args_max,
+                                    bool takes_kw) {
+    if (n_kw && !takes_kw) {
+        mp_raise_TypeError("function doesn't take keyword arguments");
+    }
+    if (n_args < n_args_min || n_args > n_args_max) {
+        mp_raise_TypeError("function got the wrong number of positional arguments");
+    }
+}
+
+static inline mp_map_elem_t *shim_map_lookup(mp_map_t *map, mp_obj_t key) {
+    for (size_t i = 0; map != NULL && i < map->used; i++) {
+        if (map->table[i].key == key) {
+            return &map->table[i];
+        }
+    }
+    return NULL;
+}
+
+static inline void mp_arg_parse_all(size_t n_pos, const mp_obj_t *pos, mp_map_t *kws, size_t n_allowed,
+                                    const mp_arg_t *allowed, mp_arg_val_t *out_vals) {
+    size_t pos_found = 0, kws_found = 0;
+    for (size_t i = 0; i < n_allowed; i++) {
+        mp_obj_t given_arg;
+        if (i < n_pos) {
+            if (allowed[i].flags & MP_ARG_KW_ONLY) {
+                mp_raise_TypeError("extra positional arguments given");
+            }
+            pos_found++;
+            given_arg = pos[i];
+        } else {
+            mp_map_elem_t *kw = shim_map_lookup(kws, MP_OBJ_NEW_QSTR(allowed[i].qst));
+            if (kw == NULL) {
+                if (allowed[i].flags & MP_ARG_REQUIRED) {
+                    mp_raise_TypeError("missing required argument");
+                }
+                out_vals[i] = allowed[i].defval;
+                continue;
+            }
+            kws_found++;
+            given_arg = kw->value;
+        }
+        switch (allowed[i].flags & MP_ARG_KIND_MASK) {
+            case MP_ARG_BOOL:
+                out_vals[i].u_bool = mp_obj_is_true(given_arg);
+                break;
+            case MP_ARG_INT:
+                out_vals[i].u_int = mp_obj_get_int(given_arg);
+                break;
+            default:
+                out_vals[i].u_obj = given_arg;
+        }
+    }
+    if (pos_found < n_pos) {
+        mp_raise_TypeError("extra positional arguments given");
+    }
+    if (kws != NULL && kws_found < kws->used) {
+        mp_raise_TypeError("extra keyword arguments given");
+    }
+}
+
+// Function objects and calls
+
+typedef mp_obj_t (*mp_fun_0_t)(void);
+typedef mp_obj_t (*mp_fun_1_t)(mp_obj_t);
+typedef mp_obj_t (*mp_fun_2_t)(mp_obj_t, mp_obj_t);
+typedef mp_obj_t (*mp_fun_3_t)(mp_obj_t, mp_obj_t, mp_obj_t);
+typedef mp_obj_t (*mp_fun_var_t)(size_t n, const mp_obj_t *);
+typedef mp_obj_t (*mp_fun_kw_t)(size_t n, const mp_obj_t *, mp_map_t *);
+
+typedef struct _mp_obj_fun_builtin_fixed_t {
+    mp_obj_base_t base;
+    union {
+        mp_fun_0_t _0;
+        mp_fun_1_t _1;
+        mp_fun_2_t _2;
+        mp_fun_3_t _3;
+    } fun;
+} mp_obj_fun_builtin_fixed_t;
+
+typedef struct _mp_obj_fun_builtin_var_t {
+    mp_obj_base_t base;
+    uint32_t sig;
+    union {
+        mp_fun_var_t var;
+        mp_fun_kw_t kw;
+    } fun;
+} mp_obj_fun_builtin_var_t;
+
+#define MP_OBJ_FUN_ARGS_MAX (0xffff)
+#define MP_OBJ_FUN_MAKE_SIG(n_args_min, n_args_max, takes_kw) \
+    ((uint32_t)((((uint32_t)(n_args_min)) << 17) | (((uint32_t)(n_args_max)) << 1) | ((takes_kw) ? 1 : 0)))
+
+#define MP_DEFINE_CONST_FUN_OBJ_0(obj_name, fun_name) \
+    const mp_obj_fun_builtin_fixed_t obj_name = { { &mp_type_fun_builtin_0 }, .fun._0 = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_1(obj_name, fun_name) \
+    const mp_obj_fun_builtin_fixed_t obj_name = { { &mp_type_fun_builtin_1 }, .fun._1 = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_2(obj_name, fun_name) \
+    const mp_obj_fun_builtin_fixed_t obj_name = { { &mp_type_fun_builtin_2 }, .fun._2 = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_3(obj_name, fun_name) \
+    const mp_obj_fun_builtin_fixed_t obj_name = { { &mp_type_fun_builtin_3 }, .fun._3 = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_VAR(obj_name, n_args_min, fun_name) \
+    const mp_obj_fun_builtin_var_t obj_name = \
+    { { &mp_type_fun_builtin_var }, MP_OBJ_FUN_MAKE_SIG(n_args_min, MP_OBJ_FUN_ARGS_MAX, false), .fun.var = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(obj_name, n_args_min, n_args_max, fun_name) \
+    const mp_obj_fun_builtin_var_t obj_name = \
+    { { &mp_type_fun_builtin_var }, MP_OBJ_FUN_MAKE_SIG(n_args_min, n_args_max, false), .fun.var = fun_name }
+#define MP_DEFINE_CONST_FUN_OBJ_KW(obj_name, n_args_min, fun_name) \
+    const mp_obj_fun_builtin_var_t obj_name = \
+    { { &mp_type_fun_builtin_var }, MP_OBJ_FUN_MAKE_SIG(n_args_min, MP_OBJ_FUN_ARGS_MAX, true), .fun.kw = fun_name }
+
+// Calls a builtin function object the way the fun_builtin_*_call handlers do
+static inline mp_obj_t mp_call_function_n_kw(mp_obj_t fun_in, size_t n_args, size_t n_kw, const mp_obj_t *args) {
+    const mp_obj_type_t *type = shim_type(fun_in);
+    if (type == &mp_type_fun_builtin_var) {
+        const mp_obj_fun_builtin_var_t *self = MP_OBJ_TO_PTR(fun_in);
+        mp_arg_check_num(n_args, n_kw, self->sig >> 17, (self->sig >> 1) & 0xffff, self->sig & 1);
+        if (self->sig & 1) {
+            mp_map_t kw_args = { n_kw, n_kw, (mp_map_elem_t *)(args + n_args) };
+            return self->fun.kw(n_args, args, &kw_args);
+        }
+        return self->fun.var(n_args, args);
+    }
+    const mp_obj_fun_builtin_fixed_t *self = MP_OBJ_TO_PTR(fun_in);
+    if (type == &mp_type_fun_builtin_0) {
+        mp_arg_check_num(n_args, n_kw, 0, 0, false);
+        return self->fun._0();
+    } else if (type == &mp_type_fun_builtin_1) {
+        mp_arg_check_num(n_args, n_kw, 1, 1, false);
+        return self->fun._1(args[0]);
+    } else if (type == &mp_type_fun_builtin_2) {
+        mp_arg_check_num(n_args, n_kw, 2, 2, false);
+        return self->fun._2(args[0], args[1]);
+    } else if (type == &mp_type_fun_builtin_3) {
+        mp_arg_check_num(n_args, n_kw, 3, 3, false);
+        return self->fun._3(args[0], args[1], args[2]);
+    }
+    mp_raise_TypeError("object isn't callable");
+}
+
+#endif // USTUBBY_SHIM_OBJ_H
+"""
+
+# The other headers generated code includes, all provided by the one shim
+SHIM_INCLUDES = ("runtime.h", "builtin.h", "binary.h", "smallint.h")
+
+# Sample arguments passed to the functions, as C expressions building the object
+sample_args = {
+    int: "MP_OBJ_NEW_SMALL_INT(3)",
+    ustubby.SmallInt: "MP_OBJ_NEW_SMALL_INT(3)",
+    float: "mp_obj_new_float(1.5)",
+    bool: "mp_const_true",
+    str: 'mp_obj_new_str("abc", 3)',
+    object: "mp_const_none",
+    bytes: 'mp_obj_new_bytes((const uint8_t *)"0123456789abcdef", 16)',
+    bytearray: "shim_new_array(&mp_type_bytearray, 'B', 16)",
+    memoryview: "shim_new_array(&mp_type_memoryview, 'B', 16)",
+    array.array: "shim_new_array(&mp_type_array, 'd', 4)",
+}
+
+# Elements in the arrays passed to the batched functions of ustubby.many
+MANY_LENGTH = 64
+
+element_samples = {
+    int: "MP_OBJ_NEW_SMALL_INT(3)",
+    float: "mp_obj_new_float(1.5)",
+    bool: "mp_const_true",
+}
+
+RET_VAL = re.compile(r"^\s+[\w\s*]+\bret_val(\[\d+\])?;$")
+
+
+def sample_arg(annotation) -> Optional[str]:
+    """
+    :return: C expression making an argument for a parameter annotated with annotation, or None if there is no sample
+    """
+    if ustubby.is_out(annotation):
+        return sample_args[annotation.buffer_type]
+    if annotation in sample_args:
+        return sample_args[annotation]
+    if annotation in (tuple, list, set):
+        element, length = int, 4
+    else:
+        container = ustubby.container_element(annotation)
+        if container is None or container[0] not in element_samples:
+            return None
+        element, length = container[0], container[1] or 4
+    items = ", ".join([element_samples[element]] * length)
+    return f"mp_obj_new_tuple({length}, (mp_obj_t[]){{ {items} }})"
+
+
+def many_arg(annotation) -> str:
+    """
+    :return: C expression making an array argument of a batched function for an int, float or bool parameter
+    """
+    return f"shim_new_array(&mp_type_array, '{'d' if annotation is float else 'i'}', {MANY_LENGTH})"
+
+
+def convention(params) -> str:
+    """
+    :return: Name of the calling convention a function with these parameters is generated with
+    """
+    kind = ustubby.calling_convention(params)
+    if kind == "positional":
+        return f"OBJ_{len(params)}"
+    return "VAR_BETWEEN" if kind == "between" else "KW"
+
+
+def convention_order(name: str) -> tuple:
+    """
+    Sort key listing OBJ_0 to OBJ_3 before VAR_BETWEEN and KW
+    """
+    return ("OBJ_" not in name, name == "KW", name)
+
+
+class Call:
+    """
+    One timed call of a generated function
+    """
+
+    def __init__(self, label, convention, obj, args, kwargs=None):
+        self.label = label
+        self.convention = convention
+        self.obj = obj
+        self.args = args
+        self.kwargs = kwargs or {}
+
+
+def calls(mod) -> Iterator[Call]:
+    """
+    Calls to time for each function of the module which can be given sample arguments.
+    Functions are called with every positional parameter, keyword functions a second time passing their keyword only
+    parameters by keyword. Batched functions are called with arrays of MANY_LENGTH elements for every argument.
+    """
+    for f in ir.module_members(mod, inspect.isfunction):
+        params = ustubby.signature(f).parameters
+        samples = {name: sample_arg(param.annotation) for name, param in params.items()
+                   if param.kind not in (param.VAR_POSITIONAL, param.VAR_KEYWORD)}
+        if None in samples.values():
+            continue
+        style = convention(params)
+        obj = f"{ustubby.c_name(f)}_obj"
+        if getattr(f, "many", False):
+            args = [many_arg(ustubby.signature(f).return_annotation)]
+            args += [many_arg(param.annotation) for param in params.values()]
+            yield Call(f"{f.__name__}_many[{MANY_LENGTH}]", "MANY", f"{ustubby.c_name(f)}_many_obj", args)
+        positional = [samples[name] for name, param in params.items()
+                      if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)]
+        if style != "KW":
+            yield Call(f.__name__, style, obj, positional)
+            continue
+        # Keyword functions are generated method style and skip the first positional argument
+        positional = ["mp_const_none"] + positional
+        yield Call(f.__name__, style, obj, positional)
+        keywords = {name: samples[name] for name, param in params.items() if param.kind == param.KEYWORD_ONLY}
+        if keywords:
+            yield Call(f"{f.__name__}(kw)", style, obj, positional, keywords)
+
+
+def iter_module_source(mod) -> Iterator[str]:
+    """
+    Generates the module as stub_module does, but with the placeholders of unimplemented functions zeroing ret_val
+    and returning an empty string so the stubs compile and run
+    """
+    source = "\n".join(ustubby.iter_stub_module(mod))
+    has_ret_val = False
+    for line in source.splitlines():
+        if line.startswith("STATIC "):
+            has_ret_val = False
+        elif RET_VAL.match(line):
+            has_ret_val = True
+        if line.strip() == "//Your code here":
+            if has_ret_val:
+                yield "    memset(&ret_val, 0, sizeof(ret_val));"
+            continue
+        yield line.replace("<ret_val_ptr>", '""').replace("<ret_val_len>", "0")
+
+
+def qstrs(source: str) -> List[str]:
+    """
+    :return: Names of the qstrs the source uses, in the order they first appear
+    """
+    return list(dict.fromkeys(re.findall(r"\bMP_QSTR_(\w+)", source)))
+
+
+def iter_qstrdefs(names: List[str]) -> Iterator[str]:
+    yield "// qstrs used by the module, written by ustubby.harness"
+    yield "enum {"
+    yield "    MP_QSTRnull,"
+    for name in names:
+        yield f"    MP_QSTR_{name},"
+    yield "};"
+    yield ""
+    yield "static const char *const shim_qstr_strings[] = {"
+    yield '    "",'
+    for name in names:
+        yield f'    "{name}",'
+    yield "};"
+
+
+def iter_driver(mod, calls: List[Call]) -> Iterator[str]:
+    """
+    Generates harness.c, timing each call and averaging the results per calling convention
+    """
+    conventions = sorted({call.convention for call in calls}, key=convention_order)
+    yield "// Host benchmark harness written by ustubby.harness"
+    yield "#define _POSIX_C_SOURCE 200809L"
+    yield "#include <time.h>"
+    yield ""
+    yield '#include "qstrdefs.h"'
+    yield '#include "py/obj.h"'
+    yield f'#include "{mod.__name__}.c"'
+    yield ""
+    yield "static uint64_t now_ns(void) {"
+    yield "    struct timespec ts;"
+    yield "    clock_gettime(CLOCK_MONOTONIC, &ts);"
+    yield "    return (uint64_t)ts.tv_sec * 1000000000u + (uint64_t)ts.tv_nsec;"
+    yield "}"
+    yield ""
+    yield "static double bench(const char *label, const char *convention, mp_obj_t fun, size_t n_args, size_t n_kw,"
+    yield "                    const mp_obj_t *args, long iterations) {"
+    yield "    // Read through volatiles so the calls aren't inlined or optimised away"
+    yield "    mp_obj_t volatile fun_in = fun;"
+    yield "    mp_obj_t volatile sink;"
+    yield "    shim_arena_mark();"
+    yield "    for (long i = 0; i < iterations / 10 + 1; i++) {"
+    yield "        sink = mp_call_function_n_kw(fun_in, n_args, n_kw, args);"
+    yield "    }"
+    yield "    uint64_t start = now_ns();"
+    yield "    for (long i = 0; i < iterations; i++) {"
+    yield "        sink = mp_call_function_n_kw(fun_in, n_args, n_kw, args);"
+    yield "    }"
+    yield "    double ns = (double)(now_ns() - start) / (double)iterations;"
+    yield "    (void)sink;"
+    yield '    printf("%-32s %-12s %10.2f ns/call\\n", label, convention, ns);'
+    yield "    return ns;"
+    yield "}"
+    yield ""
+    yield "int main(int argc, char **argv) {"
+    yield f"    long iterations = argc > 1 ? atol(argv[1]) : {DEFAULT_ITERATIONS};"
+    names = ", ".join(f'"{name}"' for name in conventions)
+    yield f"    const char *conventions[] = {{ {names} }};"
+    yield f"    double total[{len(conventions) or 1}] = {{ 0 }};"
+    yield f"    int count[{len(conventions) or 1}] = {{ 0 }};"
+    for index, call in enumerate(calls):
+        args = call.args + [item for name, value in call.kwargs.items()
+                            for item in (f"MP_OBJ_NEW_QSTR(MP_QSTR_{name})", value)]
+        c_args = f"(mp_obj_t[]){{ {', '.join(args)} }}" if args else "NULL"
+        yield ""
+        yield f"    mp_obj_t *args_{index} = {c_args};"
+        yield f'    total[{conventions.index(call.convention)}] += bench("{call.label}", "{call.convention}", ' \
+              f"MP_OBJ_FROM_PTR(&{call.obj}), {len(call.args)}, {len(call.kwargs)}, args_{index}, iterations);"
+        yield f"    count[{conventions.index(call.convention)}]++;"
+    yield ""
+    yield '    printf("\\nMean per calling convention\\n");'
+    yield f"    for (size_t i = 0; i < {len(conventions)}; i++) {{"
+    yield '        printf("%-45s %10.2f ns/call\\n", conventions[i], total[i] / count[i]);'
+    yield "    }"
+    yield "    return 0;"
+    yield "}"
+
+
+def write_harness(mod, directory) -> List[Path]:
+    """
+    Writes the shim headers, the module and the driver into directory
+    :return: Paths written
+    """
+    directory = Path(directory)
+    (directory / "py").mkdir(parents=True, exist_ok=True)
+    source = list(iter_module_source(mod))
+    files: Dict[Path, Iterable[str]] = {
+        directory / "py" / "obj.h": [SHIM_HEADER],
+        **{directory / "py" / name: ['#include "obj.h"'] for name in SHIM_INCLUDES},
+        directory / f"{mod.__name__}.c": source,
+        directory / "qstrdefs.h": iter_qstrdefs(qstrs("\n".join(source))),
+        directory / "harness.c": iter_driver(mod, list(calls(mod))),
+    }
+    for path, chunks in files.items():
+        update_file(path, chunks)
+    return list(files)
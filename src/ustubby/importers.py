@@ -0,0 +1,283 @@
+"""
+Register map importers, turning other register descriptions into the rows of a LiteX csr.csv.
+
+Each importer yields csr_register rows of name, address, length and access and csr_field rows of register, field,
+bit offset and width, all as strings, so they feed parse_rows and RegisterMap.from_rows like a csv file would.
+The files are read incrementally rather than loaded whole, so memory stays bounded on vendor files of tens of
+megabytes.
+
+CMSIS-SVD registers are named <peripheral>_<register>, with clusters adding their name in between, and their fields
+keep their own names. Each peripheral's elements are dropped once its rows are made, keeping only a tuple per register
+so that peripherals derived from it reuse its layout without reading it again.
+
+The JSON description is an array of registers, such as
+[{"name": "ctrl_reset", "address": "0x82001000", "length": 1, "access": "rw",
+  "fields": [{"name": "enable", "offset": 0, "width": 1}]}]
+where length, access and fields are optional.
+"""
+import csv
+import json
+import re
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import ustubby
+
+SVD_ACCESS = {
+    "read-only": "ro",
+    "write-only": "wo",
+    "read-write": "rw",
+    "writeOnce": "wo",
+    "read-writeOnce": "rw",
+}
+
+# Bits in a CSR word, the length of a register being its size in words
+WORD_BITS = 32
+
+# Characters read at a time by the JSON importer
+JSON_CHUNK = 1 << 16
+
+Row = List[str]
+
+
+class SvdRegister(NamedTuple):
+    """
+    Register of a peripheral, relative to the peripheral's base address
+    """
+    name: str
+    offset: int
+    length: int
+    access: str
+    fields: Tuple[Tuple[str, int, int], ...]
+
+
+def register_row(name: str, address: int, length: int, access: str) -> Row:
+    return ["csr_register", name, f"0x{address:08x}", str(length), access]
+
+
+def field_row(register: str, name: str, offset: int, width: int) -> Row:
+    return ["csr_field", register, name, str(offset), str(width)]
+
+
+def iter_csv(path) -> Iterator[Row]:
+    """
+    :return: Rows of a LiteX csr.csv, leaving out comments
+    """
+    with open(path, newline="") as f:
+        yield from csv.reader(ustubby.filter_comments(f))
+
+
+def svd_int(text: str) -> int:
+    """
+    :return: An SVD scaledNonNegativeInteger, in decimal, 0x hexadecimal or # binary
+    """
+    text = text.strip().lower()
+    if text.startswith("#"):
+        return int(text[1:], 2)
+    return int(text, 0)
+
+
+def child_text(elem, tag: str, default: Optional[str] = None) -> Optional[str]:
+    child = elem.find(tag)
+    return default if child is None or child.text is None else child.text.strip()
+
+
+def dim_indices(elem) -> List[str]:
+    """
+    :return: The indices of a dim array element, or [""] if it isn't one
+    """
+    dim = child_text(elem, "dim")
+    if dim is None:
+        return [""]
+    indices = child_text(elem, "dimIndex")
+    if indices is None:
+        return [str(i) for i in range(svd_int(dim))]
+    match = re.fullmatch(r"(\d+)-(\d+)", indices)
+    if match:
+        return [str(i) for i in range(int(match.group(1)), int(match.group(2)) + 1)]
+    return [index.strip() for index in indices.split(",")]
+
+
+def dim_name(name: str, index: str) -> str:
+    return name.replace("[%s]", index).replace("%s", index)
+
+
+def svd_fields(elem) -> Tuple[Tuple[str, int, int], ...]:
+    """
+    :return: Name, bit offset and width of each field of a register, from bitOffset and bitWidth, lsb and msb or
+        bitRange
+    """
+    fields = []
+    for field in elem.iterfind("fields/field"):
+        if child_text(field, "bitOffset") is not None:
+            offset, width = svd_int(child_text(field, "bitOffset")), svd_int(child_text(field, "bitWidth", "1"))
+        elif child_text(field, "lsb") is not None:
+            offset = svd_int(child_text(field, "lsb"))
+            width = svd_int(child_text(field, "msb")) - offset + 1
+        else:
+            msb, lsb = child_text(field, "bitRange").strip("[]").split(":")
+            offset, width = svd_int(lsb), svd_int(msb) - svd_int(lsb) + 1
+        increment = svd_int(child_text(field, "dimIncrement", "0"))
+        for i, index in enumerate(dim_indices(field)):
+            fields.append((dim_name(child_text(field, "name"), index), offset + i * increment, width))
+    return tuple(fields)
+
+
+def svd_registers(elem, prefix: str, offset: int, size: int, access: str) -> Iterator[SvdRegister]:
+    """
+    Registers of a peripheral or cluster element, expanding dim arrays and nested clusters
+    :param prefix: Names of the enclosing clusters
+    :param offset: Address offset of the enclosing clusters
+    :param size: Inherited register size in bits
+    :param access: Inherited access
+    """
+    size = svd_int(child_text(elem, "size", str(size)))
+    access = SVD_ACCESS.get(child_text(elem, "access", ""), access)
+    container = elem.find("registers")
+    parent = elem if container is None else container
+    for child in parent:
+        if child.tag not in ("register", "cluster"):
+            continue
+        start = offset + svd_int(child_text(child, "addressOffset", "0"))
+        increment = svd_int(child_text(child, "dimIncrement", "0"))
+        for i, index in enumerate(dim_indices(child)):
+            name = f"{prefix}{dim_name(child_text(child, 'name'), index)}"
+            if child.tag == "cluster":
+                yield from svd_registers(child, f"{name}_", start + i * increment, size, access)
+                continue
+            bits = svd_int(child_text(child, "size", str(size)))
+            yield SvdRegister(name, start + i * increment, max(1, -(-bits // WORD_BITS)),
+                              SVD_ACCESS.get(child_text(child, "access", ""), access), svd_fields(child))
+
+
+def peripheral_rows(name: str, address: int, layout: Tuple[SvdRegister, ...]) -> Iterator[Row]:
+    for register in layout:
+        full_name = f"{name}_{register.name}"
+        yield register_row(full_name, address + register.offset, register.length, register.access)
+        for field in register.fields:
+            yield field_row(full_name, *field)
+
+
+def iter_svd(path) -> Iterator[Row]:
+    """
+    Reads a CMSIS-SVD file one peripheral at a time, dropping each peripheral's elements once its rows are made
+    :raises ValueError: if a peripheral is derived from one that isn't in the file
+    """
+    layouts: Dict[str, Tuple[SvdRegister, ...]] = {}
+    waiting: Dict[str, List[Tuple[str, int]]] = {}
+    root = defaults = peripherals = None
+
+    def define(name: str, address: int, layout: Tuple[SvdRegister, ...]) -> Iterator[Row]:
+        layouts[name] = layout
+        yield from peripheral_rows(name, address, layout)
+        for derived, derived_address in waiting.pop(name, ()):
+            yield from define(derived, derived_address, layout)
+
+    for event, elem in ElementTree.iterparse(str(path), events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "start" or elem.tag != "peripheral":
+            continue
+        if defaults is None:
+            # The device's defaults and the peripherals element come before the first peripheral ends
+            defaults = (svd_int(child_text(root, "size", str(WORD_BITS))),
+                        SVD_ACCESS.get(child_text(root, "access", ""), "rw"))
+            peripherals = root.find("peripherals")
+        name, address = child_text(elem, "name"), svd_int(child_text(elem, "baseAddress"))
+        base = elem.get("derivedFrom")
+        if elem.find("registers") is not None or base is None:
+            yield from define(name, address, tuple(svd_registers(elem, "", 0, *defaults)))
+        elif base in layouts:
+            yield from define(name, address, layouts[base])
+        else:
+            waiting.setdefault(base, []).append((name, address))
+        # Removing the peripheral from its parent lets it be freed along with its children
+        peripherals.remove(elem)
+    if waiting:
+        raise ValueError(f"Peripherals derived from unknown peripherals {', '.join(sorted(waiting))}")
+
+
+def iter_json_array(f, chunk: int = JSON_CHUNK) -> Iterator:
+    """
+    Decodes the items of the top level JSON array in f one at a time, reading chunk characters at a time
+    :raises ValueError: if the file isn't a JSON array
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, position, eof
+        data = "" if eof else f.read(chunk)
+        eof = not data
+        buffer, position = buffer[position:] + data, 0
+        return not eof
+
+    def skip(characters: str) -> str:
+        """
+        :return: The next character which isn't one of characters, reading more as needed, "" at the end
+        """
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not fill():
+                return ""
+
+    if skip(" \t\r\n") != "[":
+        raise ValueError("Expected a JSON array of registers")
+    position += 1
+    while True:
+        char = skip(" \t\r\n,")
+        if char == "]":
+            return
+        if not char:
+            raise ValueError("Unterminated JSON array of registers")
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The item may continue past the end of the buffer
+                if not fill():
+                    raise
+                continue
+            if end == len(buffer) and not eof and not isinstance(item, (dict, list, str)):
+                # A number may continue in the next chunk
+                fill()
+                continue
+            break
+        position = end
+        yield item
+
+
+def iter_json(path) -> Iterator[Row]:
+    """
+    Reads a JSON array of registers one register at a time, see the module docstring for the format
+    """
+    with open(path) as f:
+        for register in iter_json_array(f):
+            name, address = register["name"], register["address"]
+            address = int(address, 0) if isinstance(address, str) else address
+            yield register_row(name, address, register.get("length", 1), register.get("access", "rw"))
+            for field in register.get("fields", ()):
+                yield field_row(name, field["name"], field["offset"], field.get("width", 1))
+
+
+READERS = {
+    ".csv": iter_csv,
+    ".svd": iter_svd,
+    ".json": iter_json,
+}
+
+
+def read_rows(path) -> Iterator[Row]:
+    """
+    :return: csr.csv rows of a register map file, read by the importer for its suffix
+    :raises ValueError: if no importer handles the suffix
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix not in READERS:
+        raise ValueError(f"No register map importer for {suffix} files")
+    return READERS[suffix](path)
@@ -0,0 +1,144 @@
+"""
+Per function call counts and times compiled into generated modules.
+
+Each function is generated under the name given by the module's IMPL macro and called through a wrapper which times
+it with MODULE_<NAME>_TICKS(), mp_hal_ticks_us() unless the build defines it as something else such as
+mp_hal_ticks_cpu(). The module gains _stats() returning {name: (calls, total ticks, max ticks)} and _reset_stats().
+Everything is inside #if MODULE_<NAME>_INSTRUMENT, so unless the build defines it as 1 the IMPL macro is the plain
+function name and the module compiles exactly as it would without instrumentation. Calls raising an exception are
+not counted.
+"""
+from typing import List, Sequence
+
+from ustubby import ir
+
+PREAMBLE = """
+#if {guard}
+// Call counts and times of every function, read with {module}._stats()
+#include <string.h>
+#include "py/mphal.h"
+#ifndef {ticks}
+#define {ticks}() mp_hal_ticks_us()
+#endif
+#define {impl}(name) name##_impl
+
+typedef struct _{module}_stats_t {{
+    mp_uint_t calls;
+    mp_uint_t total;
+    mp_uint_t max;
+}} {module}_stats_t;
+
+STATIC void {module}_stats_record({module}_stats_t *stats, mp_uint_t start) {{
+    mp_uint_t elapsed = {ticks}() - start;
+    stats->calls++;
+    stats->total += elapsed;
+    if (elapsed > stats->max) {{
+        stats->max = elapsed;
+    }}
+}}
+#else
+#define {impl}(name) name
+#endif"""
+
+WRAPPER = """#if {guard}
+STATIC {module}_stats_t {name}_stats;
+STATIC mp_obj_t {name}({params}) {{
+    mp_uint_t start = {ticks}();
+    mp_obj_t ret = {name}_impl({args});
+    {module}_stats_record(&{name}_stats, start);
+    return ret;
+}}
+#endif"""
+
+STATS = """
+#if {guard}
+STATIC {module}_stats_t *const {module}_stats_table[] = {{
+{table}
+}};
+STATIC const char *const {module}_stats_names[] = {{
+{names}
+}};
+
+//Returns {{name: (calls, total ticks, max ticks)}} for every function
+STATIC mp_obj_t {module}__stats(void) {{
+    mp_obj_t stats = mp_obj_new_dict(MP_ARRAY_SIZE({module}_stats_table));
+    for (size_t i = 0; i < MP_ARRAY_SIZE({module}_stats_table); i++) {{
+        const {module}_stats_t *entry = {module}_stats_table[i];
+        mp_obj_t values[3] = {{
+            mp_obj_new_int_from_uint(entry->calls),
+            mp_obj_new_int_from_uint(entry->total),
+            mp_obj_new_int_from_uint(entry->max),
+        }};
+        const char *name = {module}_stats_names[i];
+        mp_obj_dict_store(stats, mp_obj_new_str(name, strlen(name)), mp_obj_new_tuple(3, values));
+    }}
+    return stats;
+}}
+MP_DEFINE_CONST_FUN_OBJ_0({module}__stats_obj, {module}__stats);
+
+//Zeroes the counts and times of every function
+STATIC mp_obj_t {module}__reset_stats(void) {{
+    for (size_t i = 0; i < MP_ARRAY_SIZE({module}_stats_table); i++) {{
+        memset({module}_stats_table[i], 0, sizeof({module}_stats_t));
+    }}
+    return mp_const_none;
+}}
+MP_DEFINE_CONST_FUN_OBJ_0({module}__reset_stats_obj, {module}__reset_stats);
+#endif"""
+
+# Parameters of the wrapper and the arguments it passes on, for each calling convention
+FORWARD = {
+    "between": (ir.BETWEEN_PARAMS, "n_args, args"),
+    "keyword": (ir.KEYWORD_PARAMS, "n_args, pos_args, kw_args"),
+}
+
+
+def guard(module: str) -> str:
+    return f"MODULE_{module.upper()}_INSTRUMENT"
+
+
+def names(module: str) -> dict:
+    return {"module": module, "guard": guard(module), "ticks": f"MODULE_{module.upper()}_TICKS",
+            "impl": f"{module.upper()}_IMPL"}
+
+
+def impl_name(fn: ir.Function) -> str:
+    """
+    :return: Name the function itself is defined under, the wrapper taking its place when instrumented
+    """
+    return f"{names(fn.instrument)['impl']}({fn.c_name})"
+
+
+def preamble(module: str) -> str:
+    """
+    :return: The stats type and macros the instrumented functions of module use
+    """
+    return PREAMBLE.format(**names(module))
+
+
+def wrapper(fn: ir.Function) -> str:
+    """
+    :return: The timing wrapper of an instrumented function
+    """
+    if fn.convention == "positional":
+        params = ", ".join(ir.POSITIONAL_PARAM(param.name) for param in fn.parameters)
+        args = ", ".join(f"{param.name}_obj" for param in fn.parameters)
+    else:
+        params, args = FORWARD[fn.convention]
+    return WRAPPER.format(name=fn.c_name, params=params, args=args, **names(fn.instrument))
+
+
+def stats(module: str, c_names: Sequence[str], labels: Sequence[str]) -> str:
+    """
+    :param c_names: C names of the instrumented functions
+    :param labels: Name each function is reported under in _stats()
+    :return: The stats tables and the _stats and _reset_stats functions
+    """
+    table = "\n".join(f"    &{c_name}_stats," for c_name in c_names)
+    stats_names = "\n".join(f'    "{label}",' for label in labels)
+    return STATS.format(table=table, names=stats_names, **names(module))
+
+
+def table_entries(module: str) -> List[ir.TableEntry]:
+    return [ir.TableEntry("_stats", ir.FUNCTION_ENTRY(f"{module}__stats"), guard(module)),
+            ir.TableEntry("_reset_stats", ir.FUNCTION_ENTRY(f"{module}__reset_stats"), guard(module))]
@@ -0,0 +1,460 @@
+"""
+Intermediate representation between the python definitions and the generated C.
+
+Modules, classes and functions are first described by small slotted nodes, then rendered in a single pass.
+stub_module, stub_class, stub_function and FunctionContainer.to_c all render through here. Features changing the
+output can transform the nodes instead of the C text. Nodes compare by value and convert to plain dicts, so two
+versions of a module can be cached and diffed.
+"""
+import inspect
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import ustubby
+
+# Body of functions without code
+PLACEHOLDER = "\t//Your code here"
+
+# Templates, formatted once per function rather than assembled from pieces
+FUNCTION_OPEN = "STATIC mp_obj_t {}({}) {{".format
+POSITIONAL_PARAM = "mp_obj_t {}_obj".format
+DEFINE_POSITIONAL = "MP_DEFINE_CONST_FUN_OBJ_{2}({0}_obj, {0});".format
+DEFINE_BETWEEN = "MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN({0}_obj, {1}, {2}, {0});".format
+DEFINE_KEYWORD = "MP_DEFINE_CONST_FUN_OBJ_KW({0}_obj, 1, {0});".format
+FUNCTION_ENTRY = "MP_ROM_PTR(&{}_obj)".format
+
+BETWEEN_PARAMS = "size_t n_args, const mp_obj_t *args"
+KEYWORD_PARAMS = "size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args"
+
+
+class Node:
+    """
+    Base of the IR nodes, comparing and printing by the values of their slots
+    """
+    __slots__ = ()
+    # Comparing by value, with slots that can be reassigned and defaults such as lists that can't be hashed
+    __hash__ = None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{s}={getattr(self, s)!r}' for s in self.__slots__)})"
+
+    def replace(self, **changes):
+        """
+        :return: Copy of the node with the given slots changed
+        """
+        node = object.__new__(type(self))
+        for slot in self.__slots__:
+            object.__setattr__(node, slot, changes.pop(slot, getattr(self, slot)))
+        if changes:
+            raise TypeError(f"{type(self).__name__} has no field {', '.join(changes)}")
+        return node
+
+    def as_dict(self) -> dict:
+        """
+        :return: The node as plain values, with annotations and defaults as text
+        """
+        return {slot: plain(getattr(self, slot)) for slot in self.__slots__}
+
+
+def plain(value):
+    if isinstance(value, Node):
+        return value.as_dict()
+    if isinstance(value, (tuple, list)):
+        return [plain(item) for item in value]
+    if isinstance(value, inspect._ParameterKind):
+        return value.name
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if value is inspect.Parameter.empty:
+        return None
+    if inspect.isclass(value):
+        return value.__qualname__
+    return repr(value)
+
+
+class Parameter(Node):
+    __slots__ = ("name", "annotation", "kind", "default")
+
+    def __init__(self, name, annotation=object, kind=inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                 default=inspect.Parameter.empty):
+        self.name = name
+        self.annotation = annotation
+        self.kind = kind
+        self.default = default
+
+    @classmethod
+    def from_inspect(cls, param: inspect.Parameter) -> "Parameter":
+        return cls(param.name, param.annotation, param.kind, param.default)
+
+    def to_inspect(self) -> inspect.Parameter:
+        return inspect.Parameter(self.name, self.kind, default=self.default, annotation=self.annotation)
+
+
+class Native(Node):
+    """
+    Annotation of a parameter taking an instance of a native class stubbed along with the function, see build_module
+    :param c_name: Prefix of the class's C names, as for Class
+    """
+    __slots__ = ("name", "c_name")
+
+    def __init__(self, name, c_name):
+        self.name = name
+        self.c_name = c_name
+
+    # Looked up in the conversion tables like any other annotation
+    def __hash__(self):
+        return hash((self.name, self.c_name))
+
+    @classmethod
+    def from_class(cls, python_class) -> "Native":
+        return cls(python_class.__name__, f"{python_class.__module__}_{python_class.__name__}")
+
+
+class Return(Node):
+    """
+    :param mode: One of return_modes
+    :param out: Name of the parameter returned through in the out mode
+    :param value: C replacing the generated return, indented like the function body
+    """
+    __slots__ = ("annotation", "mode", "out", "value")
+
+    def __init__(self, annotation=None, mode="object", out=None, value=None):
+        self.annotation = annotation
+        self.mode = mode
+        self.out = out
+        self.value = value
+
+
+class Function(Node):
+    """
+    :param c_name: Name of the C function, the function object adds _obj
+    :param convention: "positional", "between" or "keyword", see calling_convention
+    :param method: The first parameter is self
+    :param code: C body, or None for the placeholder
+    :param instrument: Name of the module whose call stats the function is timed into, see ustubby.instrument
+    :param many: Name of the module whose helpers the batched companion uses, or None without one, see
+        ustubby.vectorise
+    """
+    __slots__ = ("name", "c_name", "doc", "convention", "parameters", "ret", "code", "method", "instrument", "many")
+
+    def __init__(self, name, c_name, doc=None, convention="positional", parameters=(), ret=None, code=None,
+                 method=False, instrument=None, many=None):
+        self.name = name
+        self.c_name = c_name
+        self.doc = doc
+        self.convention = convention
+        self.parameters: Tuple[Parameter, ...] = tuple(parameters)
+        self.ret: Return = ret if ret is not None else Return()
+        self.code = code
+        self.method = method
+        self.instrument = instrument
+        self.many = many
+
+    def signature(self) -> Dict[str, inspect.Parameter]:
+        return {param.name: param.to_inspect() for param in self.parameters}
+
+
+class Field(Node):
+    """
+    Field of the instance struct of a native class
+    :param default: C expression for the class attribute default, or None without one
+    """
+    __slots__ = ("name", "annotation", "default")
+
+    def __init__(self, name, annotation=object, default=None):
+        self.name = name
+        self.annotation = annotation
+        self.default = default
+
+
+class MakeNew(Node):
+    """
+    Constructor of a native class, converting its arguments as for a VAR_BETWEEN function
+    :param parameters: Parameters of __init__ without self, or one per field when the class has no __init__
+    :param code: C body, or None for the placeholder
+    """
+    __slots__ = ("doc", "parameters", "code")
+
+    def __init__(self, doc=None, parameters=(), code=None):
+        self.doc = doc
+        self.parameters: Tuple[Parameter, ...] = tuple(parameters)
+        self.code = code
+
+    def signature(self) -> Dict[str, inspect.Parameter]:
+        return {param.name: param.to_inspect() for param in self.parameters}
+
+
+class Class(Node):
+    """
+    Native class, see ustubby.classes
+    :param c_name: Prefix of its C names, such as example_Counter for example_Counter_obj_t and example_Counter_type
+    :param methods: Functions put in the locals dict, taking self first
+    """
+    __slots__ = ("name", "c_name", "doc", "fields", "make_new", "methods")
+
+    def __init__(self, name, c_name, doc=None, fields=(), make_new=None, methods=()):
+        self.name = name
+        self.c_name = c_name
+        self.doc = doc
+        self.fields: Tuple[Field, ...] = tuple(fields)
+        self.make_new: MakeNew = make_new if make_new is not None else MakeNew()
+        self.methods: Tuple[Function, ...] = tuple(methods)
+
+
+class TableEntry(Node):
+    """
+    Entry of a globals or locals dict table, value being the ROM object such as MP_ROM_PTR(&example_add_obj)
+    :param guard: Macro the entry is only compiled in with
+    """
+    __slots__ = ("attr", "value", "guard")
+
+    def __init__(self, attr, value, guard=None):
+        self.attr = attr
+        self.value = value
+        self.guard = guard
+
+
+class Module(Node):
+    """
+    :param includes: Headers needed beyond the ones every module includes
+    :param classes: Native classes, rendered before the functions
+    :param instrument: Time every function into call stats, see ustubby.instrument
+    """
+    __slots__ = ("name", "doc", "includes", "classes", "functions", "globals", "instrument")
+
+    def __init__(self, name, doc=None, includes=(), classes=(), functions=(), globals=(), instrument=False):
+        self.name = name
+        self.doc = doc
+        self.includes: Tuple[str, ...] = tuple(includes)
+        self.classes: Tuple[Class, ...] = tuple(classes)
+        self.functions: Tuple[Function, ...] = tuple(functions)
+        self.globals: Tuple[TableEntry, ...] = tuple(globals)
+        self.instrument = instrument
+
+
+def native_parameters(parameters: Dict[str, inspect.Parameter],
+                      natives: Dict[type, Native]) -> Dict[str, inspect.Parameter]:
+    """
+    :param natives: Native annotations of the python classes stubbed along with the parameters
+    :return: The parameters with the annotations naming one of those classes replaced by its Native
+    """
+    return {name: param.replace(annotation=natives[param.annotation])
+            if inspect.isclass(param.annotation) and param.annotation in natives else param
+            for name, param in parameters.items()}
+
+
+def build_function(f, self=False, instrument=False, natives=None) -> Function:
+    """
+    :param self: first parameter is self, either the class the function is a method of or True for a placeholder type
+    :param instrument: Time the function into the call stats of its module
+    :param natives: Native annotations of the python classes stubbed along with the function, see build_module.
+        Parameters annotated with any other class can't be converted.
+    """
+    sig = ustubby.signature(f)
+    parameters = dict(sig.parameters)
+    if self and not parameters:
+        parameters["self"] = inspect.Parameter("self", inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    if self:
+        first = next(iter(parameters))
+        parameters[first] = parameters[first].replace(annotation=self if inspect.isclass(self) else "self")
+        natives = {self: Native.from_class(self), **(natives or {})} if inspect.isclass(self) else natives
+    parameters = native_parameters(parameters, natives or {})
+    ret = Return(sig.return_annotation, ustubby.resolve_return_mode(f, parameters), ustubby.out_parameter(parameters),
+                 getattr(f, "return_value", None))
+    return Function(f.__name__, ustubby.c_name(f, self if inspect.isclass(self) else None), f.__doc__,
+                    ustubby.calling_convention(parameters), map(Parameter.from_inspect, parameters.values()), ret,
+                    getattr(f, "code", None), bool(self), f.__module__ if instrument else None,
+                    f.__module__ if getattr(f, "many", False) and not self else None)
+
+
+def build_class(cls, instrument=False, natives=None) -> Class:
+    """
+    :param instrument: Time the methods into the call stats of their module
+    :param natives: Native annotations of the python classes stubbed along with the class, see build_function
+    :raises ValueError: if __init__ takes parameters a VAR_BETWEEN function can't
+    """
+    natives = {cls: Native.from_class(cls), **(natives or {})}
+    init = vars(cls).get("__init__")
+    parameters = native_parameters(classes.init_parameters(cls), natives)
+    make_new = MakeNew(init and init.__doc__, map(Parameter.from_inspect, parameters.values()),
+                       getattr(init, "code", None))
+    fields = [Field(name, annotation, classes.field_default(cls, name, annotation))
+              for name, annotation in classes.fields(cls).items()]
+    methods = [build_function(f, cls, instrument, natives) for f in classes.methods(cls)]
+    return Class(cls.__name__, f"{cls.__module__}_{cls.__name__}", cls.__doc__, fields, make_new, methods)
+
+
+def module_members(mod, predicate) -> List:
+    """
+    :return: Members of the module defined in it, leaving out imported ones such as ustubby.small_int
+    """
+    return [o[1] for o in inspect.getmembers(mod) if predicate(o[1]) and o[1].__module__ == mod.__name__]
+
+
+def build_module(mod, instrument=False) -> Module:
+    """
+    :param instrument: Time every function into call stats, see ustubby.instrument
+    """
+    python_classes = module_members(mod, inspect.isclass)
+    natives = {cls: Native.from_class(cls) for cls in python_classes}
+    native_classes = [build_class(cls, instrument, natives) for cls in python_classes]
+    python_functions = module_members(mod, inspect.isfunction)
+    functions = [build_function(f, instrument=instrument, natives=natives) for f in python_functions]
+    methods = [fn for cls in native_classes for fn in cls.methods]
+    # Headers a function's code needs, such as py/objarray.h for mp_obj_new_memoryview
+    includes = [include for f in python_functions for include in getattr(f, "includes", ())]
+    if any(fn.ret.mode == "out" or fn.many for fn in methods + functions):
+        includes.append('#include "py/binary.h"')
+    if any(fn.ret.annotation is ustubby.SmallInt for fn in methods + functions):
+        includes.append('#include "py/smallint.h"')
+    includes = list(dict.fromkeys(includes))
+    globals = []
+    for fn in functions:
+        globals.append(TableEntry(fn.name, FUNCTION_ENTRY(fn.c_name)))
+        if fn.many:
+            globals.append(vectorise.table_entry(fn))
+    globals += [TableEntry(cls.name, f"MP_ROM_PTR(&{classes.type_name(cls)})") for cls in native_classes]
+    # Nothing to time in a module without functions
+    instrument = instrument and bool(methods + functions)
+    if instrument:
+        globals += instrumentation.table_entries(mod.__name__)
+    return Module(mod.__name__, mod.__doc__, includes, native_classes, functions, globals, instrument)
+
+
+def comment_block(doc: Optional[str]) -> str:
+    """
+    Uses single line comments as we can't know if there are string escapes such as /* in the code
+    """
+    if doc is None:
+        return "// No Comment"
+    return "\n".join(["//" + line.strip() for line in doc.splitlines()])
+
+
+def param_source(fn: Function, name: str) -> str:
+    """
+    :return: C expression for the object passed as parameter name
+    """
+    if fn.convention == "positional":
+        return f"{name}_obj"
+    if fn.convention == "between":
+        return f"args[{[param.name for param in fn.parameters].index(name)}]"
+    return f"args[ARG_{name}].u_obj"
+
+
+def render_params(fn: Function) -> List[str]:
+    """
+    :return: Lines converting the arguments into C values
+    """
+    if fn.convention == "positional":
+        return [ustubby.handler(ustubby.type_handler, param.annotation, "{0}_obj")(param.name)
+                for param in fn.parameters]
+    if fn.convention == "between":
+        return [ustubby.default_template(param.annotation, param.default)(param.name, index)
+                if param.default is not inspect.Parameter.empty else
+                ustubby.handler(ustubby.type_handler_arr, param.annotation, "args[{1}]")(param.name, index)
+                for index, param in enumerate(fn.parameters)]
+    params = fn.signature()
+    self_init = []
+    if fn.method:
+        first, *rest = params.items()
+        self_init = [ustubby.handler(ustubby.type_handler, first[1].annotation, "pos_args[0]")(first[0])]
+        params = dict(rest)
+    args = "\n\t\t".join(ustubby.allowed_arg(arg, param) for arg, param in params.items())
+    return [ustubby.kw_enum(params),
+            f"\tSTATIC const mp_arg_t {fn.c_name}_allowed_args[] = {{\n\t\t{args}\n\t}};",
+            "",
+            "\n".join(ustubby.kw_parse(fn.c_name, params)),
+            "",
+            *self_init,
+            ustubby.arg_unpack(params)]
+
+
+def render_return(fn: Function) -> str:
+    if fn.ret.value is not None:
+        return fn.ret.value
+    out = fn.ret.out and (fn.ret.out, param_source(fn, fn.ret.out))
+    return ustubby.ret_val_return(fn.ret.annotation, fn.ret.mode, out)
+
+
+def render_define(fn: Function) -> str:
+    if fn.convention == "positional":
+        return DEFINE_POSITIONAL(fn.c_name, None, len(fn.parameters))
+    if fn.convention == "between":
+        required = sum(param.default is inspect.Parameter.empty for param in fn.parameters)
+        return DEFINE_BETWEEN(fn.c_name, required, len(fn.parameters))
+    return DEFINE_KEYWORD(fn.c_name)
+
+
+def render_function(fn: Function) -> List[str]:
+    """
+    :return: Lines of the function, joining them with newlines gives stub_function
+    """
+    if not fn.parameters:
+        params = ""
+    elif fn.convention == "positional":
+        params = ", ".join(POSITIONAL_PARAM(param.name) for param in fn.parameters)
+    else:
+        params = BETWEEN_PARAMS if fn.convention == "between" else KEYWORD_PARAMS
+    name = instrumentation.impl_name(fn) if fn.instrument else fn.c_name
+    lines = ["", comment_block(fn.doc), FUNCTION_OPEN(name, params)]
+    lines.extend(render_params(fn))
+    ret_init = ustubby.ret_val_init(fn.ret.annotation, fn.ret.mode)
+    if ret_init:
+        lines.append(ret_init)
+    lines += ["", fn.code if fn.code is not None else PLACEHOLDER, "", render_return(fn), "}"]
+    if fn.instrument:
+        lines.append(instrumentation.wrapper(fn))
+    lines.append(render_define(fn))
+    if fn.many:
+        lines.append(vectorise.companion(fn))
+    return ustubby.expand_newlines(lines)
+
+
+def render_module(module: Module) -> Iterator[str]:
+    """
+    Renders a module in chunks, joining them with newlines gives stub_module(mod)
+    """
+    yield ustubby.module_doc_text(module.doc)
+    yield ustubby.headers()
+    yield from module.includes
+    if module.instrument:
+        yield instrumentation.preamble(module.name)
+    if any(fn.many for fn in module.functions):
+        yield vectorise.helpers(module.name, module.functions)
+    for cls in module.classes:
+        yield from classes.render_class(cls)
+    for fn in module.functions:
+        yield from render_function(fn)
+    if module.instrument:
+        methods = [(fn.c_name, f"{cls.name}.{fn.name}") for cls in module.classes for fn in cls.methods]
+        methods += [(fn.c_name, fn.name) for fn in module.functions]
+        yield instrumentation.stats(module.name, *zip(*methods))
+    guards = {}
+    for entry in module.globals:
+        guards.setdefault(entry.guard, []).append((entry.attr, entry.value))
+    yield from ustubby.iter_module_definition(module.name, guards.pop(None, []), guards.items())
+
+
+def diff(old: Node, new: Node) -> List[str]:
+    """
+    :return: One line per field that differs between two nodes, such as "functions.1.ret.annotation: int -> float"
+    """
+    changes = []
+
+    def walk(path, a, b):
+        if isinstance(a, dict) and isinstance(b, dict):
+            for key in dict.fromkeys([*a, *b]):
+                walk(f"{path}.{key}" if path else key, a.get(key), b.get(key))
+        elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+            for index, (x, y) in enumerate(zip(a, b)):
+                walk(f"{path}.{index}", x, y)
+        elif a != b:
+            changes.append(f"{path}: {a!r} -> {b!r}")
+
+    walk("", old.as_dict(), new.as_dict())
+    return changes
+
+
+from ustubby import classes, instrument as instrumentation, vectorise
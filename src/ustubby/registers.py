@@ -0,0 +1,621 @@
+"""
+Compact register maps that generate C directly, without building python functions for each register.
+
+parse_csv creates two python functions per register and stub_module rediscovers and sorts them, which is slow and
+memory hungry for large SoCs. RegisterMap stores the rows in arrays and iter_stub_registers emits the accessors in a
+single pass in file order.
+"""
+import array as array_module
+import itertools
+import types
+from array import array
+from typing import Dict, Iterable, Iterator, List, NamedTuple
+
+import ustubby
+from ustubby import importers
+
+ACCESS_MODES = ("ro", "rw", "wo")
+
+OBJINT_INCLUDE = '#include "py/objint.h"'
+
+# Bytes between the bus addresses of consecutive CSR words, CONFIG_CSR_ALIGNMENT / 8 on LiteX
+CSR_STRIDE = 4
+
+# Bits of a CSR word a register map may have, LiteX's csr_data_width. The burst functions copy a word per uint32_t.
+CSR_DATA_WIDTHS = (8, 16, 32)
+
+# LiteX csr.csv constant row giving the data width, CONFIG_CSR_DATA_WIDTH in generated/csr.h
+DATA_WIDTH_CONSTANT = "config_csr_data_width"
+
+BURST_CHECK = """\tsize_t count = buf_len / mp_binary_get_size('@', buf_bufinfo.typecode, NULL);
+\tif (count > {words}) {{
+\t\tmp_raise_ValueError(MP_ERROR_TEXT("buffer longer than the registers"));
+\t}}
+"""
+
+BURST_READ = BURST_CHECK + """\tfor (size_t i = 0; i < count; i++) {{
+\t\tuint32_t value = csr_read_simple({address} + i * {stride});
+\t\tif (buf_bufinfo.typecode == 'I') {{
+\t\t\t((unsigned int *)buf)[i] = value;
+\t\t}} else {{
+\t\t\tmp_binary_set_val_array_from_int(buf_bufinfo.typecode, buf, i, value);
+\t\t}}
+\t}}"""
+
+BURST_WRITE = BURST_CHECK + """\tfor (size_t i = 0; i < count; i++) {{
+\t\tuint32_t value = buf_bufinfo.typecode == 'I' ? ((const unsigned int *)buf)[i] :
+\t\t\t(uint32_t)mp_obj_get_int_truncated(mp_binary_get_val_array(buf_bufinfo.typecode, buf_bufinfo.buf, i));
+\t\tcsr_write_simple(value, {address} + i * {stride});
+\t}}"""
+
+BURST_VIEW = """#if MICROPY_PY_BUILTINS_MEMORYVIEW
+\treturn mp_obj_new_memoryview({typecode}, {words}, (void *)(uintptr_t){address});
+#else
+\tmp_raise_NotImplementedError(MP_ERROR_TEXT("memoryview not enabled"));
+#endif"""
+
+READ_TEMPLATE = """
+//:return: value from {name} @ register {address}
+STATIC mp_obj_t {module}_{name}_read() {{
+    mp_int_t ret_val;
+
+    ret_val = {name}_read();
+
+    return mp_obj_new_int(ret_val);
+}}
+MP_DEFINE_CONST_FUN_OBJ_0({module}_{name}_read_obj, {module}_{name}_read);"""
+
+WRITE_TEMPLATE = """
+//writes a value to {name} @ register {address}
+STATIC mp_obj_t {module}_{name}_write(mp_obj_t value_obj) {{
+    mp_int_t value = mp_obj_get_int(value_obj);
+
+    {name}_write(value);
+
+    return mp_const_none;
+}}
+MP_DEFINE_CONST_FUN_OBJ_1({module}_{name}_write_obj, {module}_{name}_write);"""
+
+
+TABLE_HEADER = """
+#ifndef USTUBBY_CSR_DATA_WIDTH
+#define USTUBBY_CSR_DATA_WIDTH {data_width}
+#endif
+#ifndef USTUBBY_CSR_STRIDE
+#define USTUBBY_CSR_STRIDE 4
+#endif
+#ifndef USTUBBY_CSR_READ
+#define USTUBBY_CSR_READ(addr) csr_read_simple(addr)
+#endif
+#ifndef USTUBBY_CSR_WRITE
+#define USTUBBY_CSR_WRITE(value, addr) csr_write_simple(value, addr)
+#endif
+#define USTUBBY_CSR_READABLE (1)
+#define USTUBBY_CSR_WRITABLE (2)
+
+typedef struct _{module}_register_t {{
+    uint32_t address;
+    uint8_t length;
+    uint8_t access;
+}} {module}_register_t;
+
+STATIC const {module}_register_t {module}_registers[] = {{"""
+
+TABLE_ROW = "    {{ 0x{address:08x}, {length}, {access} }}, // {name}"
+
+TABLE_ACCESS = {
+    "ro": "USTUBBY_CSR_READABLE",
+    "rw": "USTUBBY_CSR_READABLE | USTUBBY_CSR_WRITABLE",
+    "wo": "USTUBBY_CSR_WRITABLE",
+}
+
+# Largest address and length a table entry holds, being a uint32_t and a uint8_t
+TABLE_MAX_ADDRESS = 0xFFFFFFFF
+TABLE_MAX_LENGTH = 0xFF
+
+TABLE_ACCESSORS = """}};
+
+STATIC const {module}_register_t *{module}_lookup(mp_obj_t index_obj, uint8_t access) {{
+    mp_uint_t index = mp_obj_get_int(index_obj);
+    if (index >= MP_ARRAY_SIZE({module}_registers)) {{
+        mp_raise_ValueError(MP_ERROR_TEXT("register index out of range"));
+    }}
+    const {module}_register_t *reg = &{module}_registers[index];
+    if (!(reg->access & access)) {{
+        mp_raise_ValueError(MP_ERROR_TEXT("register access not allowed"));
+    }}
+    return reg;
+}}
+
+//Reads the register at index, assembling multi word registers most significant word first
+//:param index: Register index constant such as {module}.{example}
+//:return: register value
+STATIC mp_obj_t {module}_read(mp_obj_t index_obj) {{
+    const {module}_register_t *reg = {module}_lookup(index_obj, USTUBBY_CSR_READABLE);
+    uint64_t ret_val = 0;
+    for (size_t i = 0; i < reg->length; i++) {{
+        ret_val = (ret_val << USTUBBY_CSR_DATA_WIDTH) | USTUBBY_CSR_READ(reg->address + i * USTUBBY_CSR_STRIDE);
+    }}
+    return mp_obj_new_int_from_ull(ret_val);
+}}
+MP_DEFINE_CONST_FUN_OBJ_1({module}_read_obj, {module}_read);
+
+//Writes value to the register at index, splitting multi word registers most significant word first
+//:param index: Register index constant such as {module}.{example}
+//:param value: value to write
+STATIC mp_obj_t {module}_write(mp_obj_t index_obj, mp_obj_t value_obj) {{
+    const {module}_register_t *reg = {module}_lookup(index_obj, USTUBBY_CSR_WRITABLE);
+    uint64_t value;
+    if (mp_obj_is_small_int(value_obj)) {{
+        value = (uint64_t)MP_OBJ_SMALL_INT_VALUE(value_obj);
+    }} else if (!mp_obj_is_int(value_obj)) {{
+        mp_raise_TypeError(MP_ERROR_TEXT("register value must be an int"));
+    }} else {{
+        mp_obj_int_to_bytes_impl(value_obj, MP_ENDIANNESS_BIG, sizeof(value), (byte *)&value);
+    }}
+    for (size_t i = reg->length; i-- > 0;) {{
+        USTUBBY_CSR_WRITE(value & ((1ULL << USTUBBY_CSR_DATA_WIDTH) - 1), reg->address + i * USTUBBY_CSR_STRIDE);
+        value >>= USTUBBY_CSR_DATA_WIDTH;
+    }}
+    return mp_const_none;
+}}
+MP_DEFINE_CONST_FUN_OBJ_2({module}_write_obj, {module}_write);"""
+
+
+class Register(NamedTuple):
+    name: str
+    address: int
+    length: int
+    access: str
+
+    @property
+    def readable(self) -> bool:
+        return self.access in ("ro", "rw")
+
+    @property
+    def writable(self) -> bool:
+        return self.access in ("rw", "wo")
+
+    @property
+    def hex_address(self) -> str:
+        return f"0x{self.address:08x}"
+
+
+class Field(NamedTuple):
+    """
+    Bits of a register accessed on their own, bit offset 0 being the least significant bit
+    """
+    register: str
+    name: str
+    offset: int
+    width: int
+
+    @property
+    def mask(self) -> int:
+        return (1 << self.width) - 1
+
+
+class Run(NamedTuple):
+    """
+    Registers at consecutive CSR words, accessed together by the burst functions.
+    Only the ends of the run are kept, so a run spanning the whole map stays small.
+    """
+    name: str
+    address: int
+    words: int
+    writable: bool
+    last: str
+
+
+def burst_funcs(run: Run, readable: bool, mod: str = "csr", stride: int = CSR_STRIDE) -> List:
+    """
+    Python functions copying the words of a run into or out of a buffer in one call, in the form of register_func
+    :param readable: The run is of readable registers, giving burst_read and a memoryview over the registers with
+        burst_view, otherwise of writable registers giving burst_write
+    """
+    words, address = run.words, f"0x{run.address:08x}"
+    span = f"{run.name} @ register {address} to {run.last}"
+
+    def read_func(buf: ustubby.Out[array_module.array]) -> None:
+        pass
+
+    def write_func(buf: memoryview) -> None:
+        pass
+
+    def view_func() -> None:
+        pass
+
+    # The module uses postponed annotations so the real types have to be set for inspect.signature
+    read_func.__annotations__ = {"buf": ustubby.Out[array_module.array], "return": None}
+    write_func.__annotations__ = {"buf": memoryview, "return": None}
+    view_func.__annotations__ = {"return": None}
+
+    read_func.__doc__ = f"""reads up to {words} words from {span} into buf, one word per element
+    :return: buf"""
+    read_func.code = BURST_READ.format(words=words, address=address, stride=stride)
+    read_func.includes = ('#include "py/binary.h"',)
+    write_func.__doc__ = f"""writes the elements of buf to up to {words} words from {span}"""
+    write_func.code = BURST_WRITE.format(words=words, address=address, stride=stride)
+    write_func.includes = ('#include "py/binary.h"',)
+    typecode = "MP_OBJ_ARRAY_TYPECODE_FLAG_RW | 'I'" if run.writable else "'I'"
+    access = "reading and writing" if run.writable else "reading"
+    view_func.__doc__ = f""":return: memoryview of the {words} words from {span}, {access} the registers"""
+    view_func.code = BURST_VIEW.format(typecode=typecode, words=words, address=address)
+    view_func.includes = ('#include "py/objarray.h"',)
+
+    funcs = [(read_func, "read"), (view_func, "view")] if readable else [(write_func, "write")]
+    for func, suffix in funcs:
+        func.__name__ = func.__qualname__ = f"{run.name}_burst_{suffix}"
+        func.__module__ = mod
+    return [func for func, _ in funcs]
+
+
+def field_funcs(register: Register, field: Field, mod: str = "csr", data_width: int = importers.WORD_BITS) -> List:
+    """
+    Python functions shifting and masking one field of a register in C, in the form of register_func.
+    Writing a field of a rw register reads the register and writes it back with the other bits kept, writing a field of
+    a wo register clears the other bits. Fields of multi word registers or wider than 31 bits go through uint64_t.
+    :param data_width: Bits in each of the register's words
+    :raises ValueError: if the field doesn't fit in the register
+    """
+    wide = register.length > 1
+    # Registers are read into a uint64_t, so longer ones only have their low 64 bits
+    bits = min(register.length * data_width, 64)
+    if field.offset < 0 or field.width < 1 or field.offset + field.width > bits:
+        raise ValueError(f"Field {field.name} of {register.name} doesn't fit in its {bits} bits")
+    name, reg = f"{register.name}_{field.name}", register.name
+    c_type = "uint64_t" if wide or field.offset + field.width > 32 else "uint32_t"
+    mask = f"0x{field.mask:x}{'ULL' if c_type == 'uint64_t' else 'u'}"
+    bits = f"bits {field.offset} to {field.offset + field.width - 1}"
+
+    def read_func() -> int:
+        pass
+
+    def write_func(value: int) -> None:
+        pass
+
+    # The module uses postponed annotations so the real types have to be set for inspect.signature
+    read_func.__annotations__ = {"return": int}
+    write_func.__annotations__ = {"value": int, "return": None}
+
+    read_func.__doc__ = f""":return: {field.name} field of {reg} @ register {register.hex_address}, {bits}"""
+    extract = f"({reg}_read() >> {field.offset}) & {mask}"
+    value = f"({c_type})value"
+    if field.width > 31:
+        # The field may not fit in an mp_int_t
+        read_func.__annotations__ = {"return": None}
+        read_func.code = f"\tuint64_t ret_val = {extract};"
+        read_func.return_value = "\treturn mp_obj_new_int_from_ull(ret_val);"
+        write_func.__annotations__ = {"value": object, "return": None}
+        write_func.includes = (OBJINT_INCLUDE,)
+        value = "field_value"
+    else:
+        read_func.code = f"\tret_val = {extract};"
+    update = f"(({value} & {mask}) << {field.offset})"
+    if register.readable:
+        write_func.__doc__ = f"""writes value to the {field.name} field of {reg} @ register {register.hex_address}, \
+{bits}, keeping the other bits"""
+        update = f"({reg}_read() & ~({mask} << {field.offset})) | {update}"
+    else:
+        write_func.__doc__ = f"""writes value to the {field.name} field of {reg} @ register {register.hex_address}, \
+{bits}, clearing the other bits"""
+    write_func.code = f"\t{reg}_write({update});"
+    if field.width > 31:
+        write_func.code = ustubby.wide_unpack("field_value", "value") + "\n" + write_func.code
+
+    funcs = [(read_func, "read")] if register.readable else []
+    funcs += [(write_func, "write")] if register.writable else []
+    for func, suffix in funcs:
+        func.__name__ = func.__qualname__ = f"{name}_{suffix}"
+        func.__module__ = mod
+    return [func for func, _ in funcs]
+
+
+class RegisterMap:
+    """
+    Table of registers stored column wise.
+    Names are packed into one buffer so each register costs its name plus a few bytes.
+    The data width is the number of bits in a CSR word, which bounds the fields in both register modes and is the
+    word size the table accessors assemble registers from.
+    """
+    __slots__ = ("name", "_names", "_offsets", "addresses", "lengths", "_access", "fields", "_data_width")
+
+    def __init__(self, name: str = "csr", data_width: int = importers.WORD_BITS):
+        self.name = name
+        self.data_width = data_width
+        self._names = bytearray()
+        self._offsets = array("L", [0])
+        self.addresses = array("Q")
+        self.lengths = array("L")
+        self._access = bytearray()
+        self.fields: Dict[str, List[Field]] = {}
+
+    def append(self, name: str, address: int, length: int = 1, access: str = "rw") -> None:
+        """
+        :param name: Register name, used in the C function names
+        :param address: Bus address
+        :param length: Number of CSR words making up the register
+        :param access: One of ro, rw or wo
+        """
+        self._access.append(ACCESS_MODES.index(access))
+        self._names += name.encode()
+        self._offsets.append(len(self._names))
+        self.addresses.append(address)
+        self.lengths.append(length)
+
+    def append_field(self, register: str, name: str, offset: int, width: int) -> None:
+        """
+        :param register: Name of the register holding the field
+        :param name: Field name, the accessors are named {register}_{name}_read and {register}_{name}_write
+        :param offset: Position of the least significant bit of the field
+        :param width: Number of bits
+        """
+        self.fields.setdefault(register, []).append(Field(register, name, offset, width))
+
+    @property
+    def data_width(self) -> int:
+        return self._data_width
+
+    @data_width.setter
+    def data_width(self, bits: int) -> None:
+        """
+        :raises ValueError: if bits isn't one of CSR_DATA_WIDTHS
+        """
+        if bits not in CSR_DATA_WIDTHS:
+            raise ValueError(f"CSR data width {bits} isn't one of {', '.join(map(str, CSR_DATA_WIDTHS))}")
+        self._data_width = bits
+
+    def name_of(self, index: int) -> str:
+        return self._names[self._offsets[index]:self._offsets[index + 1]].decode()
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def __getitem__(self, index: int) -> Register:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("register index out of range")
+        return Register(self.name_of(index), self.addresses[index], self.lengths[index],
+                        ACCESS_MODES[self._access[index]])
+
+    def __iter__(self) -> Iterator[Register]:
+        names, offsets = self._names, self._offsets
+        for index, (address, length, access) in enumerate(zip(self.addresses, self.lengths, self._access)):
+            yield Register(names[offsets[index]:offsets[index + 1]].decode(), address, length, ACCESS_MODES[access])
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[str]], module_name: str = "csr") -> "RegisterMap":
+        """
+        Reads csr_register and csr_field rows in the form of a LiteX csr.csv one row at a time, and the data width from
+        its config_csr_data_width constant row if it has one, ignoring other rows
+        :param module_name: Name of the generated module
+        :return: New register map
+        """
+        regmap = cls(module_name)
+        for row in rows:
+            if row and row[0] == "csr_register":
+                _, name, address, length, access = row[:5]
+                regmap.append(name, int(address, 0), int(length or 1), access)
+            elif row and row[0] == "csr_field":
+                _, register, name, offset, width = row[:5]
+                regmap.append_field(register, name, int(offset, 0), int(width, 0))
+            elif row and row[0] == "constant" and row[1] == DATA_WIDTH_CONSTANT:
+                regmap.data_width = int(row[2], 0)
+        return regmap
+
+    @classmethod
+    def from_csv(cls, path, module_name: str = "csr") -> "RegisterMap":
+        """
+        Reads the csr_register and csr_field rows of a LiteX csr.csv one row at a time
+        :param path: Path of the csv file
+        :param module_name: Name of the generated module
+        :return: New register map
+        """
+        return cls.from_rows(importers.iter_csv(path), module_name)
+
+    @classmethod
+    def from_file(cls, path, module_name: str = "csr") -> "RegisterMap":
+        """
+        Reads a LiteX csr.csv, CMSIS-SVD or JSON register map going by its suffix, see ustubby.importers
+        :raises ValueError: if the suffix isn't one of importers.READERS
+        """
+        return cls.from_rows(importers.read_rows(path), module_name)
+
+    def address_order(self) -> Iterable[int]:
+        """
+        :return: Register indices in address order, only sorting them if the rows aren't in address order already
+        """
+        addresses = self.addresses
+        if all(addresses[i] <= addresses[i + 1] for i in range(len(addresses) - 1)):
+            return range(len(addresses))
+        return array("L", sorted(range(len(addresses)), key=addresses.__getitem__))
+
+    def runs(self, readable: bool, stride: int = CSR_STRIDE) -> Iterator[Run]:
+        """
+        Finds the registers at consecutive CSR words, going by their addresses and lengths.
+        The rows are streamed when they are in address order, otherwise an array of indices is sorted.
+        :param readable: Runs of readable registers, otherwise of writable registers
+        :param stride: Bytes between the addresses of consecutive words
+        :return: Every run of more than one register in address order
+        """
+        modes = {ACCESS_MODES.index(mode) for mode in (("ro", "rw") if readable else ("rw", "wo"))}
+        writable = ACCESS_MODES.index("rw"), ACCESS_MODES.index("wo")
+        first = last = None
+        count = words = 0
+        all_writable = True
+        end = None
+        for index in self.address_order():
+            access = self._access[index]
+            if access not in modes:
+                continue
+            address, length = self.addresses[index], self.lengths[index]
+            if address != end:
+                if count > 1:
+                    yield Run(self.name_of(first), self.addresses[first], words, all_writable, self.name_of(last))
+                first, count, words, all_writable = index, 0, 0, True
+            last = index
+            count += 1
+            words += length
+            all_writable = all_writable and access in writable
+            end = address + length * stride
+        if count > 1:
+            yield Run(self.name_of(first), self.addresses[first], words, all_writable, self.name_of(last))
+
+    def burst_funcs(self) -> Iterator:
+        """
+        :return: The burst functions of every run, see burst_funcs
+        """
+        for readable in (True, False):
+            for run in self.runs(readable):
+                yield from burst_funcs(run, readable, self.name)
+
+    def register_field_funcs(self, register: Register) -> List:
+        """
+        :return: The accessors of every field of register, see field_funcs
+        """
+        return [func for field in self.fields.get(register.name, ())
+                for func in field_funcs(register, field, self.name, self.data_width)]
+
+    def check_fields(self) -> None:
+        """
+        :raises ValueError: if a field names a register that isn't in the map
+        """
+        missing = set(self.fields).difference(self.name_of(index) for index in range(len(self)))
+        if missing:
+            raise ValueError(f"Fields of unknown registers {', '.join(sorted(missing))}")
+
+    def field_funcs(self) -> Iterator:
+        """
+        :return: The field accessors of every register
+        :raises ValueError: if a field names a register that isn't in the map
+        """
+        self.check_fields()
+        for register in self:
+            if register.name in self.fields:
+                yield from self.register_field_funcs(register)
+
+    def to_module(self) -> types.ModuleType:
+        """
+        :return: Module of read and write functions in the form produced by parse_csv
+        """
+        mod = types.ModuleType(self.name)
+        for register in self:
+            funcs = ustubby.register_func(register.name, register.hex_address, register.length, register.access,
+                                          self.name)
+            for func in funcs:
+                setattr(mod, func.__name__, func)
+        for func in itertools.chain(self.field_funcs(), self.burst_funcs()):
+            setattr(mod, func.__name__, func)
+        return mod
+
+
+def iter_stub_registers(regmap: RegisterMap):
+    """
+    Generates the c source of a register map module in chunks, one chunk per accessor.
+    Joining the chunks with newlines gives stub_registers(regmap).
+    Multi word registers and fields go through stub_function like parse_csv, being few.
+    The registers are streamed from the map's arrays and the burst functions made one run at a time, so nothing
+    grows with the map beyond the map itself, and a sorted array of indices if its rows are out of address order.
+    """
+    module = regmap.name
+    regmap.check_fields()
+    includes = list(burst_includes(regmap))
+    if any(length > 1 for length in regmap.lengths) or \
+            any(field.width > 31 for fields in regmap.fields.values() for field in fields):
+        includes.append(OBJINT_INCLUDE)
+    yield ustubby.module_doc(types.ModuleType(module))
+    yield ustubby.headers()
+    yield from dict.fromkeys(includes)
+    yield '#include "generated/csr.h"'
+    for register in regmap:
+        if register.length > 1:
+            for func in ustubby.register_func(register.name, register.hex_address, register.length,
+                                              register.access, module):
+                yield ustubby.stub_function(func)
+        else:
+            if register.readable:
+                yield READ_TEMPLATE.format(name=register.name, address=register.hex_address, module=module)
+            if register.writable:
+                yield WRITE_TEMPLATE.format(name=register.name, address=register.hex_address, module=module)
+        if register.name in regmap.fields:
+            for func in regmap.register_field_funcs(register):
+                yield ustubby.stub_function(func)
+    for func in regmap.burst_funcs():
+        yield ustubby.stub_function(func)
+    yield from ustubby.iter_module_definition(module, iter_members(regmap, regmap.burst_funcs()))
+
+
+def burst_includes(regmap: RegisterMap) -> Iterator[str]:
+    """
+    :return: The includes of the burst functions, going by the first run of each kind
+    """
+    for readable in (True, False):
+        run = next(regmap.runs(readable), None)
+        if run is not None:
+            yield from (include for func in burst_funcs(run, readable, regmap.name) for include in func.includes)
+
+
+def iter_field_members(regmap: RegisterMap, register: Register):
+    for field in regmap.fields.get(register.name, ()):
+        name = f"{register.name}_{field.name}"
+        for suffix, enabled in (("read", register.readable), ("write", register.writable)):
+            if enabled:
+                yield f"{name}_{suffix}", f"MP_ROM_PTR(&{regmap.name}_{name}_{suffix}_obj)"
+
+
+def iter_burst_members(bursts: Iterable):
+    for func in bursts:
+        yield func.__name__, f"MP_ROM_PTR(&{ustubby.c_name(func)}_obj)"
+
+
+def iter_members(regmap: RegisterMap, bursts: Iterable = ()):
+    for register in regmap:
+        for suffix, enabled in (("read", register.readable), ("write", register.writable)):
+            if enabled:
+                yield f"{register.name}_{suffix}", f"MP_ROM_PTR(&{regmap.name}_{register.name}_{suffix}_obj)"
+        yield from iter_field_members(regmap, register)
+    yield from iter_burst_members(bursts)
+
+
+def stub_registers(regmap: RegisterMap) -> str:
+    return "\n".join(iter_stub_registers(regmap))
+
+
+def iter_stub_register_table(regmap: RegisterMap):
+    """
+    Generates a register map module with one const table of registers and generic read(index) and write(index, value)
+    accessors. Each register costs a table entry and an index constant rather than two function objects.
+    The field accessors and burst functions are the same functions as in iter_stub_registers, being few.
+    :raises ValueError: if a register's address or length doesn't fit its table entry, or a field names a register
+        that isn't in the map
+    """
+    module = regmap.name
+    regmap.check_fields()
+    example = regmap[0].name.upper() if len(regmap) else "REGISTER"
+    yield ustubby.module_doc(types.ModuleType(module))
+    yield ustubby.headers()
+    yield from dict.fromkeys([OBJINT_INCLUDE, *burst_includes(regmap)])
+    yield '#include "generated/csr.h"'
+    yield TABLE_HEADER.format(module=module, data_width=regmap.data_width)
+    for register in regmap:
+        if register.address > TABLE_MAX_ADDRESS:
+            raise ValueError(f"{register.name} address {register.address:#x} doesn't fit a 32 bit table entry")
+        if register.length > TABLE_MAX_LENGTH:
+            raise ValueError(f"{register.name} length {register.length} doesn't fit an 8 bit table entry")
+        yield TABLE_ROW.format(address=register.address, length=register.length,
+                               access=TABLE_ACCESS[register.access], name=register.name)
+    yield TABLE_ACCESSORS.format(module=module, example=example)
+    for func in itertools.chain(regmap.field_funcs(), regmap.burst_funcs()):
+        yield ustubby.stub_function(func)
+    members = [("read", f"MP_ROM_PTR(&{module}_read_obj)"), ("write", f"MP_ROM_PTR(&{module}_write_obj)")]
+    fields = (member for register in regmap if register.name in regmap.fields
+              for member in iter_field_members(regmap, register))
+    yield from ustubby.iter_module_definition(
+        module, itertools.chain(members, ((register.name.upper(), f"MP_ROM_INT({index})")
+                                          for index, register in enumerate(regmap)),
+                                fields, iter_burst_members(regmap.burst_funcs())))
+
+
+def stub_register_table(regmap: RegisterMap) -> str:
+    return "\n".join(iter_stub_register_table(regmap))
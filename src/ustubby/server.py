@@ -0,0 +1,200 @@
+"""
+Long running generation server for build systems.
+
+Make and CMake run a generator once per target, and each run pays for starting python and importing ustubby.
+The server instead stays up and answers requests over a Unix domain socket, keeping the modules and register maps it
+has loaded in memory. Entries are checked against the modification time and size of their file on every request and
+the least recently used ones are dropped once there are more than max_entries.
+
+    python -m ustubby.server --socket /tmp/ustubby.sock
+
+Requests are sent by ustubby.client, one JSON object per line and connection, see client.request for the fields.
+Every connection is accepted straight away and answered from its own thread, while the generation itself runs one
+request at a time.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import ustubby
+from ustubby import batch, client, static, watch
+from ustubby.cache import Cache
+from ustubby.registers import RegisterMap
+
+DEFAULT_MAX_ENTRIES = 256
+
+# Connections waiting to be accepted, enough for the parallel jobs of a large build
+REQUEST_QUEUE_SIZE = 128
+
+
+class WarmCache:
+    """
+    Least recently used store of loaded inputs, each entry kept alongside the stamp of the file it was loaded from
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, evict: Callable[[Hashable, Any], None] = None):
+        """
+        :param evict: Called with the key and value of every entry dropped to stay within max_entries
+        """
+        self.max_entries = max_entries
+        self.evict = evict
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, stamp, load: Callable[[], Any]):
+        """
+        :param stamp: Current stamp of the file, the entry is loaded again if it was stored with another one
+        :param load: Loads the value on a miss
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        value = load()
+        self.entries[key] = (stamp, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            old_key, (_, old_value) = self.entries.popitem(last=False)
+            if self.evict is not None:
+                self.evict(old_key, old_value)
+        return value
+
+
+def forget_module(key, value) -> None:
+    """
+    Drops an evicted module from sys.modules too, unless it was replaced since
+    """
+    if getattr(value, "__name__", None) in sys.modules and sys.modules[value.__name__] is value:
+        del sys.modules[value.__name__]
+
+
+class Generator:
+    """
+    Generates jobs in this process, reusing loaded modules and register maps while their files are unchanged
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.warm = WarmCache(max_entries, forget_module)
+        self.caches: Dict[str, Cache] = {}
+
+    def load(self, job: batch.Job):
+        """
+        :return: The module or register map for the job's input
+        """
+        path = job.input
+        if batch.is_register_map(path):
+            return self.warm.get((path, "registers"), watch.stamp(path), lambda: RegisterMap.from_file(path, path.stem))
+        if job.static:
+            return self.warm.get((path, "static"), watch.stamp(path), lambda: static.load_module(path))
+        return self.warm.get((path, "import"), watch.stamp(path), lambda: batch.import_module(path, reload=True))
+
+    def stub(self, job: batch.Job):
+        source = self.load(job)
+        if batch.is_register_map(job.input):
+            return batch.REGISTER_MODES[job.register_mode](source)
+        return batch.iter_stub_loaded(job, source)
+
+    def generate(self, job: batch.Job, cache_dir: Optional[str] = None) -> batch.Result:
+        cache = None
+        if cache_dir is not None:
+            cache = self.caches.setdefault(cache_dir, Cache(Path(cache_dir)))
+        return batch._generate(job, cache, self.stub)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        stop = False
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("stop"):
+                stop = True
+                response = {"error": None}
+            else:
+                job = client.job(request)
+                with self.server.lock:
+                    result = self.server.generator.generate(job, request.get("cache_dir"))
+                response = {"error": result.error, "cached": result.cached, "written": result.written}
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        if stop:
+            self.server.shutdown()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts connections from a thread each, but generates one request at a time under lock, as importing modules
+    changes sys.modules and sys.path for the whole process
+    """
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        remove_stale_socket(path)
+        super().__init__(path, Handler)
+        self.generator = Generator(max_entries)
+        self.lock = threading.Lock()
+
+    def serve_until_stopped(self) -> None:
+        """
+        Serves until a stop request, closing and removing the socket once the requests being handled are answered
+        """
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+
+def remove_stale_socket(path: str) -> None:
+    """
+    Removes a socket file left behind by a server that is no longer running
+    :raises RuntimeError: if a server is still answering on path, or path isn't a socket
+    """
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise RuntimeError(f"{path} exists and isn't a socket, not removing it")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise RuntimeError(f"A server is already running on {path}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serves ustubby generation requests over a Unix domain socket.")
+    parser.add_argument("--socket", default=client.default_socket(),
+                        help="Path of the socket to listen on. Defaults to $USTUBBY_SOCKET or a per user path in "
+                             "the temporary directory.")
+    parser.add_argument("--max-entries", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="Loaded modules and register maps to keep in memory.")
+    args = parser.parse_args(argv)
+    try:
+        server = Server(args.socket, args.max_entries)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    print(f"Serving on {args.socket}")
+    try:
+        server.serve_until_stopped()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
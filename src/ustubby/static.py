@@ -0,0 +1,252 @@
+"""
+Load modules by parsing their source with ast instead of importing them.
+
+No code in the module is executed, so generating stubs has no side effects and works for modules that import
+MicroPython only packages such as machine. Functions and classes are rebuilt as stand ins carrying the same name,
+docstring, signature and attributes as the real objects so they can be used anywhere a loaded module can.
+"""
+import ast
+import builtins
+import importlib
+import inspect
+import types
+from pathlib import Path
+from typing import Dict, Optional
+
+import ustubby
+
+# Modules which may be referenced by annotations and decorators. Importing these has no side effects.
+ANNOTATION_MODULES = ("typing", "array", "ustubby")
+
+# Nodes allowed in annotations and decorators, anything else could execute code when evaluated
+SAFE_NODES = (ast.Expression, ast.Name, ast.Attribute, ast.Subscript, ast.Tuple, ast.List, ast.Constant, ast.Load,
+              ast.Call, ast.keyword) + ((ast.Index,) if hasattr(ast, "Index") else ())
+
+
+def safe_call(func) -> bool:
+    """
+    :return: func may be called while resolving, only return_mode which makes a decorator without running anything
+    """
+    return func is ustubby.return_mode
+
+
+def safe_decorator(decorator) -> bool:
+    return decorator is ustubby.small_int or decorator is ustubby.many
+
+
+def safe_subscript(value) -> bool:
+    """
+    :return: value may be subscripted while resolving, being Out, SmallInt, a typing generic or a builtin type
+    """
+    return value is ustubby.Out or value is ustubby.SmallInt or getattr(value, "__module__", None) == "typing" or \
+        (isinstance(value, type) and value.__module__ == "builtins")
+
+
+def _stub(*args, **kwargs):
+    pass
+
+
+def segment(source: str, node: ast.expr) -> str:
+    return (source and ast.get_source_segment(source, node)) or ast.dump(node)
+
+
+def base_namespace() -> Dict[str, object]:
+    return {name: value for name, value in vars(builtins).items() if isinstance(value, type)}
+
+
+def import_namespace(tree: ast.Module) -> Dict[str, object]:
+    """
+    Binds the names imported from ANNOTATION_MODULES at the top level of a module
+    :param tree: Parsed module
+    :return: Namespace to resolve annotations in
+    """
+    namespace = base_namespace()
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name in ANNOTATION_MODULES:
+                    namespace[alias.asname or alias.name] = importlib.import_module(alias.name)
+        elif isinstance(node, ast.ImportFrom) and node.module in ANNOTATION_MODULES and not node.level:
+            module = importlib.import_module(node.module)
+            for alias in node.names:
+                if alias.name != "*" and hasattr(module, alias.name):
+                    namespace[alias.asname or alias.name] = getattr(module, alias.name)
+    return namespace
+
+
+def resolve(node: ast.expr, namespace: Dict[str, object], source: str = ""):
+    """
+    Evaluates an annotation or decorator expression without running any module code.
+    The only call allowed is to return_mode, and only Out, SmallInt, typing generics and builtin types can be
+    subscripted, see safe_call and safe_subscript.
+    :param node: Expression node
+    :param namespace: Names from import_namespace
+    :param source: Module source, used for error messages
+    :return: The resolved python object
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        node = ast.parse(node.value, mode="eval").body
+    expression = ast.Expression(body=node)
+
+    def text():
+        # Only found for errors, as finding a segment splits the whole source
+        return segment(source, node)
+
+    for child in ast.walk(expression):
+        if not isinstance(child, SAFE_NODES):
+            raise ValueError(f"Unsupported expression {text()}")
+        if isinstance(child, ast.Call) and not safe_call(resolve(child.func, namespace, source)):
+            raise ValueError(f"Only ustubby.return_mode can be called, not {text()}")
+        if isinstance(child, ast.Subscript) and not safe_subscript(resolve(child.value, namespace, source)):
+            raise ValueError(f"Only Out, SmallInt, typing generics and builtin types can be subscripted, not {text()}")
+    ast.fix_missing_locations(expression)
+    try:
+        return eval(compile(expression, "<annotation>", "eval"), {"__builtins__": {}}, namespace)
+    except NameError as e:
+        raise ValueError(f"Cannot resolve {text()}: {e}") from None
+
+
+def literal(node: ast.expr, source: str = ""):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise ValueError(f"Default {segment(source, node)} must be a literal") from None
+
+
+def parameters_from_ast(node: ast.arguments, namespace: Dict[str, object], source: str = "") -> Dict[str, inspect.Parameter]:
+    """
+    :param node: Arguments of a function definition
+    :param namespace: Names from import_namespace
+    :param source: Module source, used for error messages
+    :return: Parameters in the same form as inspect.signature(...).parameters
+    """
+    def annotation(arg):
+        if arg.annotation is None:
+            return inspect.Parameter.empty
+        return resolve(arg.annotation, namespace, source)
+
+    positional = [(arg, inspect.Parameter.POSITIONAL_ONLY) for arg in getattr(node, "posonlyargs", [])]
+    positional += [(arg, inspect.Parameter.POSITIONAL_OR_KEYWORD) for arg in node.args]
+    defaults = [inspect.Parameter.empty] * (len(positional) - len(node.defaults)) + node.defaults
+    params = [inspect.Parameter(arg.arg, kind, annotation=annotation(arg),
+                                default=default if default is inspect.Parameter.empty else literal(default, source))
+              for (arg, kind), default in zip(positional, defaults)]
+    if node.vararg:
+        params.append(inspect.Parameter(node.vararg.arg, inspect.Parameter.VAR_POSITIONAL,
+                                        annotation=annotation(node.vararg)))
+    for arg, default in zip(node.kwonlyargs, node.kw_defaults):
+        params.append(inspect.Parameter(arg.arg, inspect.Parameter.KEYWORD_ONLY, annotation=annotation(arg),
+                                        default=inspect.Parameter.empty if default is None else literal(default, source)))
+    if node.kwarg:
+        params.append(inspect.Parameter(node.kwarg.arg, inspect.Parameter.VAR_KEYWORD,
+                                        annotation=annotation(node.kwarg)))
+    return {param.name: param for param in params}
+
+
+def function_from_ast(node: ast.FunctionDef, module: str, namespace: Optional[Dict[str, object]] = None,
+                      source: str = "", qualname: Optional[str] = None):
+    """
+    Builds a stand in function with the signature and docstring of a function definition
+    :param node: Function definition
+    :param module: Name of the module the function belongs to
+    :param namespace: Names from import_namespace. Defaults to the builtin types.
+    :param source: Module source, used for error messages
+    :param qualname: Qualified name, defaults to the function name
+    :return: Function that inspect.signature understands
+    """
+    if namespace is None:
+        namespace = base_namespace()
+    parameters = parameters_from_ast(node.args, namespace, source)
+    returns = inspect.Signature.empty if node.returns is None else resolve(node.returns, namespace, source)
+    f = types.FunctionType(_stub.__code__, {}, node.name)
+    f.__qualname__ = qualname or node.name
+    f.__module__ = module
+    f.__doc__ = ast.get_docstring(node, clean=False)
+    f.__signature__ = inspect.Signature(list(parameters.values()), return_annotation=returns)
+    for decorator in reversed(node.decorator_list):
+        f = apply_decorator(decorator, f, namespace, source)
+    return f
+
+
+def apply_decorator(node: ast.expr, f, namespace: Dict[str, object], source: str = ""):
+    """
+    Applies ustubby's own decorators, small_int, many and return_mode(...). Any other decorator, such as
+    micropython.native, is left to the device.
+    """
+    try:
+        decorator = resolve(node, namespace, source)
+    except ValueError:
+        return f
+    # The only call resolve allows is to return_mode, so a call resolved to its decorator
+    if isinstance(node, ast.Call) or safe_decorator(decorator):
+        return decorator(f)
+    return f
+
+
+def try_literal(node: ast.expr):
+    try:
+        return True, ast.literal_eval(node)
+    except (ValueError, TypeError):
+        return False, None
+
+
+def class_from_ast(node: ast.ClassDef, module: str, namespace: Dict[str, object], source: str = "") -> type:
+    """
+    Builds a stand in class holding the methods, annotations and class attributes of a class definition
+    :param node: Class definition
+    :param module: Name of the module the class belongs to
+    :param namespace: Names from import_namespace
+    :param source: Module source, used for error messages
+    :return: New class
+    """
+    body = {"__module__": module, "__doc__": ast.get_docstring(node, clean=False), "__annotations__": {}}
+    for item in node.body:
+        if isinstance(item, ast.FunctionDef):
+            body[item.name] = function_from_ast(item, module, namespace, source, f"{node.name}.{item.name}")
+        elif isinstance(item, ast.AnnAssign) and isinstance(item.target, ast.Name):
+            body["__annotations__"][item.target.id] = resolve(item.annotation, namespace, source)
+            if item.value is not None:
+                body[item.target.id] = literal(item.value, source)
+        elif isinstance(item, ast.Assign) and all(isinstance(t, ast.Name) for t in item.targets):
+            ok, value = try_literal(item.value)
+            if ok:
+                body.update((target.id, value) for target in item.targets)
+    return type(node.name, (), body)
+
+
+def load_source(source: str, name: str) -> types.ModuleType:
+    """
+    Builds a module from python source without executing it.
+    Top level functions and classes are loaded along with literal attribute assignments such as f.code = "..."
+    :param source: Python source code
+    :param name: Module name
+    :return: Module that can be passed to stub_module
+    """
+    tree = ast.parse(source)
+    namespace = import_namespace(tree)
+    mod = types.ModuleType(name, ast.get_docstring(tree, clean=False))
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            setattr(mod, node.name, function_from_ast(node, name, namespace, source))
+        elif isinstance(node, ast.ClassDef):
+            setattr(mod, node.name, class_from_ast(node, name, namespace, source))
+            # Later annotations can refer to the class, as they can once a class statement has run
+            namespace[node.name] = getattr(mod, node.name)
+        elif isinstance(node, ast.Assign):
+            ok, value = try_literal(node.value)
+            for target in node.targets:
+                if ok and isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name) \
+                        and hasattr(mod, target.value.id):
+                    setattr(getattr(mod, target.value.id), target.attr, value)
+    return mod
+
+
+def load_module(path: Path) -> types.ModuleType:
+    """
+    :param path: Python file to parse
+    :return: Module named after the file that can be passed to stub_module
+    """
+    path = Path(path)
+    mod = load_source(path.read_text(), path.stem)
+    mod.__file__ = str(path)
+    return mod
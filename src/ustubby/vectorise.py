@@ -0,0 +1,219 @@
+"""
+Batched companions of scalar functions, looping over buffers in C.
+
+A function decorated with ustubby.many, such as add_ints(a: int, b: int) -> int, is also generated as
+add_ints_many(out, a, b). The companion runs the function's body once per element of out with the arguments read
+from arrays of the same length, storing each ret_val in out by its typecode and returning out. Arguments which are
+not buffers are converted once and used for every element. The arguments are unpacked and the results stored without
+allocating, so the call overhead is paid once per batch instead of once per element. Elements are converted a block
+at a time by helpers switching on the typecode once per block, leaving the loop around the body free of dispatch.
+
+The body is pasted into the loop, so it has to leave its result in ret_val rather than return.
+"""
+import inspect
+from typing import Dict, Iterable, List
+
+import ustubby
+from ustubby import ir
+
+# Typecodes converted without going through an object, with the C type of their elements
+TYPECODES = {
+    "b": "int8_t",
+    "B": "uint8_t",
+    "h": "int16_t",
+    "H": "uint16_t",
+    "i": "int",
+    "I": "unsigned int",
+    "l": "long",
+    "L": "unsigned long",
+    "f": "float",
+    "d": "double",
+}
+
+# Element types the companions read and store, with the kind of the helpers converting a block of them
+ELEMENT_KINDS = {
+    int: "int",
+    ustubby.SmallInt: "int",
+    bool: "int",
+    float: "float",
+}
+
+BLOCK = """
+// Elements converted at a time, each parameter keeps a block of them on the stack
+#ifndef {macro}
+#define {macro} (16)
+#endif"""
+
+ARG = """
+// Whether obj is a buffer with n elements rather than a value used for every element
+STATIC bool {module}_many_arg(mp_obj_t obj, mp_buffer_info_t *bufinfo, size_t n) {{
+    if (!mp_get_buffer(obj, bufinfo, MP_BUFFER_READ)) {{
+        return false;
+    }}
+    if (bufinfo->len / mp_binary_get_size('@', bufinfo->typecode, NULL) != n) {{
+        mp_raise_ValueError(MP_ERROR_TEXT("arguments must be as long as out"));
+    }}
+    return true;
+}}"""
+
+READ_FALLBACK = {
+    "int": "mp_obj_get_int(mp_binary_get_val_array(bufinfo->typecode, bufinfo->buf, start + i))",
+    "float": "mp_obj_get_float(mp_binary_get_val_array(bufinfo->typecode, bufinfo->buf, start + i))",
+}
+
+WRITE_FALLBACK = {
+    "int": "mp_binary_set_val_array_from_int(bufinfo->typecode, bufinfo->buf, start + i, block[i]);",
+    "float": "mp_binary_set_val_array_from_int(bufinfo->typecode, bufinfo->buf, start + i, (mp_int_t)block[i]);",
+}
+
+C_TYPES = {"int": "mp_int_t", "float": "mp_float_t"}
+
+COMPANION_OPEN = """
+//Batched {name}: stores {name} of every element in out, arguments which aren't buffers are used for every element
+STATIC mp_obj_t {c_name}_many(size_t n_args, const mp_obj_t *args) {{
+    mp_buffer_info_t out_bufinfo;
+    mp_get_buffer_raise(args[0], &out_bufinfo, MP_BUFFER_WRITE);
+    size_t many_n = out_bufinfo.len / mp_binary_get_size('@', out_bufinfo.typecode, NULL);"""
+
+DEFINE = "MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN({0}_many_obj, {1}, {2}, {0}_many);".format
+
+
+def block_macro(module: str) -> str:
+    return f"MODULE_{module.upper()}_MANY_BLOCK"
+
+
+def convert(name: str, signature: str, cases: Dict[str, str], fallback: str) -> str:
+    """
+    :param cases: Statement converting element i of the block for each typecode, with the element type as {0}
+    :return: Helper converting a block of elements, dispatching on the typecode once per block
+    """
+    lines = [f"STATIC void {name}({signature}) {{", "\tswitch (bufinfo->typecode) {"]
+    for typecode, statement in cases.items():
+        lines += [f"\t\tcase '{typecode}':", "\t\t\tfor (size_t i = 0; i < count; i++) {",
+                  f"\t\t\t\t{statement}", "\t\t\t}", "\t\t\tbreak;"]
+    lines += ["\t\tdefault:", "\t\t\tfor (size_t i = 0; i < count; i++) {", f"\t\t\t\t{fallback}", "\t\t\t}",
+              "\t}", "}"]
+    return "\n" + "\n".join(lines).replace("\t", "    ")
+
+
+def reader(module: str, kind: str) -> str:
+    """
+    Helper reading count elements of a buffer from start into a block of mp_int_t or mp_float_t
+    """
+    c_type = C_TYPES[kind]
+    return convert(f"{module}_many_read_{kind}",
+                   f"const mp_buffer_info_t *bufinfo, size_t start, size_t count, {c_type} *block",
+                   {typecode: f"block[i] = (({element} *)bufinfo->buf)[start + i];"
+                    for typecode, element in TYPECODES.items()},
+                   f"block[i] = {READ_FALLBACK[kind]};")
+
+
+def writer(module: str, kind: str) -> str:
+    """
+    Helper storing a block of mp_int_t or mp_float_t in count elements of a buffer from start
+    """
+    c_type = C_TYPES[kind]
+    return convert(f"{module}_many_write_{kind}",
+                   f"mp_buffer_info_t *bufinfo, size_t start, size_t count, const {c_type} *block",
+                   {typecode: f"(({element} *)bufinfo->buf)[start + i] = ({element})block[i];"
+                    for typecode, element in TYPECODES.items()},
+                   WRITE_FALLBACK[kind])
+
+
+def many_name(fn: ir.Function) -> str:
+    return f"{fn.name}_many"
+
+
+def check(fn: ir.Function) -> None:
+    """
+    :raises ValueError: if the function can't be batched, needing int, float or bool parameters and result
+    """
+    if not fn.parameters:
+        raise ValueError(f"{fn.name} has no parameters to batch over")
+    if fn.ret.annotation not in ELEMENT_KINDS:
+        raise ValueError(f"{fn.name} can't be batched, it returns {fn.ret.annotation} rather than int, float or bool")
+    for param in fn.parameters:
+        if param.kind != inspect.Parameter.POSITIONAL_OR_KEYWORD or param.annotation not in ELEMENT_KINDS:
+            raise ValueError(f"{fn.name} can't be batched, parameter {param.name} isn't a positional int, float or "
+                             f"bool")
+        if param.default is not inspect.Parameter.empty and ustubby.c_default(param.annotation,
+                                                                               param.default) is None:
+            raise ValueError(f"{fn.name} can't be batched, the default of {param.name} has no C equivalent")
+
+
+def helpers(module: str, functions: Iterable[ir.Function]) -> str:
+    """
+    :return: The block size and the conversion helpers the batched functions of module use, leaving out unused ones
+    """
+    functions = [fn for fn in functions if fn.many]
+    reads = {ELEMENT_KINDS[param.annotation] for fn in functions for param in fn.parameters}
+    writes = {ELEMENT_KINDS[fn.ret.annotation] for fn in functions}
+    chunks = [BLOCK.format(macro=block_macro(module)), ARG.format(module=module)]
+    chunks += [reader(module, kind) for kind in C_TYPES if kind in reads]
+    chunks += [writer(module, kind) for kind in C_TYPES if kind in writes]
+    return "\n".join(chunks)
+
+
+def render_param(index: int, param: ir.Parameter, module: str) -> List[str]:
+    """
+    :return: Lines finding out whether the argument is a buffer, filling its block with the value if not
+    """
+    kind = C_TYPES[ELEMENT_KINDS[param.annotation]]
+    c_type, converter = ustubby.default_types[param.annotation]
+    source = f"args[{index}]"
+    many = f"{module}_many_arg({source}, &{param.name}_bufinfo, many_n)"
+    value = converter.format(source)
+    if param.default is not inspect.Parameter.empty:
+        many = f"n_args > {index} && {many}"
+        value = f"n_args > {index} ? {value} : {ustubby.c_default(param.annotation, param.default)}"
+    return [f"\tmp_buffer_info_t {param.name}_bufinfo;",
+            f"\tbool {param.name}_many = {many};",
+            f"\t{kind} {param.name}_block[{block_macro(module)}];",
+            f"\tif (!{param.name}_many) {{",
+            f"\t\t{c_type} {param.name}_value = {value};",
+            f"\t\tfor (size_t many_i = 0; many_i < {block_macro(module)}; many_i++) {{",
+            f"\t\t\t{param.name}_block[many_i] = {param.name}_value;",
+            "\t\t}",
+            "\t}"]
+
+
+def companion(fn: ir.Function) -> str:
+    """
+    :return: The batched function and its function object, after the scalar function fn
+    """
+    check(fn)
+    module = fn.many
+    block = block_macro(module)
+    ret_kind = ELEMENT_KINDS[fn.ret.annotation]
+    lines = [COMPANION_OPEN.format(name=fn.name, c_name=fn.c_name)]
+    for index, param in enumerate(fn.parameters, 1):
+        lines += render_param(index, param, module)
+    lines += [f"\t{C_TYPES[ret_kind]} ret_block[{block}];",
+              f"\tfor (size_t many_start = 0; many_start < many_n; many_start += {block}) {{",
+              f"\t\tsize_t many_len = many_n - many_start < {block} ? many_n - many_start : {block};"]
+    for param in fn.parameters:
+        lines += [f"\t\tif ({param.name}_many) {{",
+                  f"\t\t\t{module}_many_read_{ELEMENT_KINDS[param.annotation]}(&{param.name}_bufinfo, many_start, "
+                  f"many_len, {param.name}_block);",
+                  "\t\t}"]
+    lines.append("\t\tfor (size_t many_i = 0; many_i < many_len; many_i++) {")
+    for param in fn.parameters:
+        c_type = ustubby.default_types[param.annotation][0]
+        truth = " != 0" if param.annotation is bool else ""
+        lines.append(f"\t\t\t{c_type} {param.name} = {param.name}_block[many_i]{truth};")
+    lines.append("\t\t" + ustubby.return_type_handler[fn.ret.annotation])
+    code = fn.code if fn.code is not None else ir.PLACEHOLDER
+    lines += ["", *(line if line.startswith("#") else "\t\t" + line for line in code.splitlines()), ""]
+    lines += ["\t\t\tret_block[many_i] = ret_val;",
+              "\t\t}",
+              f"\t\t{module}_many_write_{ret_kind}(&out_bufinfo, many_start, many_len, ret_block);",
+              "\t}",
+              "\treturn args[0];",
+              "}"]
+    required = 1 + sum(param.default is inspect.Parameter.empty for param in fn.parameters)
+    lines.append(DEFINE(fn.c_name, required, 1 + len(fn.parameters)))
+    return "\n".join(lines)
+
+
+def table_entry(fn: ir.Function) -> ir.TableEntry:
+    return ir.TableEntry(many_name(fn), ir.FUNCTION_ENTRY(f"{fn.c_name}_many"))
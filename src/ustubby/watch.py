@@ -0,0 +1,134 @@
+"""
+Regenerate stubs whenever their inputs change, from a single long lived process.
+
+The inputs are polled with os.stat, so no extra dependencies are needed and it works the same on every platform.
+A burst of saves is collected until the files have been quiet for the debounce time, then only the modules whose
+files changed are stubbed again. Changed python modules are executed again from their source, skipping both
+sys.modules and any cached bytecode which could be older than the save.
+"""
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from ustubby import batch
+from ustubby.cache import Cache
+
+Stamp = Tuple[int, int]
+
+
+def stamp(path: Path) -> Optional[Stamp]:
+    """
+    :return: Modification time and size of path, or None if it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def describe(result: batch.Result) -> str:
+    if result.error is not None:
+        return result.error
+    if not result.written:
+        return f"{result.job.output} unchanged"
+    return f"Wrote {result.job.output}"
+
+
+class Watcher:
+    """
+    Tracks the inputs given on the command line and regenerates the ones that change.
+    Directories, globs and manifests are expanded again on every poll, so new files are picked up.
+    Like the cache, only the input files are watched and changes to modules they import are not detected.
+    """
+
+    def __init__(self, specs: Iterable[str], output_dir: Optional[Path] = None, static: bool = False,
+                 register_mode: str = "functions", cache: Optional[Cache] = None, debounce: float = 0.1,
+                 qstrdefs: bool = False, instrument: bool = False, update: bool = False):
+        """
+        :param specs: Input specifications as given on the command line
+        :param debounce: Seconds the inputs must go without changing before they are regenerated
+        """
+        self.specs = [str(spec) for spec in specs]
+        self.output_dir = output_dir
+        self.static = static
+        self.register_mode = register_mode
+        self.cache = cache
+        self.debounce = debounce
+        self.qstrdefs = qstrdefs
+        self.instrument = instrument
+        self.update = update
+        self.stamps: Dict[Path, Stamp] = self.scan()
+
+    def inputs(self) -> List[Path]:
+        found: Dict[Path, None] = {}
+        for spec in self.specs:
+            try:
+                found.update((path, None) for path in batch.collect_inputs([spec]))
+            except FileNotFoundError:
+                # Editors saving through a rename briefly remove the file
+                continue
+        return list(found)
+
+    def scan(self) -> Dict[Path, Stamp]:
+        stamps = {}
+        for path in self.inputs():
+            current = stamp(path)
+            if current is not None:
+                stamps[path] = current
+        return stamps
+
+    def changed(self) -> List[Path]:
+        """
+        :return: Inputs created or modified since the last call, updating the recorded stamps
+        """
+        stamps = self.scan()
+        changed = [path for path, current in stamps.items() if self.stamps.get(path) != current]
+        self.stamps = stamps
+        return changed
+
+    def wait(self, interval: float = 0.2, sleep: Callable[[float], None] = time.sleep) -> List[Path]:
+        """
+        Blocks until some inputs change and then stay unchanged for the debounce time
+        :param interval: Seconds between polls while nothing has changed
+        :return: Every input changed during the burst
+        """
+        changed: Dict[Path, None] = {}
+        while not changed:
+            sleep(interval)
+            changed.update((path, None) for path in self.changed())
+        while True:
+            sleep(self.debounce)
+            more = self.changed()
+            if not more:
+                return list(changed)
+            changed.update((path, None) for path in more)
+
+    def regenerate(self, paths: Iterable[Path]) -> List[batch.Result]:
+        """
+        Stubs the given inputs in this process, importing python inputs again first
+        """
+        results = []
+        for job in batch.plan(paths, self.output_dir, self.static, self.register_mode, self.qstrdefs,
+                              self.instrument, self.update):
+            if job.input.suffix == ".py" and not job.static:
+                try:
+                    batch.import_module(job.input, reload=True)
+                except Exception as e:
+                    results.append(batch.Result(job, f"{job.input}: {type(e).__name__}: {e}"))
+                    continue
+            results.append(batch._generate(job, self.cache))
+        return results
+
+    def run(self, report: Callable[[str], None] = print, interval: float = 0.2) -> None:
+        """
+        Regenerates changed inputs until interrupted
+        :param report: Called with a description of every regenerated input
+        """
+        try:
+            while True:
+                for result in self.regenerate(self.wait(interval)):
+                    report(describe(result))
+        except KeyboardInterrupt:
+            pass
@@ -1,4 +1,12 @@
+import array
+import io
+import types
+from typing import List, Sequence, Tuple
+
+import pytest
+
 import ustubby
+from ustubby import static
 
 
 def test_basic_example():
@@ -99,15 +107,34 @@ def test_readfrom_mem():
 STATIC mp_obj_t example_readfrom_mem(size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args) {
     enum { ARG_addr, ARG_memaddr, ARG_arg, ARG_addrsize };
     STATIC const mp_arg_t example_readfrom_mem_allowed_args[] = {
-        { MP_QSTR_addr, MP_ARG_REQUIRED | MP_ARG_INT, { .u_int = 0 } },
-        { MP_QSTR_memaddr, MP_ARG_REQUIRED | MP_ARG_INT, { .u_int = 0 } },
-        { MP_QSTR_arg, MP_ARG_REQUIRED | MP_ARG_OBJ, { .u_obj = MP_OBJ_NULL } },
+        { MP_QSTR_addr, MP_ARG_INT, { .u_int = 0 } },
+        { MP_QSTR_memaddr, MP_ARG_INT, { .u_int = 0 } },
+        { MP_QSTR_arg, MP_ARG_OBJ, { .u_rom_obj = MP_ROM_NONE } },
         { MP_QSTR_addrsize, MP_ARG_KW_ONLY | MP_ARG_INT, { .u_int = 8 } },
     };
 
     mp_arg_val_t args[MP_ARRAY_SIZE(example_readfrom_mem_allowed_args)];
-    mp_arg_parse_all(n_args - 1, pos_args + 1, kw_args,
-        MP_ARRAY_SIZE(example_readfrom_mem_allowed_args), example_readfrom_mem_allowed_args, args);
+    if (kw_args->used == 0 && n_args <= 4) {
+        if (n_args > 1) {
+            args[ARG_addr].u_int = mp_obj_get_int(pos_args[1]);
+        } else {
+            args[ARG_addr] = example_readfrom_mem_allowed_args[ARG_addr].defval;
+        }
+        if (n_args > 2) {
+            args[ARG_memaddr].u_int = mp_obj_get_int(pos_args[2]);
+        } else {
+            args[ARG_memaddr] = example_readfrom_mem_allowed_args[ARG_memaddr].defval;
+        }
+        if (n_args > 3) {
+            args[ARG_arg].u_obj = pos_args[3];
+        } else {
+            args[ARG_arg] = example_readfrom_mem_allowed_args[ARG_arg].defval;
+        }
+        args[ARG_addrsize] = example_readfrom_mem_allowed_args[ARG_addrsize].defval;
+    } else {
+        mp_arg_parse_all(n_args - 1, pos_args + 1, kw_args,
+            MP_ARRAY_SIZE(example_readfrom_mem_allowed_args), example_readfrom_mem_allowed_args, args);
+    }
 
     mp_int_t addr = args[ARG_addr].u_int;
     mp_int_t memaddr = args[ARG_memaddr].u_int;
@@ -143,6 +170,8 @@ def test_readfrom_mem_load_function():
     assert func.to_c_return_value() == "return mp_obj_new_str(<ret_val_ptr>, <ret_val_len>);"
     assert func.to_c_define() == "MP_DEFINE_CONST_FUN_OBJ_KW(example_readfrom_mem_obj, 1, example_readfrom_mem);"
     assert func.to_c_arg_array_def() == "STATIC const mp_arg_t example_readfrom_mem_allowed_args[]"
+    assert func.to_c().splitlines() == [line for line in ustubby.stub_function(readfrom_mem).splitlines()[2:]
+                                        if line != "//"]
 
 
 def test_many_positional_arguments():
@@ -267,3 +296,444 @@ MP_DEFINE_CONST_FUN_OBJ_0(madgwick_get_beta_obj, madgwick_get_beta);""".splitlin
     call_lines = ustubby.stub_function(get_beta).splitlines()
     for index, line in enumerate(call_lines):
         assert line == lines[index]
+
+
+def test_write_module_streams():
+    def add_ints(a: int, b: int) -> int:
+        """Adds two integers"""
+
+    mod = types.ModuleType("example")
+    add_ints.__module__ = "example"
+    mod.add_ints = add_ints
+    chunks = ustubby.iter_stub_module(mod)
+    assert next(chunks).startswith("// This file was developed using uStubby.")
+    stream = io.StringIO()
+    ustubby.write_module(mod, stream)
+    assert stream.getvalue() == ustubby.stub_module(mod)
+
+
+def test_buffer_arguments():
+    def checksum(data: bytes, out: bytearray) -> int:
+        """Sums data into out"""
+
+    checksum.__module__ = "example"
+    lines = """
+//Sums data into out
+STATIC mp_obj_t example_checksum(mp_obj_t data_obj, mp_obj_t out_obj) {
+    mp_buffer_info_t data_bufinfo;
+    mp_get_buffer_raise(data_obj, &data_bufinfo, MP_BUFFER_READ);
+    const uint8_t *data = data_bufinfo.buf;
+    size_t data_len = data_bufinfo.len;
+    mp_buffer_info_t out_bufinfo;
+    mp_get_buffer_raise(out_obj, &out_bufinfo, MP_BUFFER_RW);
+    uint8_t *out = out_bufinfo.buf;
+    size_t out_len = out_bufinfo.len;
+    mp_int_t ret_val;
+""".splitlines()
+    call_lines = ustubby.stub_function(checksum).splitlines()
+    for index, line in enumerate(lines):
+        assert call_lines[index] == line
+    func = ustubby.FunctionContainer().load_python(checksum)
+    assert "    mp_get_buffer_raise(out_obj, &out_bufinfo, MP_BUFFER_RW);" in func.to_c().splitlines()
+
+
+def test_buffer_arguments_many_and_keyword():
+    def process(a: int, b: int, c: memoryview, samples: array.array, *, scratch: bytearray = None) -> None:
+        """"""
+
+    process.__module__ = "example"
+    call_lines = ustubby.stub_function(process).splitlines()
+    assert "    mp_get_buffer_raise(args[ARG_c].u_obj, &c_bufinfo, MP_BUFFER_READ);" in call_lines
+    assert "    void *samples = samples_bufinfo.buf;" in call_lines
+    # scratch is only converted when it isn't None
+    assert """    mp_buffer_info_t scratch_bufinfo = { .buf = NULL, .len = 0 };
+    if (args[ARG_scratch].u_obj != mp_const_none) {
+        mp_get_buffer_raise(args[ARG_scratch].u_obj, &scratch_bufinfo, MP_BUFFER_RW);
+    }
+    uint8_t *scratch = scratch_bufinfo.buf;
+    size_t scratch_len = scratch_bufinfo.len;""" in "\n".join(call_lines)
+
+    def process(a: int, *, gain: float = None, name: str = None, callback: object = None) -> None:
+        """"""
+
+    process.__module__ = "example"
+    call_lines = ustubby.stub_function(process).splitlines()
+    assert "        { MP_QSTR_callback, MP_ARG_KW_ONLY | MP_ARG_OBJ, { .u_rom_obj = MP_ROM_NONE } }," in call_lines
+    assert "    bool gain_given = args[ARG_gain].u_obj != mp_const_none;" in call_lines
+    assert "    mp_float_t gain = gain_given ? mp_obj_get_float(args[ARG_gain].u_obj) : 0;" in call_lines
+    assert "    const char* name = args[ARG_name].u_obj != mp_const_none ? " \
+           "mp_obj_str_get_str(args[ARG_name].u_obj) : NULL;" in call_lines
+    assert "    mp_obj_t callback = args[ARG_callback].u_obj;" in call_lines
+
+    class Q15:
+        pass
+
+    ustubby.register_element_type(Q15, "int16_t", "q15_from_obj")
+
+    def process(a: int, *, gain: Q15 = None) -> None:
+        """"""
+
+    process.__module__ = "example"
+    with pytest.raises(TypeError, match="gain"):
+        ustubby.stub_function(process)
+
+    def process(a: int, b: int, c: memoryview, samples: array.array) -> None:
+        """"""
+
+    process.__module__ = "example"
+    call_lines = ustubby.stub_function(process).splitlines()
+    assert "    mp_get_buffer_raise(args[2], &c_bufinfo, MP_BUFFER_READ);" in call_lines
+    assert "    mp_get_buffer_raise(args[3], &samples_bufinfo, MP_BUFFER_RW);" in call_lines
+
+
+def test_typed_container_arguments():
+    def scale(values: List[int], gains: Tuple[float, ...], flags: Sequence[bool]) -> None:
+        """Scales values"""
+
+    scale.__module__ = "example"
+    lines = """
+//Scales values
+STATIC mp_obj_t example_scale(mp_obj_t values_obj, mp_obj_t gains_obj, mp_obj_t flags_obj) {
+    size_t values_len = 0;
+    mp_obj_t *values_items = NULL;
+    mp_obj_get_array(values_obj, &values_len, &values_items);
+    if (values_len > 32) {
+        mp_raise_ValueError(MP_ERROR_TEXT("values has more than 32 elements"));
+    }
+    mp_int_t values[32];
+    for (size_t values_i = 0; values_i < values_len; values_i++) {
+        values[values_i] = mp_obj_get_int(values_items[values_i]);
+    }
+    size_t gains_len = 0;
+    mp_obj_t *gains_items = NULL;
+    mp_obj_get_array(gains_obj, &gains_len, &gains_items);
+    if (gains_len > 32) {
+        mp_raise_ValueError(MP_ERROR_TEXT("gains has more than 32 elements"));
+    }
+    mp_float_t gains[32];""".splitlines()
+    call_lines = ustubby.stub_function(scale).splitlines()
+    for index, line in enumerate(lines):
+        assert call_lines[index] == line
+    assert "        flags[flags_i] = mp_obj_is_true(flags_items[flags_i]);" in call_lines
+    func = ustubby.FunctionContainer().load_python(scale)
+    assert "    mp_obj_get_array(values_obj, &values_len, &values_items);" in func.to_c().splitlines()
+
+
+def test_typed_container_fixed_length_and_keyword():
+    class Q15:
+        pass
+
+    ustubby.register_element_type(Q15, "int16_t", "q15_from_obj")
+
+    def mix(v: Tuple[float, float, float], a: int, b: int, c: int, *, taps: List[Q15] = None) -> None:
+        """"""
+
+    mix.__module__ = "example"
+    call_lines = ustubby.stub_function(mix).splitlines()
+    assert "        { MP_QSTR_taps, MP_ARG_KW_ONLY | MP_ARG_OBJ, { .u_rom_obj = MP_ROM_NONE } }," in call_lines
+    assert "    mp_obj_get_array_fixed_n(args[ARG_v].u_obj, 3, &v_items);" in call_lines
+    assert "    int16_t taps[32];" in call_lines
+    assert "        taps[taps_i] = q15_from_obj(taps_items[taps_i]);" in call_lines
+
+    def mix(v: Tuple[float, float, float], a: int, b: int, gain: Q15) -> None:
+        """"""
+
+    mix.__module__ = "example"
+    call_lines = ustubby.stub_function(mix).splitlines()
+    assert "    mp_obj_get_array_fixed_n(args[0], 3, &v_items);" in call_lines
+    assert "    const size_t v_len = 3;" in call_lines
+    assert "    mp_float_t v[3];" in call_lines
+
+    def mix(v: Tuple[(float,) * (ustubby.CONTAINER_MAX_LENGTH + 1)]) -> None:
+        """"""
+
+    mix.__module__ = "example"
+    with pytest.raises(ValueError, match="at most"):
+        ustubby.stub_function(mix)
+    assert "    int16_t gain = q15_from_obj(args[3]);" in call_lines
+
+
+def test_trailing_defaults():
+    def configure(channel: int, gain: float = 1.5, name: str = "adc", callback: object = None,
+                  enable: bool = True) -> None:
+        """Configures a channel"""
+
+    configure.__module__ = "example"
+    lines = """
+//Configures a channel
+STATIC mp_obj_t example_configure(size_t n_args, const mp_obj_t *args) {
+    mp_int_t channel = mp_obj_get_int(args[0]);
+    mp_float_t gain = n_args > 1 ? mp_obj_get_float(args[1]) : 1.5;
+    const char* name = n_args > 2 ? mp_obj_str_get_str(args[2]) : "adc";
+    mp_obj_t callback = n_args > 3 ? args[3] : mp_const_none;
+    bool enable = n_args > 4 ? mp_obj_is_true(args[4]) : true;
+
+    //Your code here
+
+    return mp_const_none;
+}
+MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(example_configure_obj, 1, 5, example_configure);""".splitlines()
+    assert ustubby.stub_function(configure).splitlines() == lines
+    assert ustubby.FunctionContainer().load_python(configure).to_c().splitlines() == lines[1:]
+
+    def configure(channel: int, pins: List[int] = None) -> None:
+        """"""
+
+    configure.__module__ = "example"
+    call_lines = ustubby.stub_function(configure).splitlines()
+    assert "MP_DEFINE_CONST_FUN_OBJ_KW(example_configure_obj, 1, example_configure);" in call_lines
+    assert "    if (kw_args->used == 0 && n_args >= 2 && n_args <= 3) {" in call_lines
+
+
+def test_keyword_fast_path_requires_keyword_only_defaults():
+    def send(data: int, *, timeout: int) -> None:
+        """"""
+
+    send.__module__ = "example"
+    call_lines = ustubby.stub_function(send).splitlines()
+    assert "        { MP_QSTR_timeout, MP_ARG_REQUIRED | MP_ARG_KW_ONLY | MP_ARG_INT,  }," in call_lines
+    assert not any("kw_args->used" in line for line in call_lines)
+
+
+def test_out_return_mode():
+    def read_accel(out: ustubby.Out[array.array]) -> Tuple[float, float, float]:
+        """Reads x, y and z"""
+
+    read_accel.__module__ = "example"
+    lines = """
+//Reads x, y and z
+STATIC mp_obj_t example_read_accel(mp_obj_t out_obj) {
+    mp_buffer_info_t out_bufinfo;
+    mp_get_buffer_raise(out_obj, &out_bufinfo, MP_BUFFER_WRITE);
+    void *out = out_bufinfo.buf;
+    size_t out_len = out_bufinfo.len;
+    mp_float_t ret_val[3];
+
+    //Your code here
+
+    if (out_len < 3 * mp_binary_get_size('@', out_bufinfo.typecode, NULL)) {
+        mp_raise_ValueError(MP_ERROR_TEXT("out buffer too small"));
+    }
+    for (size_t i = 0; i < 3; i++) {
+        switch (out_bufinfo.typecode) {
+            case 'f':
+                ((float *)out)[i] = ret_val[i];
+                break;
+            case 'd':
+                ((double *)out)[i] = ret_val[i];
+                break;
+            default:
+                mp_raise_TypeError(MP_ERROR_TEXT("out must be an array of floats"));
+        }
+    }
+    return out_obj;
+}
+MP_DEFINE_CONST_FUN_OBJ_1(example_read_accel_obj, example_read_accel);""".splitlines()
+    assert ustubby.stub_function(read_accel).splitlines() == lines
+    assert ustubby.FunctionContainer().load_python(read_accel).to_c().splitlines() == lines[1:]
+
+    @ustubby.return_mode("out")
+    def count(a: int, b: int, c: int, *, out: ustubby.Out[bytearray]) -> int:
+        """"""
+
+    count.__module__ = "example"
+    call_lines = ustubby.stub_function(count).splitlines()
+    assert "    mp_binary_set_val_array_from_int(out_bufinfo.typecode, out, 0, ret_val);" in call_lines
+    assert "    return args[ARG_out].u_obj;" in call_lines
+
+    mod = types.ModuleType("example")
+    mod.count = count
+    assert '#include "py/binary.h"' in ustubby.stub_module(mod)
+
+    @ustubby.return_mode("out")
+    def missing(a: int) -> int:
+        """"""
+
+    with pytest.raises(ValueError):
+        ustubby.stub_function(missing)
+
+
+def test_static_return_mode():
+    @ustubby.return_mode("static")
+    def temperature(channel: int) -> float:
+        """Reads the temperature"""
+
+    @ustubby.return_mode("static")
+    def status() -> str:
+        """"""
+
+    temperature.__module__ = status.__module__ = "example"
+    call_lines = ustubby.stub_function(temperature).splitlines()
+    # Floats are never stored in an object shared between calls
+    assert "    return mp_obj_new_float(ret_val);" in call_lines
+    assert not any("STATIC struct" in line for line in call_lines)
+    # Strings are qstrs built into the firmware rather than interned at run time
+    status_lines = ustubby.stub_function(status).splitlines()
+    assert "    qstr ret_val;" in status_lines
+    assert "    return MP_OBJ_NEW_QSTR(ret_val);" in status_lines
+    assert not any("qstr_from_strn" in line for line in status_lines)
+    assert ustubby.FunctionContainer().load_python(status).to_c().splitlines()[-5:] == status_lines[-5:]
+    with pytest.raises(ValueError):
+        ustubby.return_mode("pooled")
+
+
+def test_stub_module_skips_imported_decorators():
+    mod = types.ModuleType("example")
+    exec("""
+from ustubby import many, return_mode, small_int
+
+
+@small_int
+def popcount(value: int) -> int:
+    \"\"\"Counts the set bits\"\"\"
+""", vars(mod))
+    c_output = ustubby.stub_module(mod)
+    assert "MP_ROM_PTR(&example_popcount_obj)" in c_output
+    for name in ("many", "return_mode", "small_int"):
+        assert f"MP_QSTR_{name}" not in c_output
+
+
+def test_small_int():
+    def popcount(value: ustubby.SmallInt) -> ustubby.SmallInt:
+        """Counts the set bits"""
+
+    @ustubby.small_int
+    def rotate(value: int, shift: int = 1) -> int:
+        """"""
+
+    @ustubby.small_int
+    def mask(value: int, *, bits: int = 8) -> int:
+        """"""
+
+    popcount.__module__ = rotate.__module__ = mask.__module__ = "example"
+    lines = ustubby.stub_function(popcount).splitlines()
+    assert "    mp_int_t value = mp_obj_is_small_int(value_obj) ? MP_OBJ_SMALL_INT_VALUE(value_obj) : " \
+           "mp_obj_get_int(value_obj);" in lines
+    assert "    return MP_SMALL_INT_FITS(ret_val) ? MP_OBJ_NEW_SMALL_INT(ret_val) : mp_obj_new_int(ret_val);" in lines
+    assert ustubby.FunctionContainer().load_python(popcount).to_c().splitlines() == lines[1:]
+    assert "    mp_int_t shift = n_args > 1 ? (mp_obj_is_small_int(args[1]) ? MP_OBJ_SMALL_INT_VALUE(args[1]) : " \
+           "mp_obj_get_int(args[1])) : 1;" in ustubby.stub_function(rotate).splitlines()
+    lines = ustubby.stub_function(mask).splitlines()
+    assert "        args[ARG_value].u_int = mp_obj_is_small_int(pos_args[1]) ? MP_OBJ_SMALL_INT_VALUE(pos_args[1]) : " \
+           "mp_obj_get_int(pos_args[1]);" in lines
+    assert "    mp_int_t bits = args[ARG_bits].u_int;" in lines
+    mod = types.ModuleType("example")
+    mod.popcount = popcount
+    assert '#include "py/smallint.h"' in ustubby.stub_module(mod)
+
+
+UPDATE_SOURCE = '''"""Example module"""
+
+
+def add_ints(a: int, b: int) -> int:
+    """Adds two integers"""
+
+
+def scale(value: float, *, factor: int = 2) -> float:
+    """Scales value"""
+
+
+def clamp(value: int) -> int:
+    """Clamps value"""
+'''
+
+
+def test_load_c():
+    mod = static.load_source(UPDATE_SOURCE, "example")
+    c_output = ustubby.stub_module(mod).replace("    //Your code here", "    ret_val = a + b;\n\n    ret_val *= 2;", 1)
+    containers = ustubby.load_c(c_output, "example")
+    assert list(containers) == ["add_ints", "clamp", "scale"]
+    assert containers["add_ints"].code == "ret_val = a + b;\n\nret_val *= 2;"
+    assert containers["add_ints"].comments == "Adds two integers"
+    assert containers["scale"].code == "//Your code here"
+    func = ustubby.FunctionContainer().load_python(mod.add_ints)
+    func.code = ustubby.FunctionContainer().load_c(c_output).code
+    assert func.to_c() in c_output
+    with pytest.raises(ValueError):
+        ustubby.FunctionContainer().load_c("int main() {}")
+
+
+def test_update_module():
+    mod = static.load_source(UPDATE_SOURCE, "example")
+    old = ustubby.stub_module(mod)
+    bodies = ["\tret_val = a + b;", "    ret_val = value < 0 ? 0 : value;", "    ret_val = value * factor;"]
+    for body in bodies:
+        old = old.replace("    //Your code here", body, 1)
+    assert ustubby.update_module(mod, old) == old.replace("\t", "    ", 1)
+
+    changed = static.load_source(UPDATE_SOURCE.replace("value: int) -> int", "value: int, limit: int) -> int"),
+                                 "example")
+    new = ustubby.update_module(changed, old)
+    assert "    mp_int_t limit = mp_obj_get_int(limit_obj);\n    mp_int_t ret_val;\n\n" \
+           "    ret_val = value < 0 ? 0 : value;\n" in new
+    start = old.index("//Scales value")
+    assert old[start:old.index("MP_DEFINE", start)] in new
+    assert new.count("//Your code here") == 0
+
+
+def test_update_module_bodies():
+    mod = static.load_source(UPDATE_SOURCE + '''
+
+class Counter:
+    count: int
+
+    def __init__(self, count: int):
+        """Starts counting"""
+
+    def increment(self, *, by: int = 1) -> int:
+        """Adds by"""
+''', "example")
+    old = ustubby.stub_module(mod)
+    bodies = [
+        # make_new and the method of the class come before the functions
+        "    self->count += 1;",
+        "    if (by < 0) {\n\n        mp_raise_ValueError(MP_ERROR_TEXT(\"negative }\"));\n    }\n\n"
+        "    self->count += by; /* { */\n    ret_val = self->count;",
+        "    ret_val = a + b;\n  \n    ret_val *= 2;",
+    ]
+    for body in bodies:
+        old = old.replace("    //Your code here", body, 1)
+    new = ustubby.update_module(mod, old)
+    assert new == old
+    assert ustubby.update_module(mod, new) == new
+    containers = ustubby.load_c(old, "example")
+    assert containers["Counter_increment"].code.startswith("if (by < 0) {\n\n    mp_raise_ValueError(")
+    assert containers["add_ints"].code == "ret_val = a + b;\n\nret_val *= 2;"
+
+    # Without the blank line before the return the body can't be told apart from it
+    broken = old.replace("    ret_val = self->count;\n\n", "    ret_val = self->count;\n")
+    with pytest.raises(ValueError, match="example_Counter_increment"):
+        ustubby.update_module(mod, broken)
+
+
+def test_update_module_tuple_return():
+    mod = static.load_source('''
+def pair(a: int) -> tuple:
+    """Returns a pair"""
+''', "example")
+    old = ustubby.stub_module(mod).replace("    //Your code here", "    (void)a;")
+    # The tuple return starts with a blank line, which isn't taken into the body
+    assert ustubby.update_module(mod, old) == old
+
+
+def test_update_module_edited_return():
+    source = '''
+def name(index: int) -> str:
+    """Looks up a name"""
+
+
+def count() -> int:
+    """Counts"""
+'''
+    mod = static.load_source(source, "example")
+    old = ustubby.stub_module(mod).replace(
+        "    //Your code here\n\n    return mp_obj_new_str(<ret_val_ptr>, <ret_val_len>);",
+        "    const char *buf = \"abc\";\n    size_t len = 3;\n\n    return mp_obj_new_str(buf, len);")
+    assert ustubby.update_module(mod, old) == old
+
+    # The edited return survives a signature change, a return left as generated follows the new annotation
+    changed = source.replace("index: int", "index: int, upper: bool").replace("-> int", "-> float")
+    changed = static.load_source(changed, "example")
+    new = ustubby.update_module(changed, old)
+    assert "    size_t len = 3;\n\n    return mp_obj_new_str(buf, len);\n}" in new
+    assert "mp_obj_new_float(ret_val)" in new and "mp_obj_new_int(ret_val)" not in new
@@ -0,0 +1,98 @@
+import sys
+
+import pytest
+
+from ustubby import batch
+from ustubby.__main__ import main
+
+
+def write_modules(root):
+    (root / "sub").mkdir()
+    (root / "batch_example.py").write_text('def add_ints(a: int, b: int) -> int:\n    """Adds two integers"""\n')
+    (root / "sub" / "batch_madgwick.py").write_text('def get_beta() -> float:\n    """beta"""\n')
+    (root / "sub" / "__init__.py").write_text("")
+
+
+def test_collect_inputs(tmp_path):
+    write_modules(tmp_path)
+    (tmp_path / "manifest.txt").write_text("# comment\n\nbatch_example.py\nsub/*.py\n")
+    expected = [tmp_path / "batch_example.py", tmp_path / "sub" / "batch_madgwick.py"]
+    assert batch.collect_inputs([str(tmp_path)]) == expected
+    assert batch.collect_inputs([str(tmp_path / "manifest.txt")]) == expected
+    assert batch.collect_inputs([str(tmp_path / "**" / "batch_*.py"), str(tmp_path / "batch_example.py")]) == expected
+
+
+def test_run_process_pool(tmp_path):
+    write_modules(tmp_path)
+    jobs = batch.plan(batch.collect_inputs([str(tmp_path)]), tmp_path / "out")
+    results = batch.run(jobs, workers=2)
+    assert [result.error for result in results] == [None, None]
+    assert "MP_DEFINE_CONST_FUN_OBJ_2(batch_example_add_ints_obj, batch_example_add_ints);" in \
+           (tmp_path / "out" / "batch_example.c").read_text()
+    assert "MP_REGISTER_MODULE(MP_QSTR_batch_madgwick" in (tmp_path / "out" / "batch_madgwick.c").read_text()
+
+
+def test_build_files(tmp_path):
+    written = batch.write_build_files([tmp_path / "b.c", tmp_path / "a.c"])
+    assert written == [tmp_path / "micropython.mk", tmp_path / "micropython.cmake"]
+    makefile = (tmp_path / "micropython.mk").read_text()
+    name = tmp_path.name.upper()
+    assert f"SRC_USERMOD += $({name}_MOD_DIR)/a.c\nSRC_USERMOD += $({name}_MOD_DIR)/b.c" in makefile
+    assert "CFLAGS_USERMOD += -DMODULE_A_ENABLED=1" in makefile
+    assert "${CMAKE_CURRENT_LIST_DIR}/a.c" in (tmp_path / "micropython.cmake").read_text()
+
+
+def test_main_refuses_existing(tmp_path, monkeypatch, capsys):
+    write_modules(tmp_path)
+    (tmp_path / "batch_example.c").write_text("")
+    monkeypatch.setattr(sys, "argv", ["ustubby", str(tmp_path)])
+    assert main() == 1
+    assert "batch_example.c already exists." in capsys.readouterr().out
+
+
+def test_qstrdefs(tmp_path):
+    write_modules(tmp_path)
+    jobs = batch.plan(batch.collect_inputs([str(tmp_path)]), tmp_path / "out", qstrdefs=True)
+    assert [result.error for result in batch.run(jobs, workers=1)] == [None, None]
+    assert (tmp_path / "out" / "batch_example.qstrdefs.h").read_text().splitlines() == [
+        "// QSTRs used by batch_example.c, written by uStubby",
+        "Q(__name__)",
+        "Q(add_ints)",
+        "Q(batch_example)",
+    ]
+    batch.write_build_files([job.output for job in jobs], qstrdefs=True)
+    makefile = (tmp_path / "out" / "micropython.mk").read_text()
+    assert "SRC_USERMOD_LIB_C += $(OUT_MOD_DIR)/batch_example.c" in makefile
+    assert "QSTR_DEFS += $(OUT_MOD_DIR)/batch_example.qstrdefs.h" in makefile
+    assert "SRC_USERMOD +=" not in makefile
+    cmake = (tmp_path / "out" / "micropython.cmake").read_text()
+    assert "# batch_example.qstrdefs.h\n" in cmake
+    assert "    ${CMAKE_CURRENT_LIST_DIR}/batch_example.c\n" in cmake
+
+
+def test_main_update(tmp_path, monkeypatch):
+    write_modules(tmp_path)
+    path = tmp_path / "batch_example.c"
+    monkeypatch.setattr(sys, "argv", ["ustubby", str(tmp_path / "batch_example.py"), "--static"])
+    assert main() == 0
+    path.write_text(path.read_text().replace("//Your code here", "ret_val = a + b;"))
+    (tmp_path / "batch_example.py").write_text(
+        'def add_ints(a: int, b: int, c: int) -> int:\n    """Adds three integers"""\n')
+    monkeypatch.setattr(sys, "argv", ["ustubby", str(tmp_path / "batch_example.py"), "--static", "--update"])
+    assert main() == 0
+    assert "    mp_int_t c = mp_obj_get_int(c_obj);\n    mp_int_t ret_val;\n\n    ret_val = a + b;\n" in \
+        path.read_text()
+
+
+def test_same_stem_inputs(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "batch_same.py").write_text(f'def f{name}() -> None:\n    """{name}"""\n')
+    inputs = [tmp_path / "a" / "batch_same.py", tmp_path / "b" / "batch_same.py"]
+    with pytest.raises(ValueError, match="both be written"):
+        batch.plan(inputs, tmp_path / "out")
+    results = batch.run(batch.plan(inputs), workers=1)
+    assert [result.error for result in results] == [None, None]
+    assert "batch_same_fa" in (tmp_path / "a" / "batch_same.c").read_text()
+    assert "batch_same_fa" not in (tmp_path / "b" / "batch_same.c").read_text()
+    assert "batch_same_fb" in (tmp_path / "b" / "batch_same.c").read_text()
@@ -0,0 +1,29 @@
+import json
+
+from benchmarks import generate
+
+
+def test_synthetic_module_covers_every_kind():
+    mod = generate.synthetic_module(len(generate.FUNCTION_KINDS) + 1)
+    names = [f.__name__ for f in generate.functions(mod)]
+    assert names[:2] == ["no_args_0", "positional_1"]
+    assert names[-1] == f"no_args_{len(generate.FUNCTION_KINDS)}"
+
+
+def test_benchmark_baseline_round_trip(tmp_path):
+    output = tmp_path / "baseline.json"
+    assert generate.main(["--sizes", "10", "--repeat", "1", "-o", str(output)]) == 0
+    data = json.loads(output.read_text())
+    assert {r["case"] for r in data["results"]} == {"stub_module", "static_stub_module", "update_module",
+                                                    "parse_csv", "stub_registers", "stub_register_table"}
+    previous = generate.load_baseline(output)
+    slower = [r._replace(seconds=r.seconds * 2) for r in previous.values()]
+    assert len(generate.compare(slower, previous, 1.5)) == len(slower)
+    assert generate.compare(list(previous.values()), previous, 1.5) == []
+
+
+def test_committed_baseline(tmp_path):
+    previous = generate.load_baseline(generate.BASELINE)
+    cases = {case for case, size in previous}
+    assert {(case, size) for case in cases for size in generate.DEFAULT_SIZES} == set(previous)
+    assert cases == {case for case, _ in generate.cases(1, tmp_path)}
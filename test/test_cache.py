@@ -0,0 +1,40 @@
+import os
+
+from ustubby import batch
+from ustubby.cache import Cache, update_file
+
+
+def test_update_file(tmp_path):
+    path = tmp_path / "out" / "example.c"
+    assert update_file(path, ["a", "b"])
+    assert path.read_text() == "a\nb"
+    os.utime(path, (0, 0))
+    assert not update_file(path, iter(["a", "b"]))
+    assert path.stat().st_mtime == 0
+    assert update_file(path, ["b"])
+    assert path.read_text() == "b"
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_cache_key():
+    cache = Cache("unused")
+    assert cache.key(b"source", module="a") == cache.key(b"source", module="a")
+    assert cache.key(b"source", module="a") != cache.key(b"source", module="b")
+    assert cache.key(b"source", module="a") != cache.key(b"changed", module="a")
+
+
+def test_generate_uses_cache(tmp_path):
+    source = tmp_path / "cache_example.py"
+    source.write_text('def add_ints(a: int, b: int) -> int:\n    """Adds two integers"""\n')
+    job = batch.Job(source, tmp_path / "cache_example.c")
+    cache = Cache(tmp_path / "cache")
+
+    result = batch.generate(job, cache)
+    assert not result.cached and result.written
+    result = batch.generate(job, cache)
+    assert result.cached and not result.written
+
+    job.output.unlink()
+    result = batch.generate(job, cache)
+    assert result.cached and result.written
+    assert "cache_example_add_ints" in job.output.read_text()
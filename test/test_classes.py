@@ -0,0 +1,161 @@
+import inspect
+import types
+
+import pytest
+
+import ustubby
+from ustubby import static
+
+SOURCE = '''"""Example module"""
+
+
+class Counter:
+    """Counts things"""
+    count: int
+    step: float = 1.0
+    label: str
+
+    def __init__(self, count: int, label: str, step: float = 1.0):
+        """Starts counting at count"""
+
+    def increment(self, by: int) -> int:
+        """Adds by to count"""
+
+
+class Point:
+    x: float
+    y: float = 0.0
+
+    def scale(self, factor: float, *, about_origin: bool = True) -> None:
+        """Scales the point"""
+
+
+def distance(a: Point, b: Point) -> float:
+    """Distance between two points"""
+'''
+
+
+def test_stub_class():
+    c_output = ustubby.stub_module(static.load_source(SOURCE, "example"))
+    assert """
+//Counts things
+typedef struct _example_Counter_obj_t {
+    mp_obj_base_t base;
+    mp_int_t count;
+    mp_float_t step;
+    mp_obj_t label;
+} example_Counter_obj_t;
+
+extern const mp_obj_type_t example_Counter_type;
+
+//Starts counting at count
+STATIC mp_obj_t example_Counter_make_new(const mp_obj_type_t *type, size_t n_args, size_t n_kw, const mp_obj_t *args) {
+    mp_arg_check_num(n_args, n_kw, 2, 3, false);
+    mp_int_t count = mp_obj_get_int(args[0]);
+    const char* label = mp_obj_str_get_str(args[1]);
+    mp_float_t step = n_args > 2 ? mp_obj_get_float(args[2]) : 1.0;
+    example_Counter_obj_t *self = m_new_obj(example_Counter_obj_t);
+    self->base.type = type;
+    self->count = count;
+    self->step = step;
+    self->label = args[1];
+
+    //Your code here
+
+    return MP_OBJ_FROM_PTR(self);
+}
+""" in c_output
+    assert """
+//Adds by to count
+STATIC mp_obj_t example_Counter_increment(mp_obj_t self_obj, mp_obj_t by_obj) {
+    example_Counter_obj_t *self = MP_OBJ_TO_PTR(self_obj);
+    mp_int_t by = mp_obj_get_int(by_obj);
+""" in c_output
+    assert """STATIC const mp_rom_map_elem_t example_Counter_locals_dict_table[] = {
+\t{ MP_ROM_QSTR(MP_QSTR_increment), MP_ROM_PTR(&example_Counter_increment_obj) },
+};
+STATIC MP_DEFINE_CONST_DICT(example_Counter_locals_dict, example_Counter_locals_dict_table);
+
+const mp_obj_type_t example_Counter_type = {
+\t{ &mp_type_type },
+\t.name = MP_QSTR_Counter,
+\t.make_new = example_Counter_make_new,
+\t.attr = example_Counter_attr,
+\t.locals_dict = (mp_obj_dict_t*)&example_Counter_locals_dict,
+};""" in c_output
+    assert "\t{ MP_ROM_QSTR(MP_QSTR_Counter), MP_ROM_PTR(&example_Counter_type) }," in c_output
+    assert "    example_Point_obj_t *a = MP_OBJ_TO_PTR(a_obj);" in c_output
+
+    module = static.load_source(SOURCE.replace("b: Point)", "*, b: Point = None)"), "example")
+    c_output = ustubby.stub_module(module)
+    assert "    example_Point_obj_t *b = args[ARG_b].u_obj != mp_const_none ? " \
+           "MP_OBJ_TO_PTR(args[ARG_b].u_obj) : NULL;" in c_output
+
+
+def test_class_attr_and_fields_constructor():
+    point = static.load_source(SOURCE, "example").Point
+    lines = ustubby.stub_class(point).splitlines()
+    assert "    mp_arg_check_num(n_args, n_kw, 1, 2, false);" in lines
+    assert "    mp_float_t y = n_args > 1 ? mp_obj_get_float(args[1]) : 0.0;" in lines
+    assert "    self->y = y;" in lines
+    assert lines[lines.index("            case MP_QSTR_x:") + 1] == "                dest[0] = mp_obj_new_float(self->x);"
+    assert lines[lines.index("            case MP_QSTR_y:", lines.index("        // Store attribute")) + 1] == \
+        "                self->y = mp_obj_get_float(dest[1]);"
+    assert "        dest[1] = MP_OBJ_SENTINEL;" in lines
+    # Keyword methods unpack self before mp_arg_parse_all skips it
+    assert "    example_Point_obj_t *self = MP_OBJ_TO_PTR(pos_args[0]);" in lines
+    assert "    if (kw_args->used == 0 && n_args >= 2 && n_args <= 2) {" not in lines
+    assert "MP_DEFINE_CONST_FUN_OBJ_KW(example_Point_scale_obj, 1, example_Point_scale);" in lines
+    assert "        { MP_QSTR_about_origin, MP_ARG_KW_ONLY | MP_ARG_BOOL, { .u_bool = true } }," in lines
+    assert "    mp_float_t factor = mp_obj_get_float(args[ARG_factor].u_obj);" in lines
+
+
+def test_keyword_float_default():
+    def move(dx: float = 0.5, *, unit: str = "mm") -> None:
+        """"""
+
+    params = inspect.signature(move).parameters
+    assert ustubby.allowed_arg("dx", params["dx"]) == "{ MP_QSTR_dx, MP_ARG_OBJ, { .u_obj = MP_OBJ_NULL } },"
+    assert ustubby.arg_unpack(params).splitlines() == [
+        "\tmp_float_t dx = args[ARG_dx].u_obj == MP_OBJ_NULL ? 0.5 : mp_obj_get_float(args[ARG_dx].u_obj);",
+        '\tconst char* unit = args[ARG_unit].u_obj == MP_OBJ_NULL ? "mm" : mp_obj_str_get_str(args[ARG_unit].u_obj);',
+    ]
+
+
+def test_class_init_rejects_keyword_only():
+    class Sensor:
+        def __init__(self, *, pin: int):
+            """"""
+
+    Sensor.__module__ = "example"
+    with pytest.raises(ValueError):
+        ustubby.stub_class(Sensor)
+
+
+def test_stub_module_skips_imported_classes():
+    mod = types.ModuleType("example")
+    mod.Out = ustubby.Out
+    assert "Out" not in ustubby.stub_module(mod)
+
+
+def test_only_classes_of_the_module_are_native():
+    import collections
+
+    def unannotated(a) -> None:
+        """"""
+
+    def ordered(a: collections.OrderedDict) -> None:
+        """"""
+
+    def var_args(*args, **kwargs) -> None:
+        """"""
+
+    for f in (unannotated, ordered, var_args):
+        f.__module__ = "example"
+        with pytest.raises(TypeError, match="annotat"):
+            ustubby.stub_function(f)
+    mod = static.load_source(SOURCE, "example")
+    assert "    example_Point_obj_t *a = MP_OBJ_TO_PTR(a_obj);" in ustubby.stub_module(mod)
+    # Without the module the class isn't stubbed along with the function
+    with pytest.raises(TypeError, match="Point"):
+        ustubby.stub_function(mod.distance)
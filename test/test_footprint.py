@@ -0,0 +1,54 @@
+import json
+
+from ustubby import footprint, registers, static
+
+SOURCE = '''"""Example module"""
+
+
+def add_ints(a: int, b: int) -> int:
+    """Adds two integers"""
+
+
+def scale(value: float, *, factor: int = 2) -> float:
+    """Scales value"""
+
+
+def offset(value: float, factor: int) -> float:
+    """Offsets value"""
+'''
+
+
+def test_module_footprint():
+    report = footprint.module_footprint(static.load_source(SOURCE, "example"))
+    entries = {entry.name: entry for entry in report.entries}
+    add_ints = entries["add_ints"]
+    assert add_ints.kind == "positional"
+    # Function object, globals entry, three statements at two words each and the add_ints QSTR
+    assert add_ints.detail == {"fun_obj": 8, "table_entry": 8, "code": 24, "qstrs": 15}
+    assert add_ints.rom == 55 and add_ints.qstrs == 1
+    # The keyword function has a variable function object, an mp_arg_t table and QSTRs for its arguments
+    assert entries["scale"].detail["fun_obj"] == 12
+    assert entries["scale"].detail["arg_table"] == 16
+    assert entries["scale"].qstrs == 3
+    # value and factor were already charged to scale
+    assert entries["offset"].qstrs == 1
+    assert report.total.qstrs == 6
+    assert report.total.rom == sum(entry.rom for entry in report.entries) + 28 + footprint.Target().qstr("example")
+    assert footprint.format_table(report).splitlines()[1].startswith("scale")
+
+    wide = footprint.module_footprint(static.load_source(SOURCE, "example"), footprint.Target(word_size=8))
+    assert wide.total.rom > report.total.rom
+    assert json.loads(footprint.format_json([report]))[0]["total"]["rom"] == report.total.rom
+
+
+def test_register_table_is_smaller():
+    regmap = registers.RegisterMap("csr")
+    for index in range(50):
+        regmap.append(f"reg_{index}", 0x82000000 + 4 * index)
+    functions = footprint.module_footprint(regmap.to_module())
+    table = footprint.register_table_footprint(regmap)
+    # Two accessors per register plus burst read, view and write for the one run of consecutive registers
+    assert len(functions.entries) == 103
+    # The read and write accessors, a row per register and the same burst functions
+    assert len(table.entries) == 55
+    assert table.total.rom < functions.total.rom
@@ -0,0 +1,65 @@
+import shutil
+import subprocess
+import types
+
+import pytest
+
+import ustubby
+from ustubby import harness
+
+
+def example_module():
+    def add_ints(a: int, b: int) -> int:
+        """"""
+
+    def scale(value: float, factor: float = 2.0) -> float:
+        """"""
+
+    def name(index: int, *, upper: bool = False) -> str:
+        """"""
+
+    mod = types.ModuleType("example")
+    for f in (add_ints, scale, name):
+        f.__module__ = "example"
+        setattr(mod, f.__name__, f)
+    return mod
+
+
+def test_harness_module_source():
+    source = list(harness.iter_module_source(example_module()))
+    assert "    memset(&ret_val, 0, sizeof(ret_val));" in source
+    assert '    return mp_obj_new_str("", 0);' in source
+    assert not any("//Your code here" in line for line in source)
+
+
+def test_harness_calls():
+    calls = list(harness.calls(example_module()))
+    assert [(call.label, call.convention) for call in calls] == [
+        ("add_ints", "OBJ_2"), ("name", "KW"), ("name(kw)", "KW"), ("scale", "VAR_BETWEEN")]
+    assert calls[1].args == ["mp_const_none", "MP_OBJ_NEW_SMALL_INT(3)"]
+    assert calls[2].kwargs == {"upper": "mp_const_true"}
+    assert harness.sample_arg(ustubby.Out[bytearray]) == "shim_new_array(&mp_type_bytearray, 'B', 16)"
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+def test_harness_compiles_and_runs(tmp_path):
+    harness.write_harness(example_module(), tmp_path)
+    subprocess.run(["gcc", "-O2", "harness.c", "-o", "harness"], cwd=tmp_path, check=True)
+    output = subprocess.run([str(tmp_path / "harness"), "1000"], check=True, capture_output=True, text=True).stdout
+    for label in ("add_ints", "name(kw)", "scale", "OBJ_2", "VAR_BETWEEN", "KW"):
+        assert label in output
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+def test_harness_compiles_none_defaults(tmp_path):
+    def read(count: int, *, data: bytes = None, scale: float = None) -> int:
+        """"""
+
+    read.__module__ = "example"
+    mod = types.ModuleType("example")
+    mod.read = read
+    harness.write_harness(mod, tmp_path)
+    assert "MP_ROM_NONE" in (tmp_path / "example.c").read_text()
+    subprocess.run(["gcc", "-O2", "harness.c", "-o", "harness"], cwd=tmp_path, check=True)
+    output = subprocess.run([str(tmp_path / "harness"), "1000"], check=True, capture_output=True, text=True).stdout
+    assert "read(kw)" in output
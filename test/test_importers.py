@@ -0,0 +1,122 @@
+import io
+
+import pytest
+
+import ustubby
+from ustubby import batch, importers
+
+SVD = """<?xml version="1.0" encoding="utf-8"?>
+<device schemaVersion="1.3">
+  <name>EXAMPLE</name>
+  <size>32</size>
+  <access>read-write</access>
+  <peripherals>
+    <peripheral derivedFrom="TIMER0">
+      <name>TIMER1</name>
+      <baseAddress>0x40001000</baseAddress>
+    </peripheral>
+    <peripheral>
+      <name>TIMER0</name>
+      <baseAddress>0x40000000</baseAddress>
+      <registers>
+        <register>
+          <name>CTRL</name>
+          <addressOffset>0x0</addressOffset>
+          <fields>
+            <field><name>EN</name><bitOffset>0</bitOffset><bitWidth>1</bitWidth></field>
+            <field><name>MODE</name><bitRange>[6:4]</bitRange></field>
+          </fields>
+        </register>
+        <register>
+          <name>COUNT</name>
+          <addressOffset>0x4</addressOffset>
+          <size>64</size>
+          <access>read-only</access>
+        </register>
+        <cluster>
+          <dim>2</dim>
+          <dimIncrement>0x8</dimIncrement>
+          <name>CH[%s]</name>
+          <addressOffset>0x10</addressOffset>
+          <register>
+            <name>CC</name>
+            <addressOffset>0x4</addressOffset>
+            <access>write-only</access>
+          </register>
+        </cluster>
+      </registers>
+    </peripheral>
+    <peripheral derivedFrom="TIMER0">
+      <name>TIMER2</name>
+      <baseAddress>0x40002000</baseAddress>
+    </peripheral>
+  </peripherals>
+</device>
+"""
+
+JSON = """[
+  {"name": "ctrl_reset", "address": "0x82001000", "access": "rw",
+   "fields": [{"name": "enable", "offset": 0, "width": 1}]},
+  {"name": "ctrl_bus_errors", "address": 2181042196, "length": 2, "access": "ro"}
+]
+"""
+
+
+def test_iter_svd(tmp_path):
+    path = tmp_path / "example.svd"
+    path.write_text(SVD)
+    rows = list(importers.iter_svd(path))
+    timer0 = [
+        ["csr_register", "TIMER0_CTRL", "0x40000000", "1", "rw"],
+        ["csr_field", "TIMER0_CTRL", "EN", "0", "1"],
+        ["csr_field", "TIMER0_CTRL", "MODE", "4", "3"],
+        ["csr_register", "TIMER0_COUNT", "0x40000004", "2", "ro"],
+        ["csr_register", "TIMER0_CH0_CC", "0x40000014", "1", "wo"],
+        ["csr_register", "TIMER0_CH1_CC", "0x4000001c", "1", "wo"],
+    ]
+    assert rows[:6] == timer0
+    # TIMER1 is derived from TIMER0 before it is defined, TIMER2 after
+    assert rows[6][1:3] == ["TIMER1_CTRL", "0x40001000"]
+    assert rows[12][1:3] == ["TIMER2_CTRL", "0x40002000"]
+    assert len(rows) == 18
+
+    regmap = ustubby.RegisterMap.from_file(path, "example")
+    assert regmap.fields["TIMER2_CTRL"][1] == ("TIMER2_CTRL", "MODE", 4, 3)
+    c_output = ustubby.stub_registers(regmap)
+    assert "    TIMER1_CTRL_write((TIMER1_CTRL_read() & ~(0x7u << 4)) | (((uint32_t)value & 0x7u) << 4));" in c_output
+    assert ustubby.stub_module(ustubby.parse_svd(path, "example")).count("STATIC mp_obj_t") == \
+        c_output.count("STATIC mp_obj_t")
+
+
+def test_iter_svd_unknown_base(tmp_path):
+    path = tmp_path / "example.svd"
+    path.write_text(SVD.replace('derivedFrom="TIMER0"', 'derivedFrom="TIMER9"'))
+    with pytest.raises(ValueError, match="TIMER9"):
+        list(importers.iter_svd(path))
+
+
+def test_iter_json(tmp_path):
+    path = tmp_path / "regs.json"
+    path.write_text(JSON)
+    assert list(importers.iter_json(path)) == [
+        ["csr_register", "ctrl_reset", "0x82001000", "1", "rw"],
+        ["csr_field", "ctrl_reset", "enable", "0", "1"],
+        ["csr_register", "ctrl_bus_errors", "0x82001014", "2", "ro"],
+    ]
+    # Items split across reads are decoded once the rest has been read
+    assert list(importers.iter_json_array(io.StringIO(JSON), chunk=7)) == \
+        list(importers.iter_json_array(io.StringIO(JSON)))
+    assert list(importers.iter_json_array(io.StringIO("[12345, 6]"), chunk=3)) == [12345, 6]
+    with pytest.raises(ValueError):
+        list(importers.iter_json_array(io.StringIO('{"name": "csr"}')))
+
+
+def test_batch_register_maps(tmp_path):
+    (tmp_path / "example.svd").write_text(SVD)
+    (tmp_path / "regs.json").write_text(JSON)
+    jobs = batch.plan(batch.collect_inputs([str(tmp_path / "example.svd"), str(tmp_path / "regs.json")]))
+    for job in jobs:
+        assert batch.generate(job).written
+    assert "MP_REGISTER_MODULE(MP_QSTR_example," in jobs[0].output.read_text()
+    assert "csr_ctrl_reset_enable_read" not in jobs[1].output.read_text()
+    assert "regs_ctrl_reset_enable_read" in jobs[1].output.read_text()
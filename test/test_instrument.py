@@ -0,0 +1,61 @@
+import ustubby
+from ustubby import static
+
+SOURCE = '''"""Example module"""
+
+
+class Counter:
+    count: int
+
+    def increment(self, by: int) -> int:
+        """Adds by to count"""
+
+
+def add_ints(a: int, b: int) -> int:
+    """Adds two integers"""
+
+
+def scale(value: float, *, factor: int = 2) -> float:
+    """Scales value"""
+'''
+
+
+def test_instrument_module():
+    mod = static.load_source(SOURCE, "example")
+    lines = ustubby.stub_module(mod, instrument=True).splitlines()
+    assert "#define EXAMPLE_IMPL(name) name##_impl" in lines
+    assert "#define MODULE_EXAMPLE_TICKS() mp_hal_ticks_us()" in lines
+    # The function itself keeps its name unless MODULE_EXAMPLE_INSTRUMENT is set
+    start = lines.index("STATIC mp_obj_t EXAMPLE_IMPL(example_add_ints)(mp_obj_t a_obj, mp_obj_t b_obj) {")
+    assert lines[start + 9:start + 19] == [
+        "#if MODULE_EXAMPLE_INSTRUMENT",
+        "STATIC example_stats_t example_add_ints_stats;",
+        "STATIC mp_obj_t example_add_ints(mp_obj_t a_obj, mp_obj_t b_obj) {",
+        "    mp_uint_t start = MODULE_EXAMPLE_TICKS();",
+        "    mp_obj_t ret = example_add_ints_impl(a_obj, b_obj);",
+        "    example_stats_record(&example_add_ints_stats, start);",
+        "    return ret;",
+        "}",
+        "#endif",
+        "MP_DEFINE_CONST_FUN_OBJ_2(example_add_ints_obj, example_add_ints);",
+    ]
+    assert "    mp_obj_t ret = example_scale_impl(n_args, pos_args, kw_args);" in lines
+    assert "STATIC mp_obj_t EXAMPLE_IMPL(example_Counter_increment)(mp_obj_t self_obj, mp_obj_t by_obj) {" in lines
+    assert lines[lines.index("STATIC const char *const example_stats_names[] = {") + 1:][:3] == [
+        '    "Counter.increment",', '    "add_ints",', '    "scale",']
+    table = lines.index("STATIC const mp_rom_map_elem_t example_module_globals_table[] = {")
+    assert lines[table + 5:table + 9] == [
+        "#if MODULE_EXAMPLE_INSTRUMENT",
+        "\t{ MP_ROM_QSTR(MP_QSTR__stats), MP_ROM_PTR(&example__stats_obj) },",
+        "\t{ MP_ROM_QSTR(MP_QSTR__reset_stats), MP_ROM_PTR(&example__reset_stats_obj) },",
+        "#endif",
+    ]
+
+
+def test_instrument_function():
+    mod = static.load_source(SOURCE, "example")
+    assert "MODULE_EXAMPLE_INSTRUMENT" not in ustubby.stub_module(mod)
+    container = ustubby.FunctionContainer().load_python(mod.add_ints)
+    assert container.to_c(instrument=True).splitlines() == \
+        ustubby.stub_function(mod.add_ints, instrument=True).splitlines()[1:]
+    assert "STATIC mp_obj_t example_add_ints(mp_obj_t a_obj, mp_obj_t b_obj) {" in container.to_c().splitlines()
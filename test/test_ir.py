@@ -0,0 +1,71 @@
+import pytest
+
+import ustubby
+from ustubby import ir, static
+
+
+def scale(value: float, factor: int = 2, *, clamp: bool = False) -> float:
+    """Scales value"""
+
+
+scale.__module__ = "example"
+
+
+def test_build_and_render_function():
+    fn = ir.build_function(scale)
+    assert fn.name == "scale"
+    assert fn.c_name == "example_scale"
+    assert fn.convention == "keyword"
+    assert [param.name for param in fn.parameters] == ["value", "factor", "clamp"]
+    assert fn.ret == ir.Return(float, "object")
+    assert "\n".join(ir.render_function(fn)) == ustubby.stub_function(scale)
+
+
+def test_container_renders_through_ir():
+    container = ustubby.FunctionContainer().load_python(scale)
+    assert container.to_ir() == ir.build_function(scale)
+    assert container.to_c().splitlines() == ustubby.stub_function(scale).splitlines()[1:]
+
+
+def test_replace_and_diff():
+    fn = ir.build_function(scale)
+    renamed = fn.replace(c_name="example_scale_fast", ret=fn.ret.replace(annotation=int))
+    assert fn.c_name == "example_scale"
+    assert "STATIC mp_obj_t example_scale_fast(size_t n_args, const mp_obj_t *pos_args, mp_map_t *kw_args) {" in \
+        ir.render_function(renamed)
+    assert "    return mp_obj_new_int(ret_val);" in ir.render_function(renamed)
+    assert ir.diff(fn, renamed) == ["c_name: 'example_scale' -> 'example_scale_fast'",
+                                    "ret.annotation: 'float' -> 'int'"]
+    assert ir.diff(fn, ir.build_function(scale)) == []
+
+
+def test_as_dict():
+    data = ir.build_function(scale).as_dict()
+    assert data["parameters"][1] == {"name": "factor", "annotation": "int", "kind": "POSITIONAL_OR_KEYWORD",
+                                     "default": 2}
+    assert data["ret"] == {"annotation": "float", "mode": "object", "out": None, "value": None}
+    with pytest.raises(TypeError):
+        hash(ir.build_function(scale))
+
+
+def test_build_and_render_class():
+    module = static.load_source('''
+class Counter:
+    """Counts"""
+    count: int
+    label = "x"
+
+    def increment(self, by: int) -> int:
+        """"""
+''', "example")
+    node = ir.build_module(module)
+    counter, = node.classes
+    assert counter.c_name == "example_Counter"
+    assert counter.fields == (ir.Field("count", int),)
+    assert [param.name for param in counter.make_new.parameters] == ["count"]
+    assert [fn.c_name for fn in counter.methods] == ["example_Counter_increment"]
+    assert "\n".join(ustubby.classes.render_class(counter)) == ustubby.stub_class(module.Counter)
+    assert "    self->count = 5;" in ir.render_module(node.replace(
+        classes=[counter.replace(make_new=counter.make_new.replace(code="    self->count = 5;"))]))
+    assert ir.diff(node, node.replace(classes=[counter.replace(doc="Counts up")])) == [
+        "classes.0.doc: 'Counts' -> 'Counts up'"]
@@ -0,0 +1,223 @@
+import pytest
+
+import ustubby
+from ustubby import batch
+
+CSR_CSV = """#--------------------------------------------------------------------------------
+# Auto-generated by Migen (5585912) & LiteX (e637aa65) on 2019-08-04 03:04:29
+#--------------------------------------------------------------------------------
+csr_base,ctrl,0x82001000,,
+csr_register,cas_leds_out,0x82000800,1,rw
+csr_register,ctrl_reset,0x82001000,1,rw
+csr_register,ctrl_bus_errors,0x82001014,4,ro
+"""
+
+
+def write_csv(tmp_path):
+    path = tmp_path / "csr.csv"
+    path.write_text(CSR_CSV)
+    return path
+
+
+def test_register_map_from_csv(tmp_path):
+    regmap = ustubby.RegisterMap.from_csv(write_csv(tmp_path))
+    assert len(regmap) == 3
+    assert list(regmap)[2] == ("ctrl_bus_errors", 0x82001014, 4, "ro")
+    assert regmap[-1] == regmap[2]
+    assert regmap[0].hex_address == "0x82000800"
+
+
+def test_stub_registers():
+    regmap = ustubby.RegisterMap("csr")
+    regmap.append("ctrl_bus_errors", 0x82001014, 4, "ro")
+    regmap.append("ctrl_reset", 0x82001000, 1, "wo")
+    lines = """
+//:return: value from ctrl_bus_errors @ register 0x82001014
+STATIC mp_obj_t csr_ctrl_bus_errors_read() {
+
+    uint64_t ret_val = ctrl_bus_errors_read();
+
+    return mp_obj_new_int_from_ull(ret_val);
+}
+MP_DEFINE_CONST_FUN_OBJ_0(csr_ctrl_bus_errors_read_obj, csr_ctrl_bus_errors_read);
+
+//writes a value to ctrl_reset @ register 0x82001000
+STATIC mp_obj_t csr_ctrl_reset_write(mp_obj_t value_obj) {
+    mp_int_t value = mp_obj_get_int(value_obj);
+
+    ctrl_reset_write(value);
+
+    return mp_const_none;
+}
+MP_DEFINE_CONST_FUN_OBJ_1(csr_ctrl_reset_write_obj, csr_ctrl_reset_write);
+
+STATIC const mp_rom_map_elem_t csr_module_globals_table[] = {
+\t{ MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_csr) },
+\t{ MP_ROM_QSTR(MP_QSTR_ctrl_bus_errors_read), MP_ROM_PTR(&csr_ctrl_bus_errors_read_obj) },
+\t{ MP_ROM_QSTR(MP_QSTR_ctrl_reset_write), MP_ROM_PTR(&csr_ctrl_reset_write_obj) },
+};"""
+    assert lines in ustubby.stub_registers(regmap)
+
+    regmap.append("ctrl_scratch", 0x82001004, 2, "rw")
+    assert """    } else if (!mp_obj_is_int(value)) {
+        mp_raise_TypeError(MP_ERROR_TEXT("register value must be an int"));
+    } else {
+        mp_obj_int_to_bytes_impl(value, MP_ENDIANNESS_BIG, sizeof(wide_value), (byte *)&wide_value);""" in \
+        ustubby.stub_registers(regmap)
+
+
+def test_parse_csv_matches_register_map(tmp_path):
+    path = write_csv(tmp_path)
+    legacy = ustubby.stub_module(ustubby.parse_csv(path))
+    for register in ustubby.RegisterMap.from_csv(path):
+        assert f"MP_DEFINE_CONST_FUN_OBJ_0(csr_{register.name}_read_obj, csr_{register.name}_read);" in legacy
+        assert f"ret_val = {register.name}_read();" in legacy
+    assert "ctrl_reset_write(value);" in legacy
+    assert "ctrl_bus_errors_write" not in legacy
+
+
+def test_batch_csv(tmp_path):
+    path = write_csv(tmp_path)
+    assert batch.collect_inputs([str(path)]) == [path]
+    job = batch.plan([path])[0]
+    assert batch.generate(job).written
+    assert "MP_REGISTER_MODULE(MP_QSTR_csr," in job.output.read_text()
+
+
+def test_stub_register_table(tmp_path):
+    c_output = ustubby.stub_register_table(ustubby.RegisterMap.from_csv(write_csv(tmp_path)))
+    assert """STATIC const csr_register_t csr_registers[] = {
+    { 0x82000800, 1, USTUBBY_CSR_READABLE | USTUBBY_CSR_WRITABLE }, // cas_leds_out
+    { 0x82001000, 1, USTUBBY_CSR_READABLE | USTUBBY_CSR_WRITABLE }, // ctrl_reset
+    { 0x82001014, 4, USTUBBY_CSR_READABLE }, // ctrl_bus_errors
+};""" in c_output
+    assert "MP_DEFINE_CONST_FUN_OBJ_1(csr_read_obj, csr_read);" in c_output
+    assert "MP_DEFINE_CONST_FUN_OBJ_2(csr_write_obj, csr_write);" in c_output
+    assert "\t{ MP_ROM_QSTR(MP_QSTR_read), MP_ROM_PTR(&csr_read_obj) }," in c_output
+    assert "\t{ MP_ROM_QSTR(MP_QSTR_CTRL_BUS_ERRORS), MP_ROM_INT(2) }," in c_output
+    assert "csr_ctrl_reset_read" not in c_output
+    assert '#include "py/objint.h"' in c_output
+    assert 'mp_raise_TypeError(MP_ERROR_TEXT("register value must be an int"));' in c_output
+
+    for address, length in ((0x100000000, 1), (0x82001000, 256)):
+        regmap = ustubby.RegisterMap("csr")
+        regmap.append("ctrl_reset", address, length, "rw")
+        with pytest.raises(ValueError, match="ctrl_reset"):
+            ustubby.stub_register_table(regmap)
+
+
+def test_register_runs():
+    regmap = ustubby.RegisterMap("csr")
+    regmap.append("ctrl_reset", 0x82001000, 1, "rw")
+    regmap.append("ctrl_scratch", 0x82001004, 4, "rw")
+    regmap.append("ctrl_bus_errors", 0x82001014, 4, "ro")
+    regmap.append("leds_out", 0x82002000, 1, "rw")
+    reads = list(regmap.runs(readable=True))
+    assert [(run.name, run.address, run.words, run.writable) for run in reads] == [
+        ("ctrl_reset", 0x82001000, 9, False)]
+    assert [(run.name, run.words) for run in regmap.runs(readable=False)] == [("ctrl_reset", 5)]
+
+    c_output = ustubby.stub_registers(regmap)
+    assert "        uint32_t value = csr_read_simple(0x82001000 + i * 4);" in c_output
+    assert "        csr_write_simple(value, 0x82001000 + i * 4);" in c_output
+    assert "    return mp_obj_new_memoryview('I', 9, (void *)(uintptr_t)0x82001000);" in c_output
+    assert "\t{ MP_ROM_QSTR(MP_QSTR_ctrl_reset_burst_view), MP_ROM_PTR(&csr_ctrl_reset_burst_view_obj) }," in c_output
+    assert '#include "py/objarray.h"' in c_output
+    assert "leds_out_burst" not in c_output
+
+    # Rows out of address order give the same runs
+    shuffled = ustubby.RegisterMap("csr")
+    for index in (3, 1, 0, 2):
+        shuffled.append(*regmap[index])
+    assert list(shuffled.runs(readable=True)) == reads
+    assert list(regmap.address_order()) == [0, 1, 2, 3]
+    assert list(shuffled.address_order()) == [2, 1, 3, 0]
+
+
+def test_parse_csv_bursts(tmp_path):
+    path = tmp_path / "csr.csv"
+    path.write_text(CSR_CSV.replace("0x82001014,4", "0x82001004,4"))
+    legacy = ustubby.stub_module(ustubby.parse_csv(path))
+    burst = ustubby.stub_registers(ustubby.RegisterMap.from_csv(path))
+    for name in ("ctrl_reset_burst_read", "ctrl_reset_burst_view"):
+        start = legacy.index(f"STATIC mp_obj_t csr_{name}(")
+        assert legacy[start:legacy.index("MP_DEFINE", start)] in burst
+    assert "ctrl_reset_burst_write" not in legacy
+
+
+FIELDS_CSV = CSR_CSV + """csr_register,ctrl_scratch,0x82001004,1,wo
+csr_field,ctrl_reset,enable,0,1
+csr_field,ctrl_reset,mode,4,3
+csr_field,ctrl_scratch,value,8,8
+csr_field,ctrl_bus_errors,count,8,48
+"""
+
+
+def test_register_fields(tmp_path):
+    path = tmp_path / "csr.csv"
+    path.write_text(FIELDS_CSV)
+    regmap = ustubby.RegisterMap.from_csv(path)
+    assert regmap.fields["ctrl_reset"][1] == ("ctrl_reset", "mode", 4, 3)
+    c_output = ustubby.stub_registers(regmap)
+    assert "    ret_val = (ctrl_reset_read() >> 4) & 0x7u;" in c_output
+    assert "    ctrl_reset_write((ctrl_reset_read() & ~(0x7u << 4)) | (((uint32_t)value & 0x7u) << 4));" in c_output
+    assert "    ctrl_scratch_write((((uint32_t)value & 0xffu) << 8));" in c_output
+    assert "    uint64_t ret_val = (ctrl_bus_errors_read() >> 8) & 0xffffffffffffULL;" in c_output
+    assert "\t{ MP_ROM_QSTR(MP_QSTR_ctrl_reset_enable_write), MP_ROM_PTR(&csr_ctrl_reset_enable_write_obj) }," \
+        in c_output
+    assert "ctrl_scratch_value_read" not in c_output
+    assert "ctrl_bus_errors_count_write" not in c_output
+
+    legacy = ustubby.stub_module(ustubby.parse_csv(path))
+    for name in ("ctrl_reset_mode_write", "ctrl_bus_errors_count_read", "ctrl_bus_errors_read"):
+        start = legacy.index(f"STATIC mp_obj_t csr_{name}(")
+        assert legacy[start:legacy.index("MP_DEFINE", start)] in c_output
+
+    regmap.append_field("ctrl_missing", "value", 0, 1)
+    with pytest.raises(ValueError, match="ctrl_missing"):
+        ustubby.stub_registers(regmap)
+
+    # ctrl_reset is a single 32 bit word
+    regmap = ustubby.RegisterMap.from_csv(path)
+    regmap.append_field("ctrl_reset", "high", 40, 4)
+    with pytest.raises(ValueError, match="high of ctrl_reset doesn't fit in its 32 bits"):
+        ustubby.stub_registers(regmap)
+
+
+def test_register_table_fields_and_bursts(tmp_path):
+    path = tmp_path / "csr.csv"
+    path.write_text(FIELDS_CSV.replace("0x82001014,4", "0x82001008,4"))
+    regmap = ustubby.RegisterMap.from_csv(path)
+    functions, table = ustubby.stub_registers(regmap), ustubby.stub_register_table(regmap)
+    for name in ("ctrl_reset_mode_write", "ctrl_bus_errors_count_read", "ctrl_reset_burst_write"):
+        start = functions.index(f"STATIC mp_obj_t csr_{name}(")
+        assert functions[start:functions.index("MP_DEFINE", start)] in table
+        assert f"\t{{ MP_ROM_QSTR(MP_QSTR_{name}), MP_ROM_PTR(&csr_{name}_obj) }}," in table
+    assert '#include "py/binary.h"' in table
+    assert "csr_ctrl_reset_read(" not in table
+
+    regmap.append_field("ctrl_missing", "value", 0, 1)
+    with pytest.raises(ValueError, match="ctrl_missing"):
+        ustubby.stub_register_table(regmap)
+
+
+def test_register_data_width(tmp_path):
+    path = tmp_path / "csr.csv"
+    path.write_text(FIELDS_CSV)
+    assert ustubby.RegisterMap.from_csv(path).data_width == 32
+    assert "#define USTUBBY_CSR_DATA_WIDTH 32" in ustubby.stub_register_table(ustubby.RegisterMap.from_csv(path))
+
+    # ctrl_bus_errors is four 8 bit words, so its field at bits 8 to 55 doesn't fit in either mode
+    path.write_text("constant,config_csr_data_width,8,,\n" + FIELDS_CSV)
+    regmap = ustubby.RegisterMap.from_csv(path)
+    assert regmap.data_width == 8
+    for stub in (ustubby.stub_registers, ustubby.stub_register_table):
+        with pytest.raises(ValueError, match="count of ctrl_bus_errors doesn't fit in its 32 bits"):
+            stub(regmap)
+    with pytest.raises(ValueError, match="count of ctrl_bus_errors doesn't fit in its 32 bits"):
+        ustubby.parse_csv(path)
+    path.write_text("constant,config_csr_data_width,8,,\n" + CSR_CSV)
+    assert "#define USTUBBY_CSR_DATA_WIDTH 8" in ustubby.stub_register_table(ustubby.RegisterMap.from_csv(path))
+
+    with pytest.raises(ValueError, match="CSR data width 64"):
+        ustubby.RegisterMap("csr", 64)
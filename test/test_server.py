@@ -0,0 +1,108 @@
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ustubby import client, server
+
+
+def save(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_server_keeps_modules_warm(tmp_path):
+    socket_path = str(tmp_path / "ustubby.sock")
+    save(tmp_path / "server_example.py", 'def add_ints(a: int, b: int) -> int:\n    """Adds"""\n', 1_000_000_000)
+    (tmp_path / "csr.csv").write_text("csr_base,ctrl,0x82000000,,\ncsr_register,ctrl_reset,0x82000000,1,rw\n")
+    running = server.Server(socket_path, max_entries=1)
+    thread = threading.Thread(target=running.serve_until_stopped)
+    thread.start()
+    try:
+        message = {"input": str(tmp_path / "server_example.py"), "output": str(tmp_path / "server_example.c")}
+        assert client.generate(message, socket_path) == {"error": None, "cached": False, "written": True,
+                                                         "server": True}
+        assert client.generate(message, socket_path)["written"] is False
+        assert (running.generator.warm.hits, running.generator.warm.misses) == (1, 1)
+
+        save(tmp_path / "server_example.py", 'def add_flts(a: int, b: int) -> int:\n    """Adds"""\n', 1_000_000_001)
+        assert client.generate(message, socket_path)["written"] is True
+        assert "server_example_add_flts" in (tmp_path / "server_example.c").read_text()
+
+        csv_message = {"input": str(tmp_path / "csr.csv"), "output": str(tmp_path / "csr.c")}
+        assert client.generate(csv_message, socket_path)["error"] is None
+        assert "csr_ctrl_reset_read" in (tmp_path / "csr.c").read_text()
+        # Evicted to stay within max_entries
+        assert "server_example" not in sys.modules
+        assert client.generate({"input": str(tmp_path / "missing.py"), "output": str(tmp_path / "missing.c")},
+                               socket_path)["error"].startswith(f"{tmp_path / 'missing.py'}: ")
+    finally:
+        assert client.stop(socket_path)
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+
+def test_client_falls_back_in_process(tmp_path):
+    (tmp_path / "client_example.py").write_text('def get_beta() -> float:\n    """beta"""\n')
+    assert client.main([str(tmp_path / "client_example.py"), "--static", "--socket", str(tmp_path / "none.sock")]) == 0
+    assert "client_example_get_beta" in (tmp_path / "client_example.c").read_text()
+    assert not client.stop(str(tmp_path / "none.sock"))
+
+
+def test_client_reports_unanswered_requests(tmp_path):
+    socket_path = str(tmp_path / "silent.sock")
+    (tmp_path / "client_example.py").write_text('def get_beta() -> float:\n    """beta"""\n')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(socket_path)
+        listener.listen()
+
+        def hang_up():
+            connection, _ = listener.accept()
+            connection.close()
+
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        response = client.generate({"input": str(tmp_path / "client_example.py"),
+                                    "output": str(tmp_path / "client_example.c"), "static": True}, socket_path)
+        thread.join()
+    # The server took the request, so it isn't generated again in process
+    assert response["server"] is True
+    assert response["error"].startswith("No answer from the server")
+    assert not (tmp_path / "client_example.c").exists()
+
+
+def test_server_accepts_parallel_requests(tmp_path):
+    socket_path = str(tmp_path / "ustubby.sock")
+    running = server.Server(socket_path)
+    thread = threading.Thread(target=running.serve_until_stopped)
+    thread.start()
+    try:
+        for index in range(16):
+            (tmp_path / f"parallel_{index}.py").write_text(f'def get_{index}() -> int:\n    """"""\n')
+        with ThreadPoolExecutor(16) as pool:
+            responses = list(pool.map(lambda index: client.generate(
+                {"input": str(tmp_path / f"parallel_{index}.py"), "output": str(tmp_path / f"parallel_{index}.c"),
+                 "static": True}, socket_path), range(16)))
+        assert all(response == {"error": None, "cached": False, "written": True, "server": True}
+                   for response in responses)
+    finally:
+        assert client.stop(socket_path)
+        thread.join()
+
+
+def test_remove_stale_socket(tmp_path):
+    # A typo in --socket pointing at a regular file mustn't delete it
+    regular = tmp_path / "notes.txt"
+    regular.write_text("keep me")
+    with pytest.raises(RuntimeError, match="isn't a socket"):
+        server.remove_stale_socket(str(regular))
+    assert regular.read_text() == "keep me"
+
+    stale = str(tmp_path / "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(stale)
+    server.remove_stale_socket(stale)
+    assert not os.path.exists(stale)
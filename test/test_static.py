@@ -0,0 +1,111 @@
+import ast
+import types
+
+import pytest
+
+import ustubby
+from ustubby import batch, static
+
+SOURCE = '''"""Example module"""
+import machine
+from typing import List
+
+machine.reset()
+
+
+def add_ints(a: int, b: int) -> int:
+    """Adds two integers
+    :param a:
+    :param b:
+    :return:a + b"""
+
+
+add_ints.code = "    ret_val = a + b;"
+
+
+@micropython.native
+def readfrom_mem(addr: int = 0, memaddr: int = 0, arg: object = None, *, addrsize: int = 8) -> str:
+    """
+    :param addr:
+    :param memaddr:
+    :param arg:
+    :param addrsize:
+    :return:
+    """
+'''
+
+
+def imported_module():
+    mod = types.ModuleType("example", "Example module")
+    exec(SOURCE.replace("import machine", "").replace("machine.reset()", "").replace("@micropython.native", ""),
+         mod.__dict__)
+    return mod
+
+
+def test_load_source_matches_import():
+    mod = static.load_source(SOURCE, "example")
+    assert mod.add_ints.code == "    ret_val = a + b;"
+    assert ustubby.stub_module(mod) == ustubby.stub_module(imported_module())
+
+
+def test_function_container_load_ast():
+    node = ast.parse(SOURCE).body[4]
+    func = ustubby.FunctionContainer().load_ast(node, "example")
+    assert func.to_c_func_def() == "STATIC mp_obj_t example_add_ints"
+    assert func.to_c_define() == "MP_DEFINE_CONST_FUN_OBJ_2(example_add_ints_obj, example_add_ints);"
+    assert func.to_c_return_val_init() == "mp_int_t ret_val;"
+
+    params = ustubby.ParametersContainer().load_ast(ast.parse(SOURCE).body[6].args)
+    assert params.type == "keyword"
+    assert params.parameters["addrsize"].default == 8
+
+
+def test_unsafe_annotation_rejected():
+    with pytest.raises(ValueError):
+        static.load_source("def f(a: __import__('os').system('true')) -> None:\n    pass\n", "example")
+
+
+def test_ustubby_calls_rejected(tmp_path):
+    evil = tmp_path / "evil.py"
+    marker = tmp_path / "ran"
+    evil.write_text(f"open({str(marker)!r}, 'w').close()\n")
+    annotation = f"(ustubby.batch.import_module(ustubby.batch.collect_inputs([{str(evil)!r}])[0]), int)[1]"
+    with pytest.raises(ValueError):
+        static.load_source(f"import ustubby\n\ndef f(a: {annotation}) -> None:\n    pass\n", "example")
+    with pytest.raises(ValueError):
+        static.load_source("import ustubby\n\ndef f(a: ustubby.batch.REGISTER_MODES['table']) -> None:\n    pass\n",
+                           "example")
+    # Decorators other than ustubby's own are left to the device rather than called
+    mod = static.load_source("import ustubby\n\n@ustubby.batch.import_module\ndef f(a: int) -> None:\n    pass\n",
+                             "example")
+    assert mod.f.__name__ == "f"
+    assert not marker.exists()
+
+
+def test_batch_static_job(tmp_path):
+    source = tmp_path / "static_example.py"
+    source.write_text(SOURCE)
+    job = batch.Job(source, tmp_path / "static_example.c", static=True)
+    assert batch.generate(job).written
+    assert "ret_val = a + b;" in job.output.read_text()
+
+
+def test_load_source_return_modes():
+    mod = static.load_source('''
+import array
+import ustubby
+from ustubby import Out
+
+
+@ustubby.return_mode("static")
+def status(channel: int) -> str:
+    """Reads the status of a channel"""
+
+
+def sample(out: Out[array.array]) -> int:
+    """Samples into out"""
+''', "example")
+    assert mod.status.return_mode == "static"
+    c_output = ustubby.stub_module(mod)
+    assert "    return MP_OBJ_NEW_QSTR(ret_val);" in c_output
+    assert "    mp_get_buffer_raise(out_obj, &out_bufinfo, MP_BUFFER_WRITE);" in c_output
@@ -0,0 +1,76 @@
+import shutil
+import subprocess
+
+import pytest
+
+import ustubby
+from ustubby import harness, ir, static
+
+SOURCE = '''"""Example module"""
+import ustubby
+
+
+@ustubby.many
+def add_ints(a: int, b: int) -> int:
+    """Adds two integers"""
+
+
+@ustubby.many
+def scale(value: float, gain: float = 2.0) -> float:
+    """Scales value"""
+
+
+def negate(a: int) -> int:
+    """Negates a"""
+'''
+
+
+def test_many_module():
+    mod = static.load_source(SOURCE, "example")
+    mod.add_ints.code = "\tret_val = a + b;"
+    lines = ustubby.stub_module(mod).splitlines()
+    assert "#define MODULE_EXAMPLE_MANY_BLOCK (16)" in lines
+    assert "STATIC void example_many_read_float(const mp_buffer_info_t *bufinfo, size_t start, size_t count, " \
+           "mp_float_t *block) {" in lines
+    start = lines.index("STATIC mp_obj_t example_add_ints_many(size_t n_args, const mp_obj_t *args) {")
+    assert lines[start + 32:start + 41] == [
+        "            mp_int_t a = a_block[many_i];",
+        "            mp_int_t b = b_block[many_i];",
+        "            mp_int_t ret_val;",
+        "",
+        "            ret_val = a + b;",
+        "",
+        "            ret_block[many_i] = ret_val;",
+        "        }",
+        "        example_many_write_int(&out_bufinfo, many_start, many_len, ret_block);",
+    ]
+    assert "    bool gain_many = n_args > 2 && example_many_arg(args[2], &gain_bufinfo, many_n);" in lines
+    assert "        mp_float_t gain_value = n_args > 2 ? mp_obj_get_float(args[2]) : 2.0;" in lines
+    assert "MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(example_scale_many_obj, 2, 3, example_scale_many);" in lines
+    table = lines.index("STATIC const mp_rom_map_elem_t example_module_globals_table[] = {")
+    assert [line.split("(")[1].split(")")[0] for line in lines[table + 2:table + 7]] == [
+        "MP_QSTR_add_ints", "MP_QSTR_add_ints_many", "MP_QSTR_negate", "MP_QSTR_scale", "MP_QSTR_scale_many"]
+    assert "example_negate_many" not in "\n".join(lines)
+
+
+def test_many_rejects_unbatchable():
+    @ustubby.many
+    def join(a: str, b: int) -> int:
+        pass
+
+    join.__module__ = "example"
+    with pytest.raises(ValueError, match="parameter a"):
+        ustubby.stub_function(join)
+    assert ir.build_function(join, True).many is None
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+def test_many_harness(tmp_path):
+    mod = static.load_source(SOURCE, "example")
+    mod.add_ints.code = "\tret_val = a + b;"
+    harness.write_harness(mod, tmp_path)
+    subprocess.run(["gcc", "-O2", "-Wall", "-Werror", "-Wno-unused-variable", "harness.c", "-o", "harness"],
+                   cwd=tmp_path, check=True)
+    output = subprocess.run([str(tmp_path / "harness"), "1000"], check=True, capture_output=True, text=True).stdout
+    assert f"add_ints_many[{harness.MANY_LENGTH}]" in output
+    assert "scale_many" in output
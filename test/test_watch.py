@@ -0,0 +1,46 @@
+import os
+import sys
+
+from ustubby import batch, watch
+
+
+def save(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_regenerates_changed_modules(tmp_path):
+    save(tmp_path / "watch_example.py", 'def add_ints(a: int, b: int) -> int:\n    """Adds"""\n', 1_000_000_000)
+    save(tmp_path / "watch_other.py", 'def other() -> None:\n    """Other"""\n', 1_000_000_000)
+    watcher = watch.Watcher([str(tmp_path)], tmp_path / "out", debounce=0)
+    assert watcher.changed() == []
+
+    # Same size and within the same second, so stale bytecode would still look valid
+    save(tmp_path / "watch_example.py", 'def add_flts(a: int, b: int) -> int:\n    """Adds"""\n', 1_000_000_001)
+    save(tmp_path / "watch_new.py", 'def new() -> None:\n    """New"""\n', 1_000_000_000)
+    changed = watcher.wait(sleep=lambda seconds: None)
+    assert changed == [tmp_path / "watch_example.py", tmp_path / "watch_new.py"]
+    results = watcher.regenerate(changed)
+    assert [watch.describe(result) for result in results] == [f"Wrote {tmp_path / 'out' / 'watch_example.c'}",
+                                                              f"Wrote {tmp_path / 'out' / 'watch_new.c'}"]
+    assert "watch_example_add_flts" in (tmp_path / "out" / "watch_example.c").read_text()
+    assert not (tmp_path / "out" / "watch_other.c").exists()
+
+
+def test_reload_error_keeps_previous_module(tmp_path):
+    save(tmp_path / "watch_broken.py", 'def ok() -> None:\n    """Ok"""\n', 1_000_000_000)
+    batch.import_module(tmp_path / "watch_broken.py", reload=True)
+    save(tmp_path / "watch_broken.py", 'def ok( -> None:\n', 1_000_000_001)
+    watcher = watch.Watcher([str(tmp_path)], tmp_path / "out")
+    result, = watcher.regenerate([tmp_path / "watch_broken.py"])
+    assert result.error.startswith(f"{tmp_path / 'watch_broken.py'}: SyntaxError")
+    assert hasattr(sys.modules["watch_broken"], "ok")
+
+
+def test_reload_ignores_stale_bytecode(tmp_path):
+    save(tmp_path / "watch_same.py", "VALUE = 1\n", 1_000_000_000)
+    assert batch.import_module(tmp_path / "watch_same.py").VALUE == 1
+    # Same size and mtime, so the cached bytecode looks current
+    save(tmp_path / "watch_same.py", "VALUE = 2\n", 1_000_000_000)
+    assert batch.import_module(tmp_path / "watch_same.py").VALUE == 1
+    assert batch.import_module(tmp_path / "watch_same.py", reload=True).VALUE == 2